@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+#Startup benchmark of pve-zsync-manager: runs "status --plain" (what monitoring calls every minute) with a generated status file
+#and fails if the median wall time is over the budget, or if status imports modules it doesn't need.
+#Usage: python3 benchmarks/startup.py [--budget MS] [--runs N] [--guests N]
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+managerPath = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "pve-zsync-manager.py")
+#Modules the status command must not import: the sync, restore and transfer code, asyncio (pzm_runner) and prettytable (only for the table)
+forbiddenModules = ["asyncio", "concurrent.futures", "prettytable", "pzm_sync", "pzm_replicate", "pzm_restore", "pzm_remote", "pzm_locking", "pzm_runner", "pzm_cluster"]
+
+
+#Status file like the one of a node with this many guests on two backupnames
+def write_statusfile(path, guests):
+    data = {}
+    for backupname in ["daily", "offsite"]:
+        for id in range(100, 100 + guests):
+            data[str(id) + "_" + backupname] = {"id": str(id), "backupname": backupname, "starttime": "2024-01-01_01:00:00", "endtime": "2024-01-01_01:05:00",
+                                                "duration": "0:05:00", "size": "1.5G", "status": "ok", "info": ""}
+        data["all_" + backupname] = {"id": "all", "backupname": backupname, "starttime": "2024-01-01_01:00:00", "endtime": "2024-01-01_03:00:00",
+                                     "duration": "2:00:00", "size": "-", "status": "ok", "info": ""}
+    with open(path, 'w') as statusFile:
+        json.dump(data, statusFile, indent=4)
+
+#Wall time of one run in ms
+def run_once(command):
+    starttime = time.perf_counter()
+    subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    return (time.perf_counter() - starttime) * 1000
+
+#Modules imported by one run, from the output of python -X importtime
+def imported_modules(command):
+    result = subprocess.run([command[0], '-X', 'importtime'] + command[1:], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+    modules = set()
+    for line in result.stderr.decode("utf-8").split('\n'):
+        if line.startswith("import time:") and line.count('|') == 2:
+            modules.add(line.split('|')[2].strip())
+    return modules
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--budget", help="Maximum median wall time of status in ms", type=float, default=100)
+    parser.add_argument("--runs", help="Number of measured runs", type=int, default=20)
+    parser.add_argument("--guests", help="Guests per backupname in the generated status file", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        statusfile = os.path.join(directory, "manager_sync_state")
+        write_statusfile(statusfile, args.guests)
+        command = [sys.executable, managerPath, "status", "--plain", "--status-file", statusfile]
+        baseline = [sys.executable, "-c", "pass"]
+        run_once(command) #Warm up the page cache and the bytecode cache
+        times = [run_once(command) for run in range(args.runs)]
+        baseline_times = [run_once(baseline) for run in range(args.runs)]
+        modules = imported_modules(command)
+
+    median = statistics.median(times)
+    print ("status --plain: median %.1fms, min %.1fms, max %.1fms (python itself: median %.1fms), budget %.0fms"
+           % (median, min(times), max(times), statistics.median(baseline_times), args.budget))
+    failed = False
+    loaded = [module for module in forbiddenModules if module in modules]
+    if len(loaded) > 0:
+        print ("status imports modules it doesn't need: " + ", ".join(loaded))
+        failed = True
+    if median > args.budget:
+        print ("status is over the budget by %.1fms" % (median - args.budget))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
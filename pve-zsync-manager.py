@@ -1,156 +1,383 @@
 #!/usr/bin/env -S python3 -u
 
+import os
 import sys
 import argparse
-import traceback
-
-from pzm_status import read_from_json
-from pzm_restore import gather_restore_data, restore
-from pzm_sync import sync
-from pzm_sanitize import sanitize
-from pzm_locking import unlock
-from pzm_common import log, log_debug
+
 import pzm_common
 
-def main():
-    pzm_common.initialize()
+#Every command has a function which adds its arguments and one which runs it. Only the parser of the called command is built,
+#and the modules of a command are imported when it runs, so e.g. status doesn't load the sync, restore or transfer code
 
-    if len(sys.argv) <= 2 and "status" not in sys.argv:
-        #status is the only method which can stand alone without params, everything also should append --help
-        sys.argv.append("--help")
 
-    # Command: sync  - Arguments
-    syncArgsParser = argparse.ArgumentParser()
-
-    syncArgsRequired = syncArgsParser.add_argument_group('required Arguments')
-    syncArgsRequired.add_argument("sync")
-    syncArgsRequired.add_argument("--hostname", help="Destination Host for Backups", type=str, required=True)
-    syncArgsRequired.add_argument("--zfspool", help="ZFS Destination Pool for Backups", type=str, required=True)
-    syncArgsRequired.add_argument("--backupname", help="Name of PVE-ZSYNC Snapshots", type=str, required=True)
-    syncArgsRequired.add_argument("--ids", help=" Use VM/CT Numbers, separated with commas, or use \"all\". Exclude with -number e.g --ids all,-1000", type=str, required=True)
-
-    syncArgsParser.add_argument("--dest-config-path", help="Path to store VM/CT config files on destination host", type=str)
-    syncArgsParser.add_argument("--replicate", help="Set if Dataset should be replicated with all Snapshots and Properties", action="store_true")
-    syncArgsParser.add_argument("--raw", help="Send Dataset in Raw (Encrypted) mode", action="store_true")
-    syncArgsParser.add_argument("--maxsnap", help="Keep given amount of snapshots", type=int)
-    syncArgsParser.add_argument("--properties", help="Send Dataset with properties (If Dataset is encrypted, raw has to be set too!)", action="store_true")
-    syncArgsParser.add_argument("--retries", help="Retry amount of failed backups", type=int)
-    syncArgsParser.add_argument("--prepend-storage-id", help="Prepends any VM/CT Disk with it's corresponding pve-storage id (Adds an additinal zfs dataset layer)", action="store_true")
-    syncArgsParser.add_argument("--verbose", help="Enable verbose mode", action="store_true")
-    syncArgsParser.add_argument("--test", help="Only test the functionality, do not actually execute anything", action="store_true")
-
-    # Command: status - Arguments
-    statusArgsParser = argparse.ArgumentParser()
-
-    statusArgsRequired = statusArgsParser.add_argument_group('required Arguments')
-    statusArgsRequired.add_argument("status")
-    statusArgsParser.add_argument("--verbose", help="Enable verbose mode", action="store_true")
-    statusArgsParser.add_argument("--plain", help="Print text without colors", action="store_true")
-
-    # Command: restore - Arguments
-    restoreArgsParser = argparse.ArgumentParser()
-
-    restoreArgsRequired = restoreArgsParser.add_argument_group('required Arguments')
-    restoreArgsRequired.add_argument("restore")
-    restoreArgsRequired.add_argument("--hostname", help="Backup-Source Hostname", type=str, required=True)
-    restoreArgsRequired.add_argument("--zfs-source-pool", help="ZFS Source Pool (Same as destination Pool with \"sync\")", type=str, required=True)
-    restoreArgsRequired.add_argument("--backupname", help="Name of PVE-ZSYNC Snapshots (Same as with \"sync\")", type=str, required=True)
-    restoreArgsRequired.add_argument("--config-path", help="Path to restore VM/CT config files from", type=str, required=True)
-    restoreArgsParser.add_argument("--keyfile", help="Path to keyfile, needed for inheriting the ZFS-Key", type=str)
-    restoreArgsParser.add_argument("--test", help="Only test the functionality, do not actually execute anything", action="store_true")
-    restoreArgsParser.add_argument("--verbose", help="Enable verbose mode", action="store_true")
-    restoreArgsParser.add_argument("--filter", help="Filter for given string")
-
-    # Command: sanitize - Arguments
-    sanitizeArgsParser = argparse.ArgumentParser()
-
-    sanitizeArgsRequired = sanitizeArgsParser.add_argument_group('required Arguments')
-    sanitizeArgsRequired.add_argument("sanitize")
-    sanitizeArgsRequired.add_argument("--hostname", help="Host to sanitize", type=str, required=True)
-    sanitizeArgsRequired.add_argument("--zfspool", help="ZFS Pool to sanitize", type=str, required=True)
-    sanitizeArgsRequired.add_argument("--backupname", help="Name of PVE-ZSYNC Snapshots", type=str, required=True)
-    sanitizeArgsRequired.add_argument("--ids", help=" Use VM/CT Numbers, separated with commas, or use \"all\". Exclude with -number e.g --ids all,-1000", type=str, required=True)
-    sanitizeArgsParser.add_argument("--verbose", help="Enable verbose mode", action="store_true")
-    sanitizeArgsParser.add_argument("--test", help="Only test the functionality, do not actually execute anything", action="store_true")
-
-
-    if "sync" in sys.argv:
-        args = syncArgsParser.parse_args()
-        pzm_common.debug = args.verbose
-        pzm_common.test = args.test
-        if pzm_common.debug:
-            log ("Debug mode")
-        if pzm_common.test:
-            log ("Test mode")
+# Command: sync - Arguments
+def sync_arguments(parser):
+    from pzm_throttle import hours_argument
+    required = parser.add_argument_group('required Arguments')
+    required.add_argument("--hostname", help="Destination Host for Backups", type=str, required=True)
+    required.add_argument("--zfspool", help="ZFS Destination Pool for Backups", type=str, required=True)
+    required.add_argument("--backupname", help="Name of PVE-ZSYNC Snapshots", type=str, required=True)
+    required.add_argument("--ids", help=" Use VM/CT Numbers, separated with commas, or use \"all\". Exclude with -number e.g --ids all,-1000", type=str, required=True)
+    parser.add_argument("--dest-config-path", help="Path to store VM/CT config files on destination host", type=str)
+    parser.add_argument("--replicate", help="Set if Dataset should be replicated with all Snapshots and Properties", action="store_true")
+    parser.add_argument("--raw", help="Send Dataset in Raw (Encrypted) mode", action="store_true")
+    parser.add_argument("--maxsnap", help="Keep given amount of snapshots", type=int)
+    parser.add_argument("--properties", help="Send Dataset with properties (If Dataset is encrypted, raw has to be set too!)", action="store_true")
+    parser.add_argument("--retries", help="Retry amount of failed backups", type=int)
+    parser.add_argument("--prepend-storage-id", help="Prepends any VM/CT Disk with it's corresponding pve-storage id (Adds an additinal zfs dataset layer)", action="store_true")
+    parser.add_argument("--engine", help="Sync with pve-zsync (default) or with the built-in native replication engine", choices=["pve-zsync", "native"], default="pve-zsync")
+    parser.add_argument("--compressed", help="Send compressed blocks as they are on disk (native engine only)", action="store_true")
+    parser.add_argument("--consistency-groups", help="IDs which are snapshotted at the same point in time, separate IDs with commas and groups with semicolons e.g. 100,101;200,201 (native engine only)", type=str)
+    parser.add_argument("--agent", help="Do remote work with a helper agent over one ssh session, in batches", action="store_true")
+    parser.add_argument("--pull-lanes", help="Pull from at most this many source hosts at the same time (default: all)", type=int)
+    parser.add_argument("--lane-limit", help="Sync at most this many IDs of one source host at the same time (default 1)", type=int, default=1)
+    parser.add_argument("--keep", help="Retention policy for the destination instead of --maxsnap e.g. last=4,hourly=24,daily=7,weekly=4,monthly=12,yearly=2 (native engine only)", type=str)
+    parser.add_argument("--config-store", help="Keep the VM/CT configs on the destination content-addressed (each distinct config once, an index per VM/CT), existing config files are imported", action="store_true")
+    parser.add_argument("--adaptive", help="Sync an ID only if its delta will be over this many MB by the next run (from its change rate), or after --max-interval. Run the job often, e.g. every 15 minutes", type=int)
+    parser.add_argument("--min-interval", help="With --adaptive: sync an ID at most every this many minutes (default 0)", type=int, default=0)
+    parser.add_argument("--max-interval", help="With --adaptive: sync an ID at least every this many minutes (default 1440)", type=int, default=1440)
+    parser.add_argument("--preflight", help="Check free space and pool features of the destination before the sync. \"fail\" stops if not all IDs fit, \"shrink\" skips the IDs which don't fit", choices=["fail", "shrink"])
+    parser.add_argument("--facts-ttl", help="Reuse the gathered destination facts of --preflight for this many minutes (default 10)", type=int, default=10)
+    parser.add_argument("--io-limit", help="Limit the disk bandwidth of transfers to this many MB/s (read and write, per pool disk), best effort: most ZFS I/O is done by kernel threads", type=int)
+    parser.add_argument("--io-weight", help="IO weight of transfers (1-10000, default of other processes is 100), best effort like --io-limit", type=int)
+    parser.add_argument("--cpu-limit", help="Limit the CPU usage of transfers to this many percent of one CPU", type=int)
+    parser.add_argument("--throttle-hours", help="Only limit transfers within these times of day e.g. 07:00-19:00 or 07:00-12:00,13:00-19:00", type=hours_argument)
+    parser.add_argument("--tune-transfers", help="Benchmark ssh ciphers and compression (none/lz4/zstd) per host and use the fastest, measured again after this many days", type=int)
+    parser.add_argument("--timeout", help="Kill single commands (not transfers) after this many seconds", type=int)
+    parser.add_argument("--stall-timeout", help="Kill transfers which make no progress for this many minutes, they are retried like any other failure", type=int)
+    parser.add_argument("--verbose", help="Enable verbose mode", action="store_true")
+    parser.add_argument("--test", help="Only test the functionality, do not actually execute anything", action="store_true")
+
+def run_sync(args):
+    import traceback
+    from pzm_sync import sync
+    from pzm_locking import unlock
+    from pzm_throttle import setup_throttle
+    from pzm_common import log
+    pzm_common.debug = args.verbose
+    pzm_common.test = args.test
+    pzm_common.use_agent = args.agent
+    pzm_common.command_timeout = args.timeout
+    pzm_common.stall_timeout = args.stall_timeout * 60 if args.stall_timeout is not None else None
+    pzm_common.tune_interval = args.tune_transfers
+    setup_throttle(args.io_limit, args.io_weight, args.cpu_limit, args.throttle_hours)
+    if pzm_common.debug:
+        log ("Debug mode")
+    if pzm_common.test:
+        log ("Test mode")
+    try:
+        log ("Sync started with: " + ' '.join(sys.argv[0:]))
+        sync(args)
+    except KeyboardInterrupt:
+        log ("\nInterupted by User")
+        unlock(args.hostname)
+    except Exception: #Also unlock at any other exception
+        print(traceback.format_exc())
+        unlock(args.hostname)
+
+
+# Command: status - Arguments
+def status_arguments(parser):
+    parser.add_argument("--verbose", help="Enable verbose mode", action="store_true")
+    parser.add_argument("--plain", help="Print text without colors", action="store_true")
+    parser.add_argument("--cluster", help="Show the merged status of all nodes of the last cluster sync", action="store_true")
+    parser.add_argument("--status-file", help="Status file to show (default the status of this node)", type=str)
+
+def run_status(args):
+    from pzm_status import read_from_json
+    statusfile = args.status_file
+    if args.cluster:
+        from pzm_cluster import clusterStatusJsonFile
+        statusfile = clusterStatusJsonFile
+    read_from_json(args.plain, statusfile)
+
+
+# Command: restore - Arguments
+def restore_arguments(parser):
+    from pzm_throttle import hours_argument
+    required = parser.add_argument_group('required Arguments')
+    required.add_argument("--hostname", help="Backup-Source Hostname", type=str, required=True)
+    required.add_argument("--zfs-source-pool", help="ZFS Source Pool (Same as destination Pool with \"sync\")", type=str, required=True)
+    required.add_argument("--backupname", help="Name of PVE-ZSYNC Snapshots (Same as with \"sync\")", type=str, required=True)
+    required.add_argument("--config-path", help="Path to restore VM/CT config files from", type=str, required=True)
+    parser.add_argument("--keyfile", help="Path to keyfile, needed for inheriting the ZFS-Key", type=str)
+    parser.add_argument("--retries", help="Resume an interrupted receive this many times", type=int)
+    parser.add_argument("--agent", help="Do remote work with a helper agent over one ssh session, in batches", action="store_true")
+    parser.add_argument("--list", help="List the restore points (snapshots with a config, consistent over all disks) of every VM/CT and exit", action="store_true")
+    parser.add_argument("--at", help="Restore every VM/CT from its newest restore point at or before this time e.g. 2024-05-01_13:00:00 or 2024-05-01", type=str)
+    parser.add_argument("--emit-plan", help="Write a restore plan (JSON, or YAML if the file ends with .yaml/.yml) instead of asking, and exit", type=str)
+    parser.add_argument("--plan", help="Execute a restore plan without asking, after validating it", type=str)
+    parser.add_argument("--clone", help="Clone the snapshots into place instead of copying them, if the backup is a local replica in the same pool", action="store_true")
+    parser.add_argument("--promote", help="With --clone: promote the clones, so they don't depend on the replica", action="store_true")
+    parser.add_argument("--independent", help="With --clone: copy the snapshots to independent datasets in the background", action="store_true")
+    parser.add_argument("--parallel", help="Restore this many VM/CTs at the same time, if their disks are independent", type=int, default=1)
+    parser.add_argument("--io-limit", help="Limit the disk bandwidth of transfers to this many MB/s (read and write, per pool disk), best effort: most ZFS I/O is done by kernel threads", type=int)
+    parser.add_argument("--io-weight", help="IO weight of transfers (1-10000, default of other processes is 100), best effort like --io-limit", type=int)
+    parser.add_argument("--cpu-limit", help="Limit the CPU usage of transfers to this many percent of one CPU", type=int)
+    parser.add_argument("--throttle-hours", help="Only limit transfers within these times of day e.g. 07:00-19:00 or 07:00-12:00,13:00-19:00", type=hours_argument)
+    parser.add_argument("--tune-transfers", help="Benchmark ssh ciphers and compression (none/lz4/zstd) per host and use the fastest, measured again after this many days", type=int)
+    parser.add_argument("--timeout", help="Kill single commands (not transfers) after this many seconds", type=int)
+    parser.add_argument("--stall-timeout", help="Kill transfers which make no progress for this many minutes", type=int)
+    parser.add_argument("--test", help="Only test the functionality, do not actually execute anything", action="store_true")
+    parser.add_argument("--verbose", help="Enable verbose mode", action="store_true")
+    parser.add_argument("--filter", help="Filter for given string")
+
+def run_restore(args):
+    import traceback
+    from pzm_restore import gather_restore_data, restore, list_restore_points
+    from pzm_restore_plan import emit_restore_plan, load_restore_plan
+    from pzm_locking import unlock
+    from pzm_throttle import setup_throttle
+    if (args.promote or args.independent) and not args.clone:
+        print ("--promote and --independent need --clone")
+        sys.exit(1)
+    pzm_common.debug = args.verbose
+    pzm_common.test = args.test
+    pzm_common.use_agent = args.agent
+    pzm_common.command_timeout = args.timeout
+    pzm_common.stall_timeout = args.stall_timeout * 60 if args.stall_timeout is not None else None
+    pzm_common.tune_interval = args.tune_transfers
+    setup_throttle(args.io_limit, args.io_weight, args.cpu_limit, args.throttle_hours)
+    if pzm_common.debug:
+        print ("Debug mode")
+    if pzm_common.test:
+        print ("Test mode")
+    try:
+        if args.list:
+            list_restore_points(args)
+            sys.exit(0)
+        elif args.emit_plan is not None:
+            emit_restore_plan(args)
+            sys.exit(0)
+        elif args.plan is not None:
+            disk_groups = load_restore_plan(args)
+        else:
+            disk_groups = gather_restore_data(args)
+    except KeyboardInterrupt:
+        print ("\nInterupted by User")
+        sys.exit(1)
+    if disk_groups is not None:
         try:
-            log ("Sync started with: " + ' '.join(sys.argv[0:]))
-            sync(args)
+            restore(args, disk_groups)
         except KeyboardInterrupt:
-            log ("\nInterupted by User")
+            print ("\nInterupted by User")
             unlock(args.hostname)
         except Exception: #Also unlock at any other exception
             print(traceback.format_exc())
             unlock(args.hostname)
 
 
-    elif "status" in sys.argv:
-        args = statusArgsParser.parse_args()
-        read_from_json(args.plain)
-
+# Command: sanitize - Arguments
+def sanitize_arguments(parser):
+    required = parser.add_argument_group('required Arguments')
+    required.add_argument("--hostname", help="Host to sanitize", type=str, required=True)
+    required.add_argument("--zfspool", help="ZFS Pool to sanitize", type=str, required=True)
+    required.add_argument("--backupname", help="Name of PVE-ZSYNC Snapshots", type=str, required=True)
+    required.add_argument("--ids", help=" Use VM/CT Numbers, separated with commas, or use \"all\". Exclude with -number e.g --ids all,-1000", type=str, required=True)
+    parser.add_argument("--report", help="Only report the newest common snapshot and the possible incremental of each disk, do not change anything", action="store_true")
+    parser.add_argument("--agent", help="Do remote work with a helper agent over one ssh session, in batches", action="store_true")
+    parser.add_argument("--verbose", help="Enable verbose mode", action="store_true")
+    parser.add_argument("--test", help="Only test the functionality, do not actually execute anything", action="store_true")
 
-    elif "restore" in sys.argv:
-        args = restoreArgsParser.parse_args()
-        pzm_common.debug = args.verbose
-        pzm_common.test = args.test
-        if pzm_common.debug:
-            print ("Debug mode")
-        if pzm_common.test:
-            print ("Test mode")
-        try:
-            disk_groups = gather_restore_data(args)
-        except KeyboardInterrupt:
+def run_sanitize(args):
+    from pzm_sanitize import sanitize
+    pzm_common.debug = args.verbose
+    pzm_common.test = args.test
+    pzm_common.use_agent = args.agent
+    if pzm_common.debug:
+        print ("Debug mode")
+    if pzm_common.test:
+        print ("Test mode")
+    try:
+        sanitize(args)
+    except KeyboardInterrupt:
             print ("\nInterupted by User")
-            sys.exit(1)
-        if disk_groups is not None:
-            try:
-                restore(args, disk_groups)
-            except KeyboardInterrupt:
-                print ("\nInterupted by User")
-                unlock(args.hostname)
-            except Exception: #Also unlock at any other exception
-                print(traceback.format_exc())
-                unlock(args.hostname)
-
-
-    elif "sanitize" in sys.argv:
-        args = sanitizeArgsParser.parse_args()
-        pzm_common.debug = args.verbose
-        pzm_common.test = args.test
-        if pzm_common.debug:
-            print ("Debug mode")
-        if pzm_common.test:
-            print ("Test mode")
-        try:
-            sanitize(args)
-        except KeyboardInterrupt:
-                print ("\nInterupted by User")
 
-    #If no command is given
-    else:
-        print ("ERROR: no or invalid command sepcified!")
-        print ("")
-        print ("USAGE: ")
-        print ("    " + sys.argv[0] + " status [OPTIONS]")
-        print ("    " + sys.argv[0] + " sync [OPTIONS]")
-        print ("    " + sys.argv[0] + " restore [OPTIONS]")
-        print ("    " + sys.argv[0] + " sanitize [OPTIONS]")
 
+# Command: cluster - Arguments (all other arguments are passed to the sync of every node)
+def cluster_arguments(parser):
+    required = parser.add_argument_group('required Arguments')
+    required.add_argument("--hostname", help="Destination Host for Backups", type=str, required=True)
+    required.add_argument("--zfspool", help="ZFS Destination Pool for Backups", type=str, required=True)
+    required.add_argument("--backupname", help="Name of PVE-ZSYNC Snapshots", type=str, required=True)
+    required.add_argument("--ids", help=" Use VM/CT Numbers of the whole cluster, separated with commas, or use \"all\". Exclude with -number e.g --ids all,-1000", type=str, required=True)
+    parser.add_argument("--budget", help="Sync at most this many IDs at the same time on all nodes together (default 1)", type=int, default=1)
+    parser.add_argument("--manager-path", help="Path of pve-zsync-manager on the nodes (default: same as on this node)", type=str, default=os.path.abspath(sys.argv[0]))
+    parser.add_argument("--verbose", help="Enable verbose mode", action="store_true")
+    parser.add_argument("--test", help="Only test the functionality, do not actually execute anything", action="store_true")
 
+def run_cluster(args, node_args):
+    import traceback
+    from pzm_cluster import coordinate
+    from pzm_locking import unlock
+    from pzm_common import log
+    pzm_common.debug = args.verbose
+    pzm_common.test = args.test
+    if pzm_common.debug:
+        log ("Debug mode")
+    if pzm_common.test:
+        log ("Test mode")
+    try:
+        log ("Cluster sync started with: " + ' '.join(sys.argv[0:]))
+        coordinate(args, node_args)
+    except KeyboardInterrupt:
+        log ("\nInterupted by User")
+        unlock(args.hostname)
+    except Exception: #Also unlock at any other exception
+        print(traceback.format_exc())
+        unlock(args.hostname)
 
-if __name__ == "__main__":
-    main()
 
+# Command: prune - Arguments
+def prune_arguments(parser):
+    required = parser.add_argument_group('required Arguments')
+    required.add_argument("--hostname", help="Host to prune", type=str, required=True)
+    required.add_argument("--zfspool", help="ZFS Pool to prune", type=str, required=True)
+    required.add_argument("--backupname", help="Name of PVE-ZSYNC Snapshots", type=str, required=True)
+    required.add_argument("--keep", help="Retention policy e.g. last=4,hourly=24,daily=7,weekly=4,monthly=12,yearly=2", type=str, required=True)
+    parser.add_argument("--ids", help="Only prune the disks of these VM/CT IDs e.g. 100,101 (default all: every dataset below --zfspool, also those of other nodes)", type=str, default="all")
+    parser.add_argument("--dest-config-path", help="Path of the VM/CT config files on the host", type=str)
+    parser.add_argument("--agent", help="Do remote work with a helper agent over one ssh session, in batches", action="store_true")
+    parser.add_argument("--verbose", help="Enable verbose mode", action="store_true")
+    parser.add_argument("--test", help="Only test the functionality, do not actually execute anything", action="store_true")
 
+def run_prune(args):
+    from pzm_retention import prune
+    from pzm_locking import unlock
+    pzm_common.debug = args.verbose
+    pzm_common.test = args.test
+    pzm_common.use_agent = args.agent
+    if pzm_common.debug:
+        print ("Debug mode")
+    if pzm_common.test:
+        print ("Test mode")
+    try:
+        prune(args)
+    except KeyboardInterrupt:
+        print ("\nInterupted by User")
+        unlock(args.hostname)
 
 
+# Command: verify - Arguments
+def verify_arguments(parser):
+    required = parser.add_argument_group('required Arguments')
+    required.add_argument("--hostname", help="Backup host to verify", type=str, required=True)
+    required.add_argument("--zfspool", help="ZFS Pool of the backups", type=str, required=True)
+    required.add_argument("--backupname", help="Name of PVE-ZSYNC Snapshots", type=str, required=True)
+    parser.add_argument("--ids", help="IDs to verify e.g. all,-101 or 100,101 (default all)", type=str, default="all")
+    parser.add_argument("--dest-config-path", help="Path of the VM/CT config files on the host", type=str)
+    parser.add_argument("--deep", help="Also clone every snapshot and mount it, or read all its data into a checksum", type=str, choices=["mount", "checksum"])
+    parser.add_argument("--agent", help="Do remote work with a helper agent over one ssh session, in batches", action="store_true")
+    parser.add_argument("--timeout", help="Kill single commands (not deep checks) after this many seconds", type=int)
+    parser.add_argument("--stall-timeout", help="Kill deep checks which make no progress for this many minutes", type=int)
+    parser.add_argument("--verbose", help="Enable verbose mode", action="store_true")
+    parser.add_argument("--test", help="Only test the functionality, do not actually execute anything", action="store_true")
 
+def run_verify(args):
+    from pzm_verify import verify
+    from pzm_locking import unlock
+    pzm_common.debug = args.verbose
+    pzm_common.test = args.test
+    pzm_common.use_agent = args.agent
+    pzm_common.command_timeout = args.timeout
+    pzm_common.stall_timeout = args.stall_timeout * 60 if args.stall_timeout is not None else None
+    if pzm_common.debug:
+        print ("Debug mode")
+    if pzm_common.test:
+        print ("Test mode")
+    try:
+        verify(args)
+    except KeyboardInterrupt:
+        print ("\nInterupted by User")
+        unlock(args.hostname)
+
+
+# Command: simulate - Arguments
+def simulate_arguments(parser):
+    parser.add_argument("--backupname", help="Only simulate these backupnames (comma separated), default all in the status", type=str)
+    parser.add_argument("--pull-lanes", help="Sync from at most this many source hosts at the same time (default all)", type=int)
+    parser.add_argument("--lane-limit", help="Sync up to this many IDs of one source host at the same time", type=int, default=1)
+    parser.add_argument("--target-cap", help="Sync at most this many IDs to one target (backupname) at the same time", type=int)
+    parser.add_argument("--bandwidth", help="Bandwidth of one target in MB/s, shared by its transfers", type=float)
+    parser.add_argument("--retries", help="Retries of failed IDs (default as recorded)", type=int)
+    parser.add_argument("--retry-cost", help="Part of a transfer which is repeated by a retry, 1.0 sends everything again, 0.0 resumes", type=float, default=1.0)
+    parser.add_argument("--order", help="Order of the IDs within a lane", type=str, choices=["id", "longest"], default="id")
+    parser.add_argument("--window", help="Report the IDs which don't finish within this many minutes", type=int)
+    parser.add_argument("--status-file", help="Status file with the recorded syncs (default the status of this node)", type=str)
+
+def run_simulate(args):
+    from pzm_simulate import simulate
+    simulate(args)
+
+
+# Command: audit - Arguments
+def audit_arguments(parser):
+    required = parser.add_argument_group('required Arguments')
+    required.add_argument("--target", help="Target to audit as hostname:zfspool:backupname, repeat for several targets", type=str, action="append", required=True)
+    parser.add_argument("--ids", help="IDs to audit e.g. all,-101 or 100,101 (default all)", type=str, default="all")
+    parser.add_argument("--max-lag", help="Report disks whose newest replicated snapshot is older than this many minutes as issue", type=int)
+    parser.add_argument("--json", help="Print the result as JSON, e.g. for alerting", action="store_true")
+    parser.add_argument("--timeout", help="Kill the listings after this many seconds", type=int)
+    parser.add_argument("--verbose", help="Enable verbose mode", action="store_true")
+
+def run_audit(args):
+    from pzm_audit import audit
+    pzm_common.debug = args.verbose
+    pzm_common.command_timeout = args.timeout
+    try:
+        audit(args)
+    except KeyboardInterrupt:
+        print ("\nInterupted by User")
+
+
+#Name, help text, arguments and runner of every command, in the order of the usage
+commands = {
+    "status": ("Show the status of the last syncs", status_arguments, run_status),
+    "sync": ("Sync VM/CTs to a backup host", sync_arguments, run_sync),
+    "restore": ("Restore VM/CTs from a backup host", restore_arguments, run_restore),
+    "sanitize": ("Align the snapshots of a backup host with this host, so the next sync is incremental", sanitize_arguments, run_sanitize),
+    "prune": ("Delete backup snapshots with a retention policy", prune_arguments, run_prune),
+    "verify": ("Check the backups on a backup host", verify_arguments, run_verify),
+    "audit": ("Report how far the replicas of every disk are behind on one or more targets", audit_arguments, run_audit),
+    "simulate": ("Predict the duration of syncs from the recorded status, offline", simulate_arguments, run_simulate),
+    "cluster": ("Sync all nodes of a cluster with a shared budget [SYNC OPTIONS]", cluster_arguments, run_cluster),
+}
+
+def main():
+    pzm_common.initialize()
+
+    #The command is the first argument, not any argument which looks like one (e.g. a backupname containing "sync")
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    parser = argparse.ArgumentParser(prog=os.path.basename(sys.argv[0]))
+    subparsers = parser.add_subparsers(dest="command", metavar="COMMAND")
+    for name, (help, arguments, run) in commands.items():
+        subparser = subparsers.add_parser(name, help=help)
+        if name == command:
+            arguments(subparser)
+
+    if command is None or (not command.startswith('-') and not command in commands):
+        print ("ERROR: no or invalid command sepcified!")
+        print ("")
+        parser.print_help()
+        sys.exit(1)
+    if command.startswith('-') and not command in ["-h", "--help"]: #Options belong after the command, e.g. "--verbose status"
+        parser.print_usage()
+        sys.exit(2)
+    if len(sys.argv) == 2 and command != "status":
+        #status is the only method which can stand alone without params, everything else shows its help
+        sys.argv.append("--help")
+
+    if command == "cluster":
+        args, node_args = parser.parse_known_args()
+        run_cluster(args, node_args)
+    else:
+        args = parser.parse_args()
+        if args.command is None: #Argparse doesn't require the command
+            parser.print_usage()
+            sys.exit(2)
+        commands[args.command][2](args)
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+import fcntl
+import json
+import os
+import time
+
+import pzm_common
+from pzm_common import log, log_debug
+from pzm_replicate import Replication_Job
+from pzm_preflight import estimate_send_sizes, format_size
+
+#Change rates and last syncs of every target (hostname:zfspool:backupname) and ID, for --adaptive. Jobs of other targets may run at the
+#same time, the file is only changed under adaptiveLockFile
+adaptiveStateFile = "/var/lib/pve-zsync/manager_adaptive_state"
+adaptiveLockFile = "/var/lib/pve-zsync/manager_adaptive_state.lock"
+#Weight of the newest sample in the smoothed change rate and run interval (exponentially weighted moving average)
+rateSmoothing = 0.3
+
+
+def load_state():
+    if not os.path.exists(adaptiveStateFile):
+        return {}
+    with open(adaptiveStateFile, 'r') as stateFile:
+        try:
+            return json.load(stateFile)
+        except ValueError:
+            return {}
+
+#Written to a temporary file and renamed, so a job which reads the state meanwhile never sees a partial file
+def save_state(state):
+    with open(adaptiveStateFile + '.tmp', 'w') as stateFile:
+        json.dump(state, stateFile, indent=4)
+    os.replace(adaptiveStateFile + '.tmp', adaptiveStateFile)
+
+#Key of a target in the state, the same backupname may be used on several targets
+def target_key(args):
+    return args.hostname + ":" + args.zfspool + ":" + args.backupname
+
+def smooth(previous, sample):
+    if previous is None:
+        return sample
+    return previous + rateSmoothing * (sample - previous)
+
+#Change rate (bytes/s) of a guest since its last sample. written grows from the newest snapshot on, so if the guest was synced
+#after the last sample, the growth is counted from the sync. A snapshot by someone else (another backupname) resets written, then
+#only what was written since that is known
+def rate_sample(guest, pending, now):
+    if guest.get("sample_time") is None:
+        return None
+    if guest.get("last_sync") is not None and guest["last_sync"] >= guest["sample_time"]:
+        since, growth = guest["last_sync"], pending
+    else:
+        since, growth = guest["sample_time"], pending - guest["sample_written"]
+        if growth < 0:
+            growth = pending
+    if now - since <= 0:
+        return None
+    return growth / (now - since)
+
+#Whether an ID is synced in this run and why. Due are IDs which were never synced adaptively, reached max_interval, or whose pending delta
+#(written since the last snapshot) is over delta or will be before the next run at the current change rate. Nothing is synced within min_interval
+def is_due(guest, pending, now, run_interval, delta, min_interval, max_interval):
+    if guest.get("last_sync") is None:
+        return True, "first adaptive sync"
+    elapsed = now - guest["last_sync"]
+    if elapsed < min_interval:
+        return False, "synced " + str(int(elapsed / 60)) + " minutes ago"
+    if elapsed >= max_interval:
+        return True, "not synced for " + str(int(elapsed / 60)) + " minutes"
+    expected = pending + (guest.get("rate") or 0) * (run_interval or 0)
+    if expected >= delta:
+        return True, format_size(pending) + " pending, " + format_size(expected) + " by the next run"
+    return False, format_size(pending) + " pending, " + format_size(expected) + " by the next run"
+
+#Select the IDs which are due in this run of --adaptive (delta in MB, intervals in minutes), from one sample of what every guest has written.
+#The cron job runs often (e.g. every 15 minutes), busy guests are synced in most runs with small deltas, quiet ones only after max_interval.
+#Returns the IDs to sync and the state to save with record() after the run
+def select_due(args, ids, delta, min_interval, max_interval):
+    now = time.time()
+    state = load_state()
+    target = state.setdefault(target_key(args), {"guests": {}})
+    if target.get("last_run") is not None:
+        target["run_interval"] = smooth(target.get("run_interval"), now - target["last_run"])
+    target["last_run"] = now
+    job = Replication_Job(args.hostname, args.zfspool, args.backupname, args.maxsnap, args.replicate, args.raw, args.properties, args.compressed, args.prepend_storage_id, args.dest_config_path)
+    estimates, destinations = estimate_send_sizes(job, ids)
+
+    due = []
+    for id in ids:
+        guest = target["guests"].setdefault(id, {})
+        if not id in estimates:
+            due.append(id) #No disk on ZFS or not readable, the sync decides
+            continue
+        pending = estimates[id]
+        sample = rate_sample(guest, pending, now)
+        if sample is not None:
+            guest["rate"] = smooth(guest.get("rate"), sample)
+        guest["sample_time"] = now
+        guest["sample_written"] = pending
+        sync, reason = is_due(guest, pending, now, target.get("run_interval"), delta * 1024 * 1024, min_interval * 60, max_interval * 60)
+        log_debug ("Adaptive: ID " + id + (" due, " if sync else " not due, ") + reason + ", change rate " + format_size((guest.get("rate") or 0) * 3600) + "/h")
+        if sync:
+            due.append(id)
+    for id in list(target["guests"].keys()):
+        if not id in ids:
+            del target["guests"][id] #Removed or excluded since
+    log ("Adaptive: " + str(len(due)) + " of " + str(len(ids)) + " IDs due, target delta " + format_size(delta * 1024 * 1024)
+         + (", about " + str(int(target["run_interval"] / 60)) + " minutes between runs" if target.get("run_interval") is not None else ""))
+    return due, state
+
+#Remember the start of the run as last sync of the synced IDs, their snapshots were taken in this run. Failed IDs stay due.
+#The file is read again under the lock and only the entry of this target is replaced, so jobs of other targets which ran meanwhile are kept
+def record(args, state, synced):
+    if pzm_common.test:
+        return
+    target = state[target_key(args)]
+    for id in synced:
+        target["guests"].setdefault(id, {})["last_sync"] = target["last_run"]
+    with open(adaptiveLockFile, 'a') as lock_file: #Closing the file releases the lock
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        current = load_state()
+        current[target_key(args)] = target
+        save_state(current)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+#Remote helper agent. This file is streamed to the remote host by pzm_remote.Remote_Agent and executed there with python3,
+#so it may only use the python standard library. It reads one batch of requests per line from stdin
+#and answers every batch with one line (JSON list of results, in the same order as the requests) on stdout.
+#Batch:   {"test": false, "requests": [{"op": "list_snapshots", "datasets": [...], "properties": [...]}, ...]}
+#Result:  {"ok": true, "result": ...} or {"ok": false, "error": "..."}
+
+import json
+import os
+import subprocess
+import sys
+
+#Mutating operations are skipped and reported as successful in test mode, like execute_command does
+mutating_ops = ["lock", "unlock", "rollback", "destroy", "rename", "write_file"]
+
+
+#Run a command, returns returncode, stdout, stderr
+def run(command):
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+    return process.returncode, stdout.decode("utf-8"), stderr.decode("utf-8")
+
+#Snapshots of the given datasets with the given properties, oldest first. Returns dataset -> list of {"name": <snapname>, <property>: <value>, ...}
+def list_snapshots(request):
+    properties = request.get("properties", [])
+    datasets = request.get("datasets", [])
+    snapshots = {}
+    if len(datasets) == 0:
+        return snapshots
+    rc, stdout, stderr = run(['zfs', 'list', '-t', 'snapshot', '-H', '-p', '-o', ','.join(['name'] + properties), '-s', 'createtxg'] + datasets)
+    for line in stdout.split('\n'):
+        fields = line.split('\t')
+        if len(fields) != len(properties) + 1 or not '@' in fields[0]:
+            continue
+        dataset, snapname = fields[0].split('@', 1)
+        snapshot = {"name": snapname}
+        for property, value in zip(properties, fields[1:]):
+            snapshot[property] = value
+        snapshots.setdefault(dataset, []).append(snapshot)
+    return snapshots
+
+#Properties of the given datasets. Returns dataset -> {property: value}. Datasets which don't exist are missing
+def get_properties(request):
+    datasets = request.get("datasets", [])
+    values = {}
+    if len(datasets) == 0:
+        return values
+    rc, stdout, stderr = run(['zfs', 'get', '-H', '-p', '-o', 'name,property,value', ','.join(request["properties"])] + datasets)
+    for line in stdout.split('\n'):
+        fields = line.split('\t')
+        if len(fields) != 3:
+            continue
+        values.setdefault(fields[0], {})[fields[1]] = fields[2]
+    return values
+
+#Names of all datasets below root (including root) of the given type
+def list_datasets(request):
+    rc, stdout, stderr = run(['zfs', 'list', '-H', '-r', '-t', request.get("type", "filesystem,volume"), '-o', 'name', request["root"]])
+    if rc != 0:
+        raise Exception(stderr.strip())
+    return [line for line in stdout.split('\n') if line != ""]
+
+#Create the lockfile with the given value and make it immutable. Fails if it exists already. Returns the holder if it couldn't be locked
+def lock(request):
+    try:
+        fd = os.open(request["path"], os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+    except FileExistsError:
+        with open(request["path"], 'r') as lockfile:
+            return {"locked": False, "holder": lockfile.read()}
+    with os.fdopen(fd, 'w') as lockfile:
+        lockfile.write(request["value"])
+    run(['chattr', '+i', request["path"]])
+    return {"locked": True, "holder": request["value"]}
+
+#Remove the lockfile. Returns False if it didn't exist
+def unlock(request):
+    if not os.path.exists(request["path"]):
+        return False
+    run(['chattr', '-i', request["path"]])
+    os.remove(request["path"])
+    return True
+
+#Roll a dataset back to the given snapshot, destroying newer snapshots
+def rollback(request):
+    rc, stdout, stderr = run(['zfs', 'rollback', '-r', request["snapshot"]])
+    if rc != 0:
+        raise Exception(stderr.strip())
+    return True
+
+#Rename a snapshot
+def rename(request):
+    rc, stdout, stderr = run(['zfs', 'rename', request["source"], request["destination"]])
+    if rc != 0:
+        raise Exception(stderr.strip())
+    return True
+
+#Destroy snapshots of a dataset, snapshots is a list of snapshot names (the part after @). One zfs destroy for all of them
+def destroy(request):
+    rc, stdout, stderr = run(['zfs', 'destroy', request["dataset"] + '@' + ','.join(request["snapshots"])])
+    if rc != 0:
+        raise Exception(stderr.strip())
+    return True
+
+#Content of a file, None if it doesn't exist
+def read_file(request):
+    if not os.path.exists(request["path"]):
+        return None
+    with open(request["path"], 'r') as file:
+        return file.read()
+
+#Write a file, creating its directory if needed
+def write_file(request):
+    directory = os.path.dirname(request["path"])
+    if directory != "" and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(request["path"], 'w') as file:
+        file.write(request["content"])
+    return True
+
+#File names in a directory, sorted by name
+def list_dir(request):
+    return sorted(os.listdir(request["path"]))
+
+#Run a readonly command and return its output, for everything without an own operation
+def command(request):
+    rc, stdout, stderr = run(request["command"])
+    return {"rc": rc, "stdout": stdout, "stderr": stderr}
+
+operations = {
+    "list_snapshots": list_snapshots,
+    "get_properties": get_properties,
+    "list_datasets": list_datasets,
+    "lock": lock,
+    "unlock": unlock,
+    "rollback": rollback,
+    "rename": rename,
+    "destroy": destroy,
+    "read_file": read_file,
+    "write_file": write_file,
+    "list_dir": list_dir,
+    "command": command,
+}
+
+#Execute one request, errors are reported per request and don't affect the other requests of the batch
+def handle(request, test):
+    op = request.get("op")
+    if not op in operations:
+        return {"ok": False, "error": "Unknown operation " + str(op)}
+    if test and op in mutating_ops:
+        if op == "lock":
+            return {"ok": True, "result": {"locked": True, "holder": request.get("value")}}
+        return {"ok": True, "result": True}
+    try:
+        return {"ok": True, "result": operations[op](request)}
+    except Exception as e:
+        return {"ok": False, "error": str(e)}
+
+#Main loop: one batch per line until stdin is closed
+def serve(stdin, stdout):
+    stdout.write(b'{"ready": true}\n')
+    stdout.flush()
+    for line in stdin:
+        try:
+            batch = json.loads(line.decode("utf-8"))
+        except ValueError as e:
+            results = [{"ok": False, "error": "Invalid request: " + str(e)}]
+        else:
+            results = [handle(request, batch.get("test", False)) for request in batch.get("requests", [])]
+        stdout.write((json.dumps(results) + '\n').encode("utf-8"))
+        stdout.flush()
+
+
+if __name__ == "__main__":
+    serve(sys.stdin.buffer, sys.stdout.buffer)
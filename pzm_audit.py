@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+import concurrent.futures
+import datetime
+import json
+import shlex
+import sys
+import time
+
+from pzm_common import log, log_debug, get_ids, parse_ids, is_local, Zfs_Listing, format_duration
+from pzm_replicate import Snapshot, find_common_snapshot, is_backup_snapshot
+from pzm_retention import dataset_vmid, maxCommandLength
+from pzm_remote import run_script
+from pzm_preflight import format_size
+
+
+#hostname, zfspool and backupname of a --target "hostname:zfspool:backupname"
+def parse_target(target):
+    fields = target.split(':')
+    if len(fields) != 3 or "" in fields:
+        print ("Invalid target " + target + ", use hostname:zfspool:backupname")
+        sys.exit(2)
+    return fields[0], fields[1], fields[2]
+
+#Local VM/CT ids selected by --ids, "all" with excluding -ids or a list of ids. Pulled IDs (host:id) are not audited
+def select_local_ids(ids):
+    including, excluding = parse_ids(ids)
+    selected = get_ids("qm", including, excluding) + get_ids("pct", including, excluding)
+    return [id for id in selected if not ':' in id]
+
+#Snapshot chains (oldest first) and creation times of all datasets below roots on hostname (all pools if there are none), from one
+#streamed listing. Only datasets for which keep(dataset) is true are kept. Returns dataset -> Snapshots, dataset -> snapshot name -> creation
+#, the datasets which exist (also those without snapshots) and whether the listing succeeded
+def list_chains(hostname, roots, keep):
+    chains = {}
+    creations = {}
+    datasets = set()
+    listing = Zfs_Listing(hostname, roots, types="filesystem,volume,snapshot", properties=["name", "guid", "createtxg", "creation"], sort="createtxg")
+    for name, guid, createtxg, creation in listing:
+        dataset, unused, snapname = name.partition('@')
+        if not keep(dataset):
+            continue
+        if snapname == "":
+            datasets.add(dataset)
+            continue
+        chains.setdefault(dataset, []).append(Snapshot(snapname, guid, int(createtxg)))
+        creations.setdefault(dataset, {})[snapname] = int(creation)
+    if listing.returncode != 0:
+        log ("Could not list the datasets of " + (hostname if hostname is not None else "this host") + ": " + listing.stderr.strip())
+    return chains, creations, datasets, listing.returncode == 0
+
+#Remote copies below zfspool by disk name, like sanitize finds them: <zfspool>/<disk> or, with prepend-storage-id, <zfspool>/<pve-storage-id>/<disk>
+def remote_copies(zfspool, datasets):
+    copies = {}
+    for dataset in sorted(datasets, key=lambda dataset: dataset.count('/')):
+        relative = dataset[len(zfspool) + 1:].split('/')
+        if dataset.startswith(zfspool + '/') and len(relative) <= 2 and not relative[-1] in copies:
+            copies[relative[-1]] = dataset
+    return copies
+
+#Replication state of one local disk on one target, compared by guid like sanitize does. Issues are what sanitize would fix (a rename or a
+#rollback) or what only a full send fixes. The lag is the age of the newest replicated snapshot, behind the backup snapshots not replicated yet
+def audit_disk(dataset, local_chain, creations, backupname, remote_dataset, remote_chain, now):
+    backups = [snapshot for snapshot in local_chain if is_backup_snapshot(snapshot.name, backupname)]
+    result = {"disk": dataset, "remote": remote_dataset, "newest": backups[-1].name if len(backups) > 0 else None,
+              "replicated": None, "behind": len(backups), "lag": None, "unreplicated": None, "issues": []}
+    if remote_dataset is None:
+        result["issues"].append("not on the target")
+        return result, None
+    local_common, remote_common = find_common_snapshot(local_chain, remote_chain)
+    if local_common is None:
+        result["issues"].append("no common snapshot, only a full send is possible")
+        return result, None
+    result["replicated"] = local_common.name
+    result["behind"] = len([snapshot for snapshot in backups if snapshot.createtxg > local_common.createtxg])
+    result["lag"] = max(now - creations[local_common.name], 0)
+    if local_common.name != remote_common.name:
+        result["issues"].append("replicated snapshot is named " + remote_common.name + " on the target")
+    remote_newer = [snapshot for snapshot in remote_chain if snapshot.createtxg > remote_common.createtxg]
+    if len(remote_newer) > 0:
+        result["issues"].append(str(len(remote_newer)) + " newer snapshot(s) only on the target, rollback to " + remote_common.name + " needed")
+    local_guids = dict([(snapshot.name, snapshot.guid) for snapshot in local_chain])
+    conflicts = [snapshot.name for snapshot in remote_chain if snapshot.name in local_guids and local_guids[snapshot.name] != snapshot.guid]
+    if len(conflicts) > 0:
+        result["issues"].append(str(len(conflicts)) + " snapshot(s) with the same name but another guid on the target")
+    return result, local_common.name
+
+#Bytes of every dataset which are not replicated: written since its replicated snapshot (written@snapshot), or everything it references if
+#it has none. One local script for all datasets (several if it gets too long). Takes (dataset, snapname or None), returns them -> bytes
+def unreplicated_bytes(bases):
+    scripts = []
+    for dataset, snapname in sorted(set(bases), key=lambda base: (base[0], base[1] or "")):
+        property = 'written@' + snapname if snapname is not None else 'referenced'
+        command = 'zfs get -H -p -o name,property,value ' + shlex.quote(property) + ' ' + shlex.quote(dataset) + ' 2>/dev/null; '
+        if len(scripts) > 0 and len(scripts[-1]) + len(command) < maxCommandLength:
+            scripts[-1] = scripts[-1] + command
+        else:
+            scripts.append(command)
+    sizes = {}
+    for script in scripts:
+        rc, stdout, stderr = run_script(None, script)
+        for line in stdout.split('\n'):
+            fields = line.split('\t')
+            if len(fields) != 3 or not fields[2].isdigit():
+                continue
+            snapname = fields[1].split('@', 1)[1] if fields[1].startswith('written@') else None
+            sizes[(fields[0], snapname)] = int(fields[2])
+    return sizes
+
+#Entry point of the "audit" command. Takes one listing of this host and one of every target (all at the same time), and reports for every
+#disk of the selected guests how far its replica on each target is behind and what sanitize would need to fix. Nothing is changed
+def audit(args):
+    starttime = datetime.datetime.now()
+    targets = [parse_target(target) for target in args.target]
+    ids = set(select_local_ids(args.ids))
+    log_debug ("Auditing " + str(len(ids)) + " IDs on " + str(len(targets)) + " targets")
+
+    listings = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(targets) + 1) as executor:
+        listings[None] = executor.submit(list_chains, None, [], lambda dataset: dataset_vmid(dataset) in ids)
+        for hostname, zfspool, backupname in targets:
+            if not (hostname, zfspool) in listings:
+                listings[(hostname, zfspool)] = executor.submit(list_chains, hostname, [zfspool], lambda dataset: dataset_vmid(dataset) is not None)
+    local_chains, local_creations, local_datasets, listed = listings[None].result()
+    if not listed:
+        sys.exit(1)
+    #Replicas received on this host (e.g. a target below a local pool) are no local disks
+    for hostname, zfspool, backupname in targets:
+        if is_local(hostname):
+            local_datasets = set([dataset for dataset in local_datasets if not dataset.startswith(zfspool + '/')])
+
+    now = int(time.time())
+    rows = []
+    bases = []
+    for hostname, zfspool, backupname in targets:
+        remote_chains, unused, remote_datasets, listed = listings[(hostname, zfspool)].result()
+        copies = remote_copies(zfspool, remote_datasets)
+        target = backupname + "@" + hostname + ":" + zfspool
+        for dataset in sorted(local_datasets):
+            if not listed:
+                rows.append({"disk": dataset, "remote": None, "newest": None, "replicated": None, "behind": None, "lag": None, "unreplicated": None,
+                             "issues": ["target could not be listed"], "id": dataset_vmid(dataset), "target": target})
+                continue
+            remote_dataset = copies.get(dataset.split('/')[-1])
+            result, base = audit_disk(dataset, local_chains.get(dataset, []), local_creations.get(dataset, {}), backupname,
+                                      remote_dataset, remote_chains.get(remote_dataset, []), now)
+            result["id"] = dataset_vmid(dataset)
+            result["target"] = target
+            if args.max_lag is not None and result["lag"] is not None and result["lag"] > args.max_lag * 60:
+                result["issues"].append("lag over " + str(args.max_lag) + " minutes")
+            if remote_dataset is not None:
+                bases.append((dataset, base))
+            rows.append(result)
+
+    sizes = unreplicated_bytes(bases)
+    for result in rows:
+        if result["remote"] is not None:
+            result["unreplicated"] = sizes.get((result["disk"], result["replicated"]))
+
+    #Worst first: never replicated, then by lag, then by the amount not replicated
+    rows.sort(key=lambda result: (result["lag"] is not None, -(result["lag"] or 0), -(result["unreplicated"] or 0), result["target"], result["disk"]))
+    problems = [result for result in rows if len(result["issues"]) > 0]
+    if args.json:
+        print (json.dumps({"time": now, "targets": sorted(set([result["target"] for result in rows])), "disks": rows}, indent=4))
+    else:
+        format_row = "{:<30} {:<10} {:<24} {:<30} {:<8} {:<18} {:<14} {}"
+        print (format_row.format("Target", "VM/CT-ID", "Disk", "Replicated", "Behind", "Lag", "Unreplicated", "Issues"))
+        for result in rows:
+            print (format_row.format(result["target"], result["id"], result["disk"].split('/')[-1], result["replicated"] or "-",
+                                     result["behind"] if result["behind"] is not None else "-",
+                                     format_duration(result["lag"]) if result["lag"] is not None else "never",
+                                     format_size(result["unreplicated"]) if result["unreplicated"] is not None else "-", "; ".join(result["issues"])))
+        print ("")
+        log ("Audited " + str(len(rows)) + " disks of " + str(len(set([result["id"] for result in rows]))) + " IDs on " + str(len(targets)) + " targets, "
+             + str(len(problems)) + " with issues. Took " + str(datetime.datetime.now() - starttime))
+    if len(problems) > 0:
+        sys.exit(1)
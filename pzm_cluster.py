@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+import concurrent.futures
+import datetime
+import json
+import os
+import shlex
+
+import pzm_common
+from pzm_common import execute_command, execute_readonly_command, log, log_debug, is_local, ssh_command, read_file, select_ids
+from pzm_locking import lock, unlock, lock_value, coordinatorVariable
+
+#Cluster membership and guest placement, maintained by pmxcfs
+membersFile = "/etc/pve/.members"
+vmlistFile = "/etc/pve/.vmlist"
+#Merged status of all nodes of the last cluster run, shown with "status --cluster"
+clusterStatusJsonFile = "/var/lib/pve-zsync/manager_cluster_state"
+
+
+#Read a JSON file of pmxcfs
+def read_pmxcfs(path):
+    with open(path, 'r') as pmxcfsFile:
+        return json.load(pmxcfsFile)
+
+#Nodes of the cluster. Returns node name -> {"online": bool, "address": ip (or the name if pmxcfs has no ip)}
+def get_nodes():
+    members = read_pmxcfs(membersFile)
+    nodes = {}
+    if "nodelist" in members:
+        for name, node in members["nodelist"].items():
+            nodes[name] = {"online": node.get("online", 0) == 1, "address": node.get("ip", name)}
+    else: #No cluster, only this node
+        nodes[members.get("nodename", "localhost")] = {"online": True, "address": members.get("nodename", "localhost")}
+    return nodes
+
+#Current node of every guest. Returns vmid -> node name
+def get_placement():
+    return dict([(vmid, guest["node"]) for vmid, guest in read_pmxcfs(vmlistFile).get("ids", {}).items()])
+
+#Assign the ids to the nodes which currently host them. Returns node -> ids
+def assign(ids, placement):
+    assignment = {}
+    for id in ids:
+        assignment.setdefault(placement[id], []).append(id)
+    return assignment
+
+#Run "pve-zsync-manager sync" for the given ids on one node. The coordinator holds the lock of the destination and passes its lock value
+#in the environment, so the node doesn't lock. The sync is no transfer, it runs as long as it needs. Returns returncode and output
+def run_node(args, node_args, node, address, ids, lane_limit):
+    command = [args.manager_path, 'sync', '--hostname', args.hostname, '--zfspool', args.zfspool, '--backupname', args.backupname,
+               '--ids', ','.join(ids), '--lane-limit', str(lane_limit)] + node_args
+    if pzm_common.debug:
+        command.append('--verbose')
+    if pzm_common.test:
+        command.append('--test')
+    command = ['env', coordinatorVariable + '=' + lock_value()] + command
+    if not is_local(address) and not is_local(node):
+        command = ssh_command(address, [shlex.quote(element) for element in command]) #ssh passes the command through the remote shell
+    log ("Node " + node + ": syncing " + str(len(ids)) + " IDs")
+    if pzm_common.test: #The nodes only test too, so they can run
+        rc, stdout, stderr = execute_readonly_command(command)
+    else:
+        rc, stdout, stderr, pid = execute_command(command)
+    for line in (stdout + stderr).split('\n'):
+        if line not in pzm_common.considered_empty:
+            log_debug ("[" + node + "] " + line)
+    log ("Node " + node + ": finished " + ("successfully" if rc == 0 else "with returncode " + str(rc)))
+    return rc, stdout + stderr
+
+#Status entries of the given backupname on a node, by id
+def read_node_status(node, address, backupname):
+    rc, content, stderr = read_file(None if is_local(node) else address, pzm_common.statusJsonFile)
+    if rc != 0:
+        log ("Could not read the status of node " + node + ": " + stderr)
+        return {}
+    try:
+        data = json.loads(content)
+    except ValueError:
+        return {}
+    return dict([(entry['id'], entry) for entry in data.values() if entry.get('backupname') == backupname])
+
+#Write the merged status of all nodes. Ids are prefixed with their node (node/id)
+def write_cluster_status(backupname, statuses, starttime, endtime, failed):
+    data = {}
+    if os.path.exists(clusterStatusJsonFile):
+        with open(clusterStatusJsonFile, 'r') as jsonFile:
+            try:
+                data = json.load(jsonFile)
+            except ValueError:
+                data = {}
+    data = dict([(key, entry) for key, entry in data.items() if entry.get('backupname') != backupname])
+    for node, entries in statuses.items():
+        for id, entry in entries.items():
+            entry = dict(entry)
+            entry['id'] = node + "/" + id
+            data[entry['id'] + "_" + backupname] = entry
+    timeformat = "%d-%m-%Y_%H:%M:%S"
+    data["all_" + backupname] = {
+        'id': "all",
+        'backupname': backupname,
+        'starttime': starttime.strftime(timeformat),
+        'endtime': endtime.strftime(timeformat),
+        'duration': str(endtime - starttime),
+        'size': "-",
+        'status': "error" if failed else "ok",
+        'info': str(len(statuses)) + " nodes"
+    }
+    with open(clusterStatusJsonFile, 'w') as jsonFile:
+        json.dump(data, jsonFile, indent=4)
+
+#Entry point of the "cluster" command: sync the guests of the whole cluster on the nodes which host them, with one lock of the destination.
+#At most budget syncs run at the same time on all nodes together. Guests which migrated while their node was syncing are synced
+#on their new node afterwards. node_args are passed to the sync of every node
+def coordinate(args, node_args):
+    starttime = datetime.datetime.now()
+    nodes = get_nodes()
+    placement = get_placement()
+    ids = select_ids(args.ids, placement.keys()) #Against all guests of the cluster
+    assignment = assign(ids, placement)
+    failed = False
+    for node in list(assignment.keys()):
+        if not node in nodes or not nodes[node]["online"]:
+            log ("Node " + node + " is offline, not syncing " + ",".join(assignment.pop(node)))
+            failed = True
+    if len(assignment) == 0:
+        log ("Nothing to sync")
+        return
+
+    parallel_nodes = max(min(args.budget, len(assignment)), 1)
+    lane_limit = max(args.budget // parallel_nodes, 1)
+    log ("Cluster sync of " + str(len(ids)) + " IDs on " + str(len(assignment)) + " nodes, " + str(parallel_nodes) + " nodes with " + str(lane_limit) + " IDs each at the same time")
+
+    lock(args.hostname)
+    try:
+        done = {} #node -> ids synced there
+        for attempt in range(2): #The second round syncs guests which migrated during the first one
+            def run(node):
+                return node, run_node(args, node_args, node, nodes[node]["address"], assignment[node], lane_limit)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=parallel_nodes) as executor:
+                for node, (rc, output) in executor.map(run, list(assignment.keys())):
+                    if rc != 0:
+                        failed = True
+                    done.setdefault(node, []).extend(assignment[node])
+            if attempt == 1:
+                break
+            moved = get_placement()
+            migrated = [id for node, node_ids in assignment.items() for id in node_ids if moved.get(id) is not None and moved[id] != node]
+            if len(migrated) == 0:
+                break
+            log ("IDs " + ",".join(migrated) + " migrated during the sync, syncing them on their new nodes")
+            assignment = dict([(node, node_ids) for node, node_ids in assign(migrated, moved).items() if node in nodes and nodes[node]["online"]])
+    finally:
+        unlock(args.hostname)
+
+    statuses = {}
+    for node in done.keys():
+        statuses[node] = read_node_status(node, nodes[node]["address"], args.backupname)
+        if len([entry for entry in statuses[node].values() if entry['status'] == "error"]) > 0:
+            failed = True
+    endtime = datetime.datetime.now()
+    if not pzm_common.test:
+        write_cluster_status(args.backupname, statuses, starttime, endtime, failed)
+    log ("Cluster sync finished " + ("with errors" if failed else "successfully") + ". Took " + str(endtime - starttime))
@@ -1,18 +1,44 @@
 #!/usr/bin/env -S python3 -u
 
-import subprocess
 import datetime
+import io
+import socket
+import os
+import subprocess
 import sys
+import tempfile
+import threading
+
+
+#Log the transfers of a thread are streamed to (pzm_logs.Capped_Output), set for every VM/CT by the sync. Threads of different lanes have their own
+output_logs = threading.local()
+
+#pzm_runner (asyncio) is only imported when the first command is run, status and simulate don't need it
+def runner():
+    import pzm_runner
+    return pzm_runner
 
 def initialize():
     global debug
     global test
     global statusJsonFile
     global considered_empty
+    global sshControlPath
+    global use_agent
+    global command_timeout
+    global stall_timeout
+    global throttle
+    global tune_interval
     debug = False
     test = False
     statusJsonFile = "/var/lib/pve-zsync/manager_sync_state"
     considered_empty = ['\n', '', " "]
+    sshControlPath = "/run/pve-zsync-manager-ssh-%C" #%C is a hash of local host, remote host, port and user
+    use_agent = False #Do remote work with pzm_agent (batched, over one ssh session), set by --agent
+    command_timeout = None #Seconds after which a single (non transfer) command is killed, set by --timeout
+    stall_timeout = None #Seconds without progress after which a transfer is killed, set by --stall-timeout
+    throttle = None #pzm_throttle.Throttle which limits the transfers, set by --io-limit, --io-weight and --cpu-limit
+    tune_interval = None #Days after which the ssh cipher and compression of transfers are measured again, set by --tune-transfers
 
 #Log to stdout
 def log(data):
@@ -24,27 +50,148 @@ def log_debug(data):
     if debug:
         log("DEBUG - " + str(data))
 
+#Human readable duration of seconds
+def format_duration(seconds):
+    return str(datetime.timedelta(seconds=int(seconds)))
+
 #Execute command will not alter anything. These commands can be executed as normal in "TEST" mode
 def execute_readonly_command(command):
+    global command_timeout
     log_debug ("Executing command: " + " ".join(command))
-    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = process.communicate()
-    return process.returncode, stdout.decode("utf-8"), stderr.decode("utf-8")
-    return 0, "", ""
+    rc, stdout, stderr, pid = runner().run_commands([command], timeout=command_timeout)
+    return rc, stdout, stderr
+
+#Execute many readonly commands concurrently from one thread, at most limit at the same time. Returns (rc, stdout, stderr) in the order of the commands
+def execute_readonly_commands(commands, limit=8):
+    global command_timeout
+    for command in commands:
+        log_debug ("Executing command: " + " ".join(command))
+    return [(rc, stdout, stderr) for rc, stdout, stderr, pid in runner().run_concurrently(commands, limit, command_timeout)]
 
 #Execute command which will definetly alter something. Will not be executed in "TEST" mode
-def execute_command(command, shell=False):
+#input is written to stdin of the command, if given.
+#transfer marks long running commands (e.g. pve-zsync sync), which are watched by the stall watchdog instead of the command timeout
+def execute_command(command, shell=False, input=None, transfer=False):
     global test
+    global command_timeout
+    global stall_timeout
     if test:
         log_debug ("Would execute command: " + " ".join(command))
     else:
         log_debug ("Executing command: " + " ".join(command))
     if not test:
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=shell)
-        stdout, stderr = process.communicate()
-        return process.returncode, stdout.decode("utf-8"), stderr.decode("utf-8"), process.pid
+        if transfer:
+            return run_transfer([command], input.encode("utf-8") if input is not None else None, shell)
+        return runner().run_commands([command], input.encode("utf-8") if input is not None else None, shell, timeout=command_timeout)
     return 0, "", "", ""
 
+#Execute a pipeline of commands (e.g. zfs send | zfs recv) without a shell. Will not be executed in "TEST" mode
+#The returncode is the first non zero returncode of all commands (like "set -o pipefail"), stderr is the stderr of all commands.
+#Pipelines are transfers, they are killed by the stall watchdog if they make no progress
+def execute_pipeline(commands):
+    global test
+    global stall_timeout
+    pipeline_text = " | ".join([" ".join(command) for command in commands])
+    if test:
+        log_debug ("Would execute pipeline: " + pipeline_text)
+        return 0, "", "", ""
+    log_debug ("Executing pipeline: " + pipeline_text)
+    return run_transfer(commands)
+
+#Stream the output of the transfers of this thread to output_log instead of keeping it in memory. None stops that
+def set_output_log(output_log):
+    output_logs.current = output_log
+
+#Run a transfer with the stall watchdog. If transfers are throttled, they are run within the limits.
+#The output is streamed to the log of this thread, if there is one
+def run_transfer(commands, input=None, shell=False):
+    global stall_timeout
+    global throttle
+    output_log = getattr(output_logs, "current", None)
+    if throttle is not None:
+        commands = throttle.wrap(commands, shell)
+    return runner().run_commands(commands, input, shell, stall_timeout=stall_timeout, output_log=output_log)
+
+#Build a ssh command for the given host. All ssh sessions to the same host share one connection (ControlMaster),
+#which stays open for 60s after the last session, so subsequent commands don't have to reconnect.
+#The cipher is negotiated by the shared connection, sessions with another cipher share an own connection
+def ssh_command(hostname, command, cipher=None):
+    global sshControlPath
+    if cipher is not None:
+        return ['ssh', '-o', 'BatchMode yes', '-c', cipher, '-o', 'ControlMaster auto', '-o', 'ControlPath ' + sshControlPath + '-' + cipher, '-o', 'ControlPersist 60', 'root@' + hostname] + command
+    return ['ssh', '-o', 'BatchMode yes', '-o', 'ControlMaster auto', '-o', 'ControlPath ' + sshControlPath, '-o', 'ControlPersist 60', 'root@' + hostname] + command
+
+#Transport: checks if hostname is this host. None means this host too
+def is_local(hostname):
+    if hostname is None:
+        return True
+    hostname = hostname.lower()
+    own_hostname = socket.gethostname().lower()
+    return "localhost" in hostname or "127.0.0.1" in hostname or hostname == own_hostname or hostname.startswith(own_hostname + ".")
+
+#Transport: returns the command which executes command on hostname. Local commands are executed directly, remote ones over the pooled ssh connection
+def on_host(hostname, command):
+    if is_local(hostname):
+        return command
+    return ssh_command(hostname, command)
+
+#Transport: read a file on hostname. Local files are read in-process. Returns returncode (1 if it doesn't exist, like cat), content and stderr
+def read_file(hostname, path):
+    if is_local(hostname):
+        try:
+            with open(path, 'r') as file:
+                return 0, file.read(), ""
+        except OSError as e:
+            return 1, "", str(e)
+    return execute_readonly_command(ssh_command(hostname, ['cat', path]))
+
+#Transport: list the file names in a directory on hostname, sorted by name. Local directories are listed in-process
+def list_directory(hostname, path):
+    if is_local(hostname):
+        try:
+            return 0, sorted(os.listdir(path)), ""
+        except OSError as e:
+            return 1, [], str(e)
+    rc, stdout, stderr = execute_readonly_command(ssh_command(hostname, ['ls', '-1', path]))
+    return rc, [element for element in stdout.split('\n') if element not in considered_empty], stderr
+
+#Transport: copy a file from hostname to a local path. Local files are copied with cp, remote ones with scp over the pooled ssh connection
+def fetch_file(hostname, path, local_path):
+    global sshControlPath
+    if is_local(hostname):
+        return execute_command(['cp', path, local_path])
+    return execute_command(['scp', '-B', '-o', 'ControlMaster auto', '-o', 'ControlPath ' + sshControlPath, '-o', 'ControlPersist 60', 'root@' + hostname + ':' + path, local_path])
+
+#Including and excluding ids of --ids: "all" with excluding -ids, or a list of ids (no ids are included with "all").
+#Exits if other ids are combined with "all" or excluding ids are given without it
+def parse_ids(ids):
+    exclude_ids = []
+    include_ids = []
+    id_list = ids.split(',')
+    if "all" in id_list:
+        id_list.pop(id_list.index("all"))
+        for id in id_list:
+            if id.startswith('-'):
+                exclude_ids.append(id.replace("-", ""))
+            else:
+                print ("Do not use \"all\" in combination with other, non excluding ids!")
+                sys.exit(2)
+    else:
+        for id in id_list:
+            if id.startswith('-'):
+                print ("Do not use excluding IDs without \"all\"!")
+                sys.exit(2)
+            else:
+                include_ids.append(id)
+    return include_ids, exclude_ids
+
+#Select the ids of --ids from the existing ids (e.g. of the cluster or of a backup host), like get_ids does with qm/pct list
+def select_ids(ids, existing):
+    including, excluding = parse_ids(ids)
+    if including:
+        return [id for id in including if id in existing]
+    return sorted([id for id in existing if not id in excluding])
+
 #Get VM or CT ids from command. command will be either lxc or pct, including ids are numbers, excluding ids are numbers which were given with a heading minus
 def get_ids(command, including, excluding):
     rc, stdout, stderr = execute_readonly_command([command, 'list'])
@@ -79,16 +226,83 @@ def get_ids(command, including, excluding):
         backup_ids = existing_vmct_ids
     return backup_ids
 
-#Check if ZFS pool exists on the remote side
+#Check if ZFS pool (or any dataset) exists on the remote side. Only this dataset is queried, not the whole host
 def check_zfs_pool(hostname,zfspool):
-    rc, stdout, stderr = execute_readonly_command(['ssh', '-o', 'BatchMode yes', 'root@' + hostname, 'zfs' ,'list', '-rH', '-o', 'name'])
-    if stderr != "":
-        log ("(SSH) Error while getting zfs list names " + stderr)
-        sys.exit(1)
+    rc, stdout, stderr = execute_readonly_command(on_host(hostname, ['zfs' ,'list', '-H', '-o', 'name', zfspool]))
+    if rc == 0 and stdout.strip() == zfspool:
+        return True
+    if "does not exist" in stderr:
+        log ("ZFS Pool " + zfspool + " does not exist on " + str(hostname))
     else:
-        if zfspool not in stdout:
-            log ("ZFS Pool " + zfspool + " does not exist on " + hostname)
-            sys.exit(1)
+        log ("(SSH) Error while getting zfs list names " + stderr)
+    sys.exit(1)
+
+
+#Streams "zfs list -H -p" on hostname and yields one record at a time, as list of the requested property values.
+#Lines are parsed while zfs is still listing, so listings of hosts with many datasets and snapshots are never held in memory as a whole.
+#roots scopes the listing to these datasets and their children, depth levels deep (all levels if None).
+#returncode and stderr of zfs list are set after the iteration. The listing is killed after --timeout seconds or if the iteration stops early
+class Zfs_Listing:
+    def __init__(self, hostname, roots=[], types="filesystem,volume", properties=["name"], depth=None, sort=None):
+        self.hostname = hostname
+        self.roots = roots
+        self.types = types
+        self.properties = properties
+        self.depth = depth
+        self.sort = sort
+        self.returncode = None
+        self.stderr = ""
+
+    def command(self):
+        command = ['zfs', 'list', '-H', '-p', '-t', self.types, '-o', ','.join(self.properties)]
+        if self.depth is None:
+            command.append('-r')
         else:
-            return stdout
+            command.extend(['-d', str(self.depth)])
+        if self.sort is not None:
+            command.extend(['-s', self.sort])
+        return on_host(self.hostname, command + self.roots)
+
+    def __iter__(self):
+        global command_timeout
+        command = self.command()
+        log_debug ("Streaming command: " + " ".join(command))
+        stderr_file = tempfile.TemporaryFile()
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr_file, start_new_session=True)
+        timer = None
+        timed_out = []
+        if command_timeout is not None:
+            def kill_listing():
+                timed_out.append(True)
+                runner().kill_groups([process.pid])
+            timer = threading.Timer(command_timeout, kill_listing)
+            timer.start()
+        try:
+            for line in io.TextIOWrapper(process.stdout, encoding="utf-8", errors="replace"):
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) == len(self.properties):
+                    yield fields
+        finally:
+            if process.poll() is None:
+                runner().kill_groups([process.pid])
+            process.stdout.close()
+            self.returncode = process.wait()
+            if timer is not None:
+                timer.cancel()
+            stderr_file.seek(0)
+            self.stderr = stderr_file.read().decode("utf-8", "replace")
+            stderr_file.close()
+            if len(timed_out) > 0:
+                self.stderr = self.stderr + "Killed after a timeout of " + str(command_timeout) + "s\n"
 
+#Index of the snapshots below root on hostname, from one streamed listing: dataset -> snapshot names (the part after @), oldest first.
+#If datasets is given, only these datasets are kept in the index. Returns returncode, index and stderr
+def build_snapshot_index(hostname, root, datasets=None):
+    listing = Zfs_Listing(hostname, [root], types="snapshot", sort="createtxg")
+    index = {}
+    for name, in listing:
+        dataset, unused, snapname = name.partition('@')
+        if datasets is not None and not dataset in datasets:
+            continue
+        index.setdefault(dataset, []).append(snapname)
+    return listing.returncode, index, listing.stderr
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+import hashlib
+import re
+import shlex
+
+from pzm_common import execute_command, log, log_debug, ssh_command, is_local
+from pzm_remote import run_script
+
+#Content-addressed store of the guest configs below a config path: every distinct config once in <storeDir>/blobs/<sha256>, and per VM/CT
+#an index <storeDir>/index/<vmid> with one line "<snapname> <type> <sha256>" per snapshot. Configs keep their pve-zsync name
+#(<vmid>.conf.<type>.<snapname>) everywhere else, the store only changes where the content is
+storeDir = ".store"
+#Names of flat config files as pve-zsync writes them
+flatConfigName = re.compile(r'^(\d+)\.conf\.(qemu|lxc)\.(.+)$')
+
+#Loaded indexes by (hostname, config path): config name -> sha256
+indexes = {}
+
+
+#pve-zsync name of a config
+def config_name(vmid, type, snapname):
+    return vmid + '.conf.' + type + '.' + snapname
+
+#vmid, type and snapname of a config name, None if it is no config
+def parse_config_name(name):
+    match = flatConfigName.match(name)
+    if match is None:
+        return None
+    return match.group(1), match.group(2), match.group(3)
+
+#Config names by (vmid, snapname), so the config of a snapshot is found without scanning all names
+def config_lookup(names):
+    lookup = {}
+    for name in names:
+        parsed = parse_config_name(name)
+        if parsed is not None:
+            lookup[(parsed[0], parsed[2])] = name
+    return lookup
+
+def store_path(config_path):
+    return config_path.rstrip('/') + '/' + storeDir
+
+#Shell script printing all index lines of the store, prefixed with their vmid ("<vmid>:<snapname> <type> <sha256>"). Prints nothing without a store
+def index_script(config_path):
+    return "cd " + shlex.quote(store_path(config_path) + '/index') + " 2>/dev/null && grep -H '' -- * 2>/dev/null; true"
+
+#Parse the output of index_script. Returns config name -> sha256
+def parse_index(lines):
+    index = {}
+    for line in lines:
+        vmid, unused, entry = line.partition(':')
+        fields = entry.split(' ')
+        if len(fields) == 3:
+            index[config_name(vmid, fields[1], fields[0])] = fields[2]
+    return index
+
+#Read all indexes of the store with one round-trip. Returns config name -> sha256, empty if there is no store
+def read_index(hostname, config_path):
+    rc, stdout, stderr = run_script(hostname, index_script(config_path))
+    if rc != 0:
+        log ("Could not read the config store of " + hostname + ":" + config_path + ": " + stderr)
+        return {}
+    index = parse_index(stdout.split('\n'))
+    indexes[(hostname, config_path)] = index
+    return index
+
+#Path of a config: its blob if it is in the store, otherwise the flat file. The index is read once per host and config path
+def resolve(hostname, config_path, name):
+    key = (hostname, config_path)
+    if not key in indexes:
+        read_index(hostname, config_path)
+    if name in indexes[key]:
+        return store_path(config_path) + '/blobs/' + indexes[key][name]
+    return config_path.rstrip('/') + '/' + name
+
+#Run a script which changes the store, it is passed on stdin so its length doesn't matter
+def run_store_script(hostname, script):
+    command = ['sh'] if is_local(hostname) else ssh_command(hostname, ['sh'])
+    return execute_command(command, input=script)
+
+#Store the config of a snapshot: the blob is only written if no snapshot had the same config before, the index gets one line
+def store_config(hostname, config_path, vmid, type, snapname, config):
+    sha256 = hashlib.sha256(config.encode("utf-8")).hexdigest()
+    store = shlex.quote(store_path(config_path))
+    script = ("mkdir -p " + store + "/blobs " + store + "/index && cd " + store + " && "
+              "if [ -e blobs/" + sha256 + " ]; then cat > /dev/null; else cat > blobs/" + sha256 + ".tmp && mv blobs/" + sha256 + ".tmp blobs/" + sha256 + "; fi && "
+              "echo " + shlex.quote(snapname + ' ' + type + ' ' + sha256) + " >> index/" + vmid)
+    command = ['sh', '-c', script] if is_local(hostname) else ssh_command(hostname, ['sh', '-c', shlex.quote(script)])
+    rc, stdout, stderr, pid = execute_command(command, input=config)
+    if rc == 0 and (hostname, config_path) in indexes:
+        indexes[(hostname, config_path)][config_name(vmid, type, snapname)] = sha256
+    return rc, stderr
+
+#Shell commands which delete blobs no index refers to anymore
+def collect_garbage_script():
+    return ("cat index/* 2>/dev/null | cut -d' ' -f3 | sort -u > .referenced\n"
+            "ls blobs | grep -v '\\.tmp$' | sort | comm -23 - .referenced | (cd blobs && xargs -r rm -f)\n"
+            "rm -f .referenced\n")
+
+#Remove the entries of the given config names from the indexes (one rewrite per VM/CT) and, with collect, delete the blobs which are no
+#longer used. Syncs only remove entries, the collection scans the whole store and must not run while other lanes store configs.
+#Returns the number of removed entries
+def remove_entries(hostname, config_path, names, collect=True):
+    index = indexes.get((hostname, config_path))
+    if index is None:
+        index = read_index(hostname, config_path)
+    lines_by_vmid = {}
+    for name in names:
+        parsed = parse_config_name(name)
+        if parsed is None or not name in index:
+            continue
+        vmid, type, snapname = parsed
+        lines_by_vmid.setdefault(vmid, []).append(snapname + ' ' + type + ' ' + index[name])
+    if len(lines_by_vmid) == 0:
+        return 0
+    script = "cd " + shlex.quote(store_path(config_path)) + " || exit 1\n"
+    for vmid, lines in lines_by_vmid.items():
+        script = script + ("grep -v -x -F " + ' '.join(['-e ' + shlex.quote(line) for line in lines]) + " index/" + vmid + " > index/" + vmid + ".tmp; "
+                           "if [ -s index/" + vmid + ".tmp ]; then mv index/" + vmid + ".tmp index/" + vmid + "; else rm -f index/" + vmid + ".tmp index/" + vmid + "; fi\n")
+    rc, stdout, stderr, pid = run_store_script(hostname, script + (collect_garbage_script() if collect else ""))
+    if rc != 0:
+        log ("Could not prune the config store of " + hostname + ":" + config_path + ": " + stderr)
+        return 0
+    for name in names:
+        index.pop(name, None)
+    removed = sum([len(lines) for lines in lines_by_vmid.values()])
+    log_debug ("Config store: removed " + str(removed) + " entries of " + str(len(lines_by_vmid)) + " VM/CTs")
+    return removed
+
+#Delete the blobs no index refers to anymore, once per run after all transfers. Returns False if that failed
+def collect_garbage(hostname, config_path):
+    rc, stdout, stderr, pid = run_store_script(hostname, "cd " + shlex.quote(store_path(config_path)) + " || exit 0\n" + collect_garbage_script())
+    if rc != 0:
+        log ("Could not collect the unused blobs of " + hostname + ":" + config_path + ": " + stderr)
+    return rc == 0
+
+#Move the flat config files (e.g. written by pve-zsync) into the store, with one command. Files whose content is stored already are deleted.
+#Returns the number of imported files
+def import_flat_configs(hostname, config_path):
+    script = ("cd " + shlex.quote(config_path) + " || exit 1\n"
+              "mkdir -p " + storeDir + "/blobs " + storeDir + "/index || exit 1\n"
+              "imported=0\n"
+              "for file in *.conf.*; do\n"
+              "  case \"$file\" in [0-9]*.conf.qemu.*|[0-9]*.conf.lxc.*) ;; *) continue;; esac\n"
+              "  [ -f \"$file\" ] || continue\n"
+              "  vmid=${file%%.conf.*}; rest=${file#*.conf.}; type=${rest%%.*}; snapname=${rest#*.}\n"
+              "  sha256=$(sha256sum < \"$file\" | cut -d' ' -f1) || continue\n"
+              "  if [ -e " + storeDir + "/blobs/$sha256 ]; then rm -f \"$file\"; else mv \"$file\" " + storeDir + "/blobs/$sha256; fi\n"
+              "  echo \"$snapname $type $sha256\" >> " + storeDir + "/index/$vmid\n"
+              "  imported=$((imported+1))\n"
+              "done\n"
+              "echo $imported\n")
+    rc, stdout, stderr, pid = run_store_script(hostname, script)
+    if rc != 0:
+        log ("Could not import the config files of " + hostname + ":" + config_path + " into the store: " + stderr)
+        return 0
+    indexes.pop((hostname, config_path), None) #Read again on the next lookup
+    return int(stdout.strip()) if stdout.strip().isdigit() else 0
@@ -1,18 +1,25 @@
 #!/usr/bin/env -S python3 -u
 
 import pzm_common
-from pzm_common import log, log_debug, execute_command, execute_readonly_command
+from pzm_common import log, log_debug, execute_command, execute_readonly_command, ssh_command, is_local, read_file
+from pzm_remote import get_agent
 import os
 import socket
 import random
 import time
 
 remoteSyncLock = "/var/lib/pve-zsync/manager_sync.lock"
+unlockRetries = 10 #Give up removing the remote lock after this many tries (30s apart)
+coordinatorVariable = "PZM_COORDINATOR" #Set by the cluster coordinator for the syncs of the nodes, holds its lock value
 locked = False
 remote_locked_here = False
 local_locked_here = False
 
 
+#Lock value of this process, written to the lockfile
+def lock_value():
+    return socket.gethostname().lower() + "-" + str(os.getpid())
+
 #Check if the local lock (=file "remoteSyncLock") is lockable
 #the file on remote and local is the same, in order to be able to do local and remote sync one by one.
 def can_get_local_lock():
@@ -28,8 +35,20 @@ def can_get_local_lock():
 #Check if the remote lock (=file "remoteSyncLock") is lockable
 #the file on remote and local is the same, in order to be able to do local and remote sync one by one.
 def can_get_remote_lock(hostname):
-    lockvalue = socket.gethostname().lower() + "-" + str(os.getpid())
-    rc, stdout, stderr = execute_readonly_command(['ssh', '-o', 'BatchMode yes', 'root@' + hostname, 'cat', remoteSyncLock])
+    lockvalue = lock_value()
+    results = None
+    agent = get_agent(hostname)
+    if agent is not None:
+        results = agent.request([{"op": "read_file", "path": remoteSyncLock}])
+    if results is not None: #Same returncodes as cat
+        if not results[0]["ok"]:
+            rc, stdout, stderr = 2, "", results[0]["error"]
+        elif results[0]["result"] is None:
+            rc, stdout, stderr = 1, "", ""
+        else:
+            rc, stdout, stderr = 0, results[0]["result"], ""
+    else:
+        rc, stdout, stderr = execute_readonly_command(ssh_command(hostname, ['cat', remoteSyncLock]))
     if rc == 1: #rc 1 means, file not found - which means no lock is held on remote side
         log_debug ("Remote lockfile does not exist, can proceed...")
         return True
@@ -54,7 +73,7 @@ def can_get_remote_lock(hostname):
 def lock_local():
     global local_locked_here
     log_debug ("Locking locally")
-    lockvalue = socket.gethostname().lower() + "-" + str(os.getpid())
+    lockvalue = lock_value()
     if not os.path.exists(remoteSyncLock): #In case it was locked by "remote lock" if it's a local sync, do nothing
         with open(remoteSyncLock, 'w') as lockfile:
             log_debug("Writing local lockfile")
@@ -79,10 +98,21 @@ def lock_remote(hostname):
     global remote_locked_here
     log_debug("Locking remotly")
     log_debug("Trying to write remote lockfile")
-    lockvalue = socket.gethostname().lower() + "-" + str(os.getpid())
-
-    rc, stdout, stderr, pid = execute_command(['ssh', '-o', 'BatchMode yes', 'root@' + hostname,
-                                               "echo -n " + lockvalue + " > " + remoteSyncLock + " && chattr +i " + remoteSyncLock])
+    lockvalue = lock_value()
+
+    results = None
+    agent = get_agent(hostname)
+    if agent is not None:
+        results = agent.request([{"op": "lock", "path": remoteSyncLock, "value": lockvalue}])
+    if results is not None: #Same returncodes as the shell command
+        if not results[0]["ok"]:
+            rc, stdout, stderr = 2, "", results[0]["error"]
+        elif results[0]["result"]["locked"]:
+            rc, stdout, stderr = 0, "", ""
+        else:
+            rc, stdout, stderr = 1, "", "Held by " + results[0]["result"]["holder"]
+    else:
+        rc, stdout, stderr, pid = execute_command(ssh_command(hostname, ["echo -n " + lockvalue + " > " + remoteSyncLock + " && chattr +i " + remoteSyncLock]))
     if rc == 1: #Operation not permitteed or File no Found in chattr
 
 
@@ -116,16 +146,32 @@ def unlock_remote(hostname):
     global locked
     global remote_locked_here
     if remote_locked_here: #Only delete if it was remote locked here
+        tries = 0
         while locked: #Make sure we safely delete the lock
             #chattr: make file muteable again
             log_debug("Removing remote lockfile")
-            rc, stdout, stderr, pid = execute_command(['ssh', '-o', 'BatchMode yes', 'root@' + hostname, 'chattr -i ' + remoteSyncLock + ' ; rm ' + remoteSyncLock])
+            results = None
+            agent = get_agent(hostname)
+            if agent is not None:
+                results = agent.request([{"op": "unlock", "path": remoteSyncLock}])
+            if results is not None: #Same returncodes as the shell command
+                if not results[0]["ok"]:
+                    rc, stdout, stderr = 2, "", results[0]["error"]
+                else:
+                    rc, stdout, stderr = 0 if results[0]["result"] else 1, "", ""
+            else:
+                rc, stdout, stderr, pid = execute_command(ssh_command(hostname, ['chattr -i ' + remoteSyncLock + ' ; rm ' + remoteSyncLock]))
             if rc == 0:
                 locked = False
             elif rc == 1:
                 log_debug ("(SSH) Odd, remote lockfile doesn't exist anymore???")
                 locked = False
             else:
+                tries += 1
+                if tries >= unlockRetries:
+                    log ("(SSH) Error while deleting the remote lock, giving up after " + str(tries) + " tries. Remove " + hostname + ":" + remoteSyncLock + " manually! " + stderr)
+                    locked = False
+                    break
                 log ("(SSH) Error while deleting the remote lock, trying again " + stderr)
                 time.sleep(30)
     else:
@@ -143,10 +189,7 @@ def unlock_local():
             execute_command(['chattr', '-i', remoteSyncLock]) #Make file mutable again
             os.remove(remoteSyncLock)
         else:
-            if socket.gethostname().lower() not in hostname.lower() and "localhost" not in hostname.lower():
-                #AKA if my hostname is not the same as the hostname where the remotefile was previously removed. = Non-local Backup
-                log_debug ("Odd, local lockfile doesn't exist anymore???")
-                #It would be normal that the lockfile doesn't exist anymore at this point, if the destination was localhost
+            log_debug ("Odd, local lockfile doesn't exist anymore???")
     else:
         log_debug("Not removing local lockfile as it wasn't created in lock_local (was previously locked)")
 
@@ -155,6 +198,7 @@ def unlock_local():
         log ("Locks released")
 
 #Check if both locks are available, then lock both. If anything goes wrong, reset and start over.
+#If hostname is this host, local and remote lock would be the same file, so only the local lock is taken
 def lock(hostname):
     global locked
     presleep = random.uniform(0,60)
@@ -162,6 +206,13 @@ def lock(hostname):
         log ("Waiting for " + str(presleep) + "s before starting...")
         time.sleep(presleep) #Random Delay to minimize possibility of simultanious locking...
     log ("Aquiring locks")
+    while not locked and is_local(hostname):
+        while not can_get_local_lock():
+            sleeptime = random.uniform(30,60)
+            log_debug ("Lock is held... sleeping " + str(sleeptime) + "s")
+            time.sleep(sleeptime)
+        if lock_local():
+            locked = True
     while not locked: #Make sure lock was established successfully on remote side. If not, check again if possible
         while not (can_get_remote_lock(hostname) and can_get_local_lock()):
             sleeptime = random.uniform(30,60)
@@ -175,6 +226,18 @@ def lock(hostname):
                 locked = True #breaks the while loop
     log ("Locks aquired")
 
+#Check if the cluster coordinator which started this sync (see coordinatorVariable) holds the lock of hostname. Then this sync must not lock
+def held_by_coordinator(hostname):
+    coordinator = os.environ.get(coordinatorVariable)
+    if coordinator is None:
+        return False
+    rc, stdout, stderr = read_file(hostname, remoteSyncLock)
+    if rc == 0 and stdout.strip().lower() == coordinator.lower():
+        log_debug ("Lock is held by the cluster coordinator " + coordinator)
+        return True
+    log ("Started by the cluster coordinator " + coordinator + ", but it doesn't hold the lock" + (" (held by " + stdout.strip() + ")" if rc == 0 else "") + ", locking...")
+    return False
+
 #Unlock remote and lock lock
 def unlock(hostname):
     global locked
@@ -182,5 +245,8 @@ def unlock(hostname):
     global local_locked_here
     if remote_locked_here or local_locked_here or locked:
         log("Releasing locks")
-    unlock_remote(hostname)
+    if is_local(hostname): #There is no remote lock for this host, see lock()
+        locked = False
+    else:
+        unlock_remote(hostname)
     unlock_local()
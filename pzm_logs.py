@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+import gzip
+import os
+import time
+
+import pzm_common
+
+#Where the logs of the transfers are stored, one gzip file per run and VM/CT (<run id>_<id>.log.gz)
+logpath = "/var/log/pve-zsync"
+#Of the output of one transfer attempt, the first and the last this many bytes are kept, everything in between is skipped
+logHeadSize = 1024 * 1024
+logTailSize = 1024 * 1024
+#Skipped lines containing the keep pattern are kept anyway, at most this many
+keptLinesMax = 1000
+#Logs are deleted after this many days, and the oldest ones if all logs together are bigger than this many bytes
+logMaxAge = 7
+logMaxTotal = 256 * 1024 * 1024
+
+
+#Output of a command, capped to its first head and last tail bytes, so memory stays bounded however much a transfer prints.
+#With a path, the output is also streamed to a gzip file: the head while it arrives, the skipped size, kept lines and the tail on close.
+#Several attempts can be written to the same file, gzip reads them as one
+class Capped_Output:
+    def __init__(self, path=None, header=None, keep=None, head=logHeadSize, tail=logTailSize):
+        self.path = path
+        self.keep = keep
+        self.head_size = head
+        self.tail_size = tail
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.skipped = 0
+        self.kept = []
+        self.partial = b"" #Incomplete line at the start of the tail, only needed to find kept lines
+        self.file = None
+        if path is not None:
+            self.file = gzip.open(path, 'ab')
+            if header is not None:
+                self.file.write((header + '\n').encode("utf-8"))
+
+    #Memory-only output with the same limits, for the result of one command which is also written to this log
+    def buffer(self):
+        return Capped_Output(keep=self.keep, head=self.head_size, tail=self.tail_size)
+
+    def write(self, data):
+        if len(self.head) < self.head_size:
+            part = data[:self.head_size - len(self.head)]
+            self.head.extend(part)
+            if self.file is not None:
+                self.file.write(part)
+            data = data[len(part):]
+        if len(data) == 0:
+            return
+        self.tail.extend(data)
+        if len(self.tail) > self.tail_size:
+            dropped = bytes(self.tail[:len(self.tail) - self.tail_size])
+            del self.tail[:len(dropped)]
+            self.skipped = self.skipped + len(dropped)
+            if self.keep is not None:
+                lines = (self.partial + dropped).split(b'\n')
+                self.partial = lines.pop()
+                self.kept.extend([line for line in lines if self.keep in line][:keptLinesMax - len(self.kept)])
+
+    #Everything which is kept after the head
+    def rest(self):
+        if self.skipped == 0:
+            return bytes(self.tail)
+        return (b"\n[... " + str(self.skipped).encode("utf-8") + b" bytes skipped ...]\n" + b"".join([line + b'\n' for line in self.kept]) + bytes(self.tail))
+
+    #The kept output as text
+    def text(self):
+        return (bytes(self.head) + self.rest()).decode("utf-8", "replace")
+
+    def close(self):
+        if self.file is not None:
+            self.file.write(self.rest())
+            self.file.close()
+            self.file = None
+
+
+#Open the log of one attempt of a VM/CT. Returns None in test mode, nothing is written then
+def open_log(filename, header, keep=None):
+    if pzm_common.test:
+        return None
+    if not os.path.exists(logpath):
+        os.makedirs(logpath)
+    return Capped_Output(os.path.join(logpath, filename), header, keep)
+
+#Delete the log of a VM/CT, e.g. if its sync succeeded at the first attempt
+def remove_log(filename):
+    try:
+        os.remove(os.path.join(logpath, filename))
+    except OSError:
+        pass
+
+#Delete logs older than logMaxAge days, and the oldest logs while all together are bigger than logMaxTotal bytes.
+#The directory is read once, scandir returns the entries with their stat
+def cleanup_logfolder():
+    if not os.path.exists(logpath):
+        return
+    logs = []
+    with os.scandir(logpath) as entries:
+        for entry in entries:
+            if entry.is_file():
+                stat = entry.stat()
+                logs.append((stat.st_mtime, stat.st_size, entry.path))
+    logs.sort()
+    total = sum([size for mtime, size, path in logs])
+    for mtime, size, path in logs:
+        if mtime >= time.time() - logMaxAge * 86400 and total <= logMaxTotal:
+            break
+        try:
+            os.remove(path)
+            total = total - size
+        except OSError:
+            pass
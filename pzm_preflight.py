@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import shlex
+import sys
+import time
+
+import pzm_common
+from pzm_common import log, log_debug, Zfs_Listing
+from pzm_replicate import Replication_Job, is_backup_snapshot
+from pzm_remote import run_script
+
+#Facts of destination hosts, by hostname and pool, reused for --facts-ttl minutes
+factsCacheFile = "/var/lib/pve-zsync/manager_host_facts"
+#Estimated send sizes are multiplied with this, as they are only estimates and the destination needs some headroom
+sizeMargin = 1.1
+#Pool features a receive needs, depending on the sync options
+requiredFeatures = {"raw": "encryption", "resumable": "extensible_dataset", "compressed": "lz4_compress"}
+
+
+#Shell script printing all facts of the destination, one section after the other, so they are gathered with one command (one round-trip)
+def facts_script(zfspool):
+    return ("echo ::space; zfs get -H -p -o property,value available,used,quota " + shlex.quote(zfspool) + "; "
+            "echo ::version; cat /sys/module/zfs/version 2>/dev/null; "
+            "echo ::features; zpool get -H -o property,value all " + shlex.quote(zfspool.split('/')[0]) + " | grep '^feature@'; "
+            "echo ::cpus; nproc; "
+            "echo ::resume; zfs get -H -r -t filesystem,volume -o name,value receive_resume_token " + shlex.quote(zfspool))
+
+#Parse the output of facts_script. Returns a dict with available, used, quota (bytes), version, features (name -> state), cpus and
+#resume_datasets (datasets below the pool with an interrupted receive)
+def parse_facts(stdout):
+    facts = {"available": None, "used": None, "quota": None, "version": "", "features": {}, "cpus": None, "resume_datasets": []}
+    section = None
+    for line in stdout.split('\n'):
+        if line in pzm_common.considered_empty:
+            continue
+        if line.startswith('::'):
+            section = line[2:]
+            continue
+        fields = line.split('\t')
+        if section == "space" and len(fields) == 2 and fields[1].isdigit():
+            facts[fields[0]] = int(fields[1])
+        elif section == "version":
+            facts["version"] = line.strip()
+        elif section == "features" and len(fields) == 2:
+            facts["features"][fields[0].split('@', 1)[1]] = fields[1]
+        elif section == "cpus" and line.strip().isdigit():
+            facts["cpus"] = int(line.strip())
+        elif section == "resume" and len(fields) == 2 and fields[1] != '-':
+            facts["resume_datasets"].append(fields[0])
+    return facts
+
+#Gather the facts of the destination with one round-trip (one command, or one agent request). Returns the facts or None if that failed
+def gather_host_facts(hostname, zfspool):
+    rc, stdout, stderr = run_script(hostname, facts_script(zfspool))
+    if rc != 0:
+        log ("Could not gather facts of " + hostname + ":" + zfspool + ": " + stderr)
+        return None
+    return parse_facts(stdout)
+
+#Facts of the destination, from the cache if they are younger than ttl seconds, otherwise gathered and cached again
+def get_host_facts(hostname, zfspool, ttl):
+    key = hostname + ":" + zfspool
+    cache = {}
+    if os.path.exists(factsCacheFile):
+        with open(factsCacheFile, 'r') as cacheFile:
+            try:
+                cache = json.load(cacheFile)
+            except ValueError:
+                cache = {}
+    if key in cache and time.time() - cache[key].get("time", 0) < ttl:
+        log_debug ("Using cached facts of " + key + " from " + time.strftime("%Y-%m-%d_%H:%M:%S", time.localtime(cache[key]["time"])))
+        return cache[key]
+    facts = gather_host_facts(hostname, zfspool)
+    if facts is None:
+        return None
+    facts["time"] = time.time()
+    if not pzm_common.test:
+        cache[key] = facts
+        with open(factsCacheFile, 'w') as cacheFile:
+            json.dump(cache, cacheFile, indent=4)
+    return facts
+
+#Estimated send size of every ID in bytes. Disks with a snapshot of this backupname are sent incremental (estimated by what was written
+#since their newest snapshot), all others are sent full (estimated by their referenced size, or used size with --replicate).
+#Returns ID -> estimated size and ID -> destination datasets. IDs without disks on ZFS are missing
+def estimate_send_sizes(job, ids):
+    guests = {}
+    datasets = {} #source host -> datasets
+    for id in ids:
+        guest, error = job.prepare_guest(id)
+        if guest is None:
+            log_debug ("ID " + id + " not estimated: " + error.strip())
+            continue
+        guests[id] = guest
+        datasets.setdefault(guest.source_host, []).extend([disk.source for disk in guest.disks])
+    sizes = {} #(source host, dataset) -> estimated bytes
+    for source_host, host_datasets in datasets.items():
+        has_backup = set()
+        for name, in Zfs_Listing(source_host, host_datasets, types="snapshot", depth=1):
+            dataset, unused, snapname = name.partition('@')
+            if is_backup_snapshot(snapname, job.backupname):
+                has_backup.add(dataset)
+        for name, used, referenced, written in Zfs_Listing(source_host, host_datasets, properties=["name", "used", "referenced", "written"], depth=0):
+            if name in has_backup:
+                sizes[(source_host, name)] = int(written) if written.isdigit() else 0
+            else:
+                full = used if job.replicate else referenced
+                sizes[(source_host, name)] = int(full) if full.isdigit() else 0
+    estimates = {}
+    destinations = {}
+    for id, guest in guests.items():
+        estimates[id] = sum([sizes.get((guest.source_host, disk.source), 0) for disk in guest.disks])
+        destinations[id] = [disk.destination for disk in guest.disks]
+    return estimates, destinations
+
+#Human readable size
+def format_size(size):
+    for unit in ["B", "K", "M", "G", "T"]:
+        if size < 1024 or unit == "T":
+            return ("%.1f" % size) + unit
+        size = size / 1024.0
+
+#Pre-flight stage of a sync, before anything is locked or sent. Gathers the facts of the destination (cached for ttl seconds),
+#fails if the destination pool lacks a feature the selected options need, and compares the free space with the estimated send size.
+#mode "fail" stops the run if not all IDs fit, "shrink" drops the IDs which don't fit (in ID order, resumable IDs first).
+#Returns the IDs to sync and the skipped IDs with the reason
+def preflight(args, ids, mode, ttl):
+    facts = get_host_facts(args.hostname, args.zfspool, ttl)
+    if facts is None:
+        log ("Pre-flight: no facts of " + args.hostname + ":" + args.zfspool + ", continuing without checks")
+        return ids, {}
+    log_debug ("Pre-flight facts: ZFS " + facts["version"] + ", " + str(facts["cpus"]) + " CPUs, " + format_size(facts["available"] or 0) + " available, "
+               + str(len(facts["resume_datasets"])) + " interrupted receives")
+
+    needed = []
+    if args.raw:
+        needed.append(requiredFeatures["raw"])
+    if args.engine == "native":
+        needed.append(requiredFeatures["resumable"])
+        if args.compressed:
+            needed.append(requiredFeatures["compressed"])
+    missing = [feature for feature in needed if facts["features"].get(feature) not in ["enabled", "active"]]
+    if len(missing) > 0:
+        log ("Pre-flight: pool of " + args.hostname + ":" + args.zfspool + " lacks the feature(s) " + ", ".join(missing) + " needed for the selected options")
+        sys.exit(1)
+
+    if facts["available"] is None:
+        return ids, {}
+    job = Replication_Job(args.hostname, args.zfspool, args.backupname, args.maxsnap, args.replicate, args.raw, args.properties, args.compressed, args.prepend_storage_id, args.dest_config_path)
+    estimates, destinations = estimate_send_sizes(job, ids)
+    total = sum(estimates.values())
+    log ("Pre-flight: estimated send size " + format_size(total) + ", " + format_size(facts["available"]) + " available on " + args.hostname + ":" + args.zfspool)
+    if total * sizeMargin <= facts["available"]:
+        return ids, {}
+    if mode == "fail":
+        log ("Pre-flight: not enough space on " + args.hostname + ":" + args.zfspool + " for all IDs")
+        sys.exit(1)
+
+    #Interrupted receives are continued first, most of their data is on the destination already
+    resumable = [id for id in ids if len(set(destinations.get(id, [])).intersection(facts["resume_datasets"])) > 0]
+    available = facts["available"]
+    kept = []
+    skipped = {}
+    for id in resumable + [id for id in ids if id not in resumable]:
+        estimate = estimates.get(id, 0) * sizeMargin
+        if estimate <= available:
+            kept.append(id)
+            available = available - estimate
+        else:
+            skipped[id] = "Skipped by pre-flight: estimated " + format_size(estimates[id]) + ", only " + format_size(available) + " left on " + args.zfspool
+            log ("Pre-flight: ID " + id + " skipped, estimated " + format_size(estimates[id]) + " does not fit")
+    return [id for id in ids if id in kept], skipped
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+import atexit
+import json
+import os
+import select
+import shlex
+import subprocess
+import tempfile
+import threading
+import time
+
+import pzm_common
+from pzm_common import execute_readonly_command, execute_command, log, log_debug, ssh_command, is_local
+
+#Started on the remote side with "python3 -c". Reads the length of the agent source, the source itself and then runs it,
+#so the same stdin (of the one ssh session) is used for the requests afterwards
+bootstrap = "import sys;n=int(sys.stdin.buffer.readline());exec(compile(sys.stdin.buffer.read(n),'pzm_agent','exec'))"
+
+#Started agents by hostname. None if the agent couldn't be started on that host, so it's not tried again
+agents = {}
+#Guards agents, lanes of a sync ask for the agent of the same host at the same time
+agentsLock = threading.Lock()
+
+
+#Client side of pzm_agent. Streams the agent to the host and sends batches of requests over one ssh session.
+class Remote_Agent:
+    def __init__(self, hostname):
+        self.hostname = hostname
+        self.process = None
+        self.stderr_file = None
+        self.lock = threading.Lock() #One batch at a time, the answers of concurrent batches would be mixed up otherwise
+        self.pending = b"" #Read from the agent, but not yet returned by read_line()
+
+    #Start the agent on the host. Returns False if that didn't work (e.g. no python3 on the host)
+    def start(self):
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pzm_agent.py'), 'rb') as agent_file:
+            source = agent_file.read()
+        if is_local(self.hostname):
+            command = ['python3', '-u', '-c', bootstrap]
+        else:
+            command = ssh_command(self.hostname, ['python3', '-u', '-c', shlex.quote(bootstrap)]) #ssh passes the command through the remote shell
+        log_debug ("Starting remote agent: " + " ".join(command))
+        self.stderr_file = tempfile.TemporaryFile()
+        try:
+            self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self.stderr_file)
+            self.process.stdin.write(str(len(source)).encode("utf-8") + b'\n' + source)
+            self.process.stdin.flush()
+            ready = self.read_line(pzm_common.command_timeout)
+            if ready is None:
+                self.process.kill()
+            elif json.loads(ready.decode("utf-8")).get("ready"):
+                return True
+        except (OSError, ValueError):
+            pass
+        self.stderr_file.seek(0)
+        log ("Could not start remote agent on " + self.hostname + ", falling back to single commands: " + self.stderr_file.read().decode("utf-8"))
+        self.close()
+        return False
+
+    #Read one line of the agent, at most timeout seconds (None: no limit) for the whole line, not only for its first bytes.
+    #Returns None if the time is up. Reads the pipe directly, a buffered readline() would block on a partially written line
+    def read_line(self, timeout):
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        fd = self.process.stdout.fileno()
+        chunks = [self.pending]
+        while not b'\n' in chunks[-1]:
+            remaining = max(deadline - time.monotonic(), 0) if deadline is not None else None
+            ready, unused, unused = select.select([fd], [], [], remaining)
+            if len(ready) == 0:
+                self.pending = b"".join(chunks)
+                return None
+            chunk = os.read(fd, 65536)
+            if chunk == b"":
+                raise OSError("agent closed its output")
+            chunks.append(chunk)
+        line, unused, self.pending = b"".join(chunks).partition(b'\n')
+        return line
+
+    #Send one batch of requests (dicts with "op" and its arguments) and return the results in the same order. Threads sharing the agent
+    #wait for each other's batches. Returns None if the agent died, the caller has to fall back to single commands then
+    def request(self, requests):
+        with self.lock:
+            return self.request_locked(requests)
+
+    #request() while holding the lock of the agent
+    def request_locked(self, requests):
+        if self.process is None:
+            return None
+        log_debug ("Agent on " + self.hostname + ": " + ", ".join([request["op"] for request in requests]))
+        try:
+            self.process.stdin.write((json.dumps({"test": pzm_common.test, "requests": requests}) + '\n').encode("utf-8"))
+            self.process.stdin.flush()
+            #The agent answers with exactly one line per batch, wait for all of it at most --timeout seconds
+            answer = self.read_line(pzm_common.command_timeout)
+            if answer is None:
+                log ("Remote agent on " + self.hostname + " didn't answer within " + str(pzm_common.command_timeout) + "s")
+                self.process.kill()
+                self.close()
+                return None
+            results = json.loads(answer.decode("utf-8"))
+        except (OSError, ValueError):
+            log ("Remote agent on " + self.hostname + " died")
+            self.close()
+            return None
+        for request, result in zip(requests, results):
+            if not result["ok"]:
+                log_debug ("Agent request " + request["op"] + " failed: " + result["error"])
+        return results
+
+    #Stop the agent by closing its stdin
+    def close(self):
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+                self.process.wait()
+            except OSError:
+                pass
+            self.process = None
+        if self.stderr_file is not None:
+            self.stderr_file.close()
+            self.stderr_file = None
+
+
+#Returns the agent for hostname, if agents are enabled (--agent) and it could be started. Otherwise None,
+#and the caller uses single commands instead. Local hosts don't need an agent, the transport is in-process already
+def get_agent(hostname):
+    if not pzm_common.use_agent or is_local(hostname):
+        return None
+    with agentsLock:
+        if not hostname in agents:
+            agent = Remote_Agent(hostname)
+            agents[hostname] = agent if agent.start() else None
+        agent = agents[hostname]
+        if agent is not None and agent.process is None: #Died in between
+            agents[hostname] = None
+            return None
+        return agent
+
+#Stop all agents
+def close_agents():
+    with agentsLock:
+        for hostname, agent in agents.items():
+            if agent is not None:
+                with agent.lock:
+                    agent.close()
+        agents.clear()
+
+atexit.register(close_agents)
+
+#Run a shell script on hostname with one round-trip: one agent request, or one command (over ssh). Scripts which change something
+#(readonly=False) are never sent to the agent and not executed in test mode. Long running scripts are run as transfer, without the
+#--timeout of single commands. Returns returncode, stdout and stderr
+def run_script(hostname, script, readonly=True, shell='sh', transfer=False):
+    agent = get_agent(hostname) if readonly else None
+    if agent is not None:
+        results = agent.request([{"op": "command", "command": [shell, '-c', script]}])
+        if results is not None and results[0]["ok"]:
+            return results[0]["result"]["rc"], results[0]["result"]["stdout"], results[0]["result"]["stderr"]
+    if is_local(hostname):
+        command = [shell, '-c', script]
+    else:
+        command = ssh_command(hostname, [shell, '-c', shlex.quote(script)]) #ssh passes the command through the remote shell
+    if readonly:
+        return execute_readonly_command(command)
+    rc, stdout, stderr, pid = execute_command(command, transfer=transfer)
+    return rc, stdout, stderr
@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+
+import datetime
+import os
+import re
+
+import pzm_common
+from pzm_common import execute_readonly_command, execute_command, execute_pipeline, on_host, is_local, read_file, log, log_debug, Zfs_Listing
+from pzm_tuning import tuned_pipeline
+from pzm_remote import get_agent
+from pzm_config_store import store_config, remove_entries, config_name
+
+#Default config path of pve-zsync, used if no --dest-config-path is given
+defaultConfigPath = "/var/lib/pve-zsync"
+#Timestamp format pve-zsync uses in its snapshot names (rep_<backupname>_<timestamp>)
+snapshotTimeformat = "%Y-%m-%d_%H:%M:%S"
+
+
+#Split command output into lines, without empty lines
+def split_lines(stdout):
+    lines = stdout.split('\n')
+    for x in set(lines).intersection(pzm_common.considered_empty):
+        lines.remove(x)
+    return lines
+
+#Snapshot name pve-zsync would use for the given backupname and time
+def snapshot_name(backupname, time):
+    return "rep_" + backupname + "_" + time.strftime(snapshotTimeformat)
+
+#Checks if a snapshot name (the part after @) was made by pve-zsync or the native engine for the given backupname
+def is_backup_snapshot(snapname, backupname):
+    return re.match(r'^rep_' + re.escape(backupname) + r'_\d{4}-\d{2}-\d{2}_\d{2}:\d{2}:\d{2}$', snapname) is not None
+
+#List all snapshot names (the part after @) of a dataset on host, oldest first. Returns an empty list if the dataset does not exist
+def list_snapshots(host, dataset):
+    listing = Zfs_Listing(host, [dataset], types="snapshot", depth=1, sort="createtxg")
+    snapshots = [name.split('@')[1] for name, in listing]
+    if listing.returncode != 0:
+        return []
+    return snapshots
+
+#Snapshot chains of the given datasets on host, fetched with one streamed zfs list. Returns dataset -> Snapshots, oldest first.
+#Datasets which don't exist (or have no snapshots) are not in the result
+def get_snapshot_chains(host, datasets):
+    chains = {}
+    if len(datasets) == 0:
+        return chains
+    agent = get_agent(host)
+    if agent is not None:
+        results = agent.request([{"op": "list_snapshots", "datasets": datasets, "properties": ["guid", "createtxg"]}])
+        if results is not None and results[0]["ok"]:
+            for dataset, snapshots in results[0]["result"].items():
+                chains[dataset] = [Snapshot(snapshot["name"], snapshot["guid"], int(snapshot["createtxg"])) for snapshot in snapshots]
+            return chains
+    for name, guid, createtxg in Zfs_Listing(host, datasets, types="snapshot", properties=["name", "guid", "createtxg"], depth=1, sort="createtxg"):
+        if not '@' in name:
+            continue
+        dataset, snapname = name.split('@', 1)
+        if not dataset in chains:
+            chains[dataset] = []
+        chains[dataset].append(Snapshot(snapname, guid, int(createtxg)))
+    return chains
+
+#Newest snapshot of the source chain which also exists in the destination chain, compared by guid and not by name.
+#Returns the matching Snapshot of both sides, or None, None if they have nothing in common
+def find_common_snapshot(source_chain, destination_chain):
+    destination_guids = {}
+    for snapshot in destination_chain:
+        destination_guids[snapshot.guid] = snapshot
+    for snapshot in reversed(source_chain):
+        if snapshot.guid in destination_guids:
+            return snapshot, destination_guids[snapshot.guid]
+    return None, None
+
+#Returns the receive_resume_token of a dataset on host, or None if it has no interrupted receive to continue
+def get_resume_token(host, dataset):
+    rc, stdout, stderr = execute_readonly_command(on_host(host, ['zfs', 'get', '-H', '-o', 'value', 'receive_resume_token', dataset]))
+    if rc != 0:
+        return None
+    token = stdout.strip()
+    if token in pzm_common.considered_empty or token == '-':
+        return None
+    return token
+
+#Checks if a dataset exists on host
+def dataset_exists(host, dataset):
+    rc, stdout, stderr = execute_readonly_command(on_host(host, ['zfs', 'list', '-H', '-o', 'name', dataset]))
+    return rc == 0
+
+
+#A snapshot, identified by its guid. The name can differ between source and destination (renamed, other backupname)
+class Snapshot:
+    def __init__(self, name, guid, createtxg):
+        self.name = name
+        self.guid = guid
+        self.createtxg = createtxg
+
+
+#A disk of a guest, as pve-zsync would sync it. The pve storage id, the dataset on the source and the dataset on the destination
+class Guest_Disk:
+    def __init__(self, storage_id, source, destination):
+        self.storage_id = storage_id
+        self.source = source
+        self.destination = destination
+
+
+#A VM/CT to sync with its config and disks. snapname is set once the snapshot of all disks exists
+class Guest:
+    def __init__(self, id, source_host, vmid, type, config, disks):
+        self.id = id
+        self.source_host = source_host
+        self.vmid = vmid
+        self.type = type
+        self.config = config
+        self.disks = disks
+        self.snapname = None
+
+
+#Built-in replacement for "pve-zsync sync". Snapshots, sends and receives the disks of a VM/CT directly,
+#with the same snapshot names, destination datasets and config files as the (patched) pve-zsync.
+class Replication_Job:
+    #retention: if set, the destination is pruned by the retention engine (pzm_retention) after all transfers instead of with maxsnap
+    #config_store: configs are written to the content-addressed store (pzm_config_store) instead of one file per snapshot
+    def __init__(self, hostname, zfspool, backupname, maxsnap, replicate, raw, properties, compressed, prepend_storage_id, dest_config_path=None, retention=None, config_store=False):
+        self.hostname = hostname
+        self.zfspool = zfspool
+        self.backupname = backupname
+        self.maxsnap = maxsnap if maxsnap is not None else 1
+        self.replicate = replicate
+        self.raw = raw
+        self.properties = properties
+        self.compressed = compressed
+        self.prepend_storage_id = prepend_storage_id
+        self.dest_config_path = dest_config_path if dest_config_path is not None else defaultConfigPath
+        self.retention = retention
+        self.config_store = config_store
+        self.prepared = {} #ID -> Guest, filled by the snapshot phase
+
+    #IDs are either "vmid" (push) or "host:vmid" (pull). Returns the source host (None for local) and the vmid
+    def parse_id(self, id):
+        if ':' in id:
+            source_host, vmid = id.rsplit(':', 1)
+            return (None if is_local(source_host) else source_host), vmid
+        return None, id
+
+    #Returns "qemu" or "lxc", depending on where the config of the guest is. None if the guest doesn't exist on the source
+    def get_type(self, source_host, vmid):
+        if is_local(source_host):
+            if os.path.exists('/etc/pve/local/qemu-server/' + vmid + '.conf'):
+                return "qemu"
+            if os.path.exists('/etc/pve/local/lxc/' + vmid + '.conf'):
+                return "lxc"
+            return None
+        rc, stdout, stderr = execute_readonly_command(on_host(source_host, ['ls', '/etc/pve/local/qemu-server/' + vmid + '.conf', '/etc/pve/local/lxc/' + vmid + '.conf']))
+        if "qemu-server" in stdout:
+            return "qemu"
+        if "lxc" in stdout:
+            return "lxc"
+        return None
+
+    #Read the config of the guest on the source
+    def get_config(self, source_host, type, vmid):
+        rc, stdout, stderr = read_file(source_host, '/etc/pve/local/' + ('qemu-server' if type == "qemu" else "lxc") + '/' + vmid + '.conf')
+        if rc != 0:
+            return None
+        return stdout
+
+    #Parse all disks of the guest which are on ZFS, from the current (first) block of the config
+    def get_disks(self, source_host, type, vmid, config):
+        diskconfigs = [element for element in split_lines(config.split('\n\n')[0]) if (vmid + '-disk' in element and not element.startswith('unused') and not 'media=cdrom' in element)]
+        disks = []
+        for diskconfig in diskconfigs:
+            volume = diskconfig.split(',')[0].split(':', 1)[1].replace(' ', '')
+            rc, stdout, stderr = execute_readonly_command(on_host(source_host, ['pvesm', 'path', volume]))
+            if rc != 0 or len(split_lines(stdout)) == 0:
+                log_debug ("pvesm path error for " + volume + ": " + stderr)
+                continue
+            path = split_lines(stdout)[0]
+            if path.startswith('/dev/zvol/'):
+                dataset = path.split('/dev/zvol/', 1)[1]
+            elif type == "lxc":
+                dataset = path.split('/', 1)[1]
+            else:
+                continue #qemu disk which is no zvol - not on ZFS
+            if not dataset_exists(source_host, dataset):
+                continue #e.g. a subvol on a directory storage
+            storage_id = volume.split(':')[0]
+            destination = self.zfspool
+            if self.prepend_storage_id:
+                destination = destination + '/' + storage_id
+            destination = destination + '/' + dataset.split('/')[-1]
+            disks.append(Guest_Disk(storage_id, dataset, destination))
+        return disks
+
+    #Destroy the snapshot snapname of every disk, one "zfs destroy" per disk as it takes only one dataset. Returns the errors, empty if all worked
+    def destroy_snapshots(self, source_host, disks, snapname):
+        errors = ""
+        for disk in disks:
+            rc, stdout, stderr, pid = execute_command(on_host(source_host, ['zfs', 'destroy', disk.source + '@' + snapname]))
+            if rc != 0:
+                errors = errors + "Could not destroy " + disk.source + "@" + snapname + ": " + stderr.strip() + "\n"
+        return errors
+
+    #Set or remove the backup lock of the guest, the same way the pve-zsync patch does. Setting fails if the guest holds another lock
+    #(e.g. vzdump, migrate, snapshot). Returns whether the lock was set (removed), only a lock set by this run may be removed
+    def set_guest_lock(self, source_host, type, vmid, lock):
+        command = 'qm' if type == "qemu" else 'pct'
+        if lock:
+            rc, stdout, stderr, pid = execute_command(on_host(source_host, [command, 'set', vmid, '--lock=backup']))
+        else:
+            rc, stdout, stderr, pid = execute_command(on_host(source_host, [command, 'unlock', vmid]))
+        if rc != 0:
+            log_debug ("Could not " + ("lock " if lock else "unlock ") + vmid + ": " + stderr)
+        return rc == 0
+
+    #Continue an interrupted receive of a disk from the resume token of the destination.
+    #If the source snapshot of the token doesn't exist anymore, the partial state is aborted and the disk is sent normally
+    def resume_disk(self, source_host, disk, token):
+        log ("Resuming interrupted receive of " + self.hostname + ":" + disk.destination)
+        rc, stdout, stderr, pid = execute_pipeline(tuned_pipeline(source_host, ['zfs', 'send', '-v', '-t', token], self.hostname, ['zfs', 'recv', '-s', '--', disk.destination]))
+        if rc != 0 and "no longer exists" in stderr:
+            log ("Can't resume " + disk.destination + ", source snapshot is gone. Aborting the partial receive")
+            rc, stdout, stderr, pid = execute_command(on_host(self.hostname, ['zfs', 'recv', '-A', disk.destination]))
+        return rc, stderr, pid
+
+    #Send the snapshot of one disk to the destination, incremental from the newest snapshot both sides have in common (by guid)
+    #Receives are resumable (zfs recv -s), an interrupted receive is continued first and the rest is sent incremental afterwards
+    def send_disk(self, source_host, disk, snapname):
+        output = ""
+        token = get_resume_token(self.hostname, disk.destination)
+        if token is not None:
+            rc, output, pid = self.resume_disk(source_host, disk, token)
+            if rc != 0:
+                return rc, output, pid
+
+        base = None
+        source_chain = get_snapshot_chains(source_host, [disk.source]).get(disk.source, [])
+        destination_chain = get_snapshot_chains(self.hostname, [disk.destination]).get(disk.destination, [])
+        if snapname in [snapshot.name for snapshot in destination_chain]:
+            return 0, output, os.getpid() #The resumed receive already was the snapshot of this run
+        #The base is found by guid, so the incremental also works if the snapshot has another name on the destination
+        source_common, destination_common = find_common_snapshot([snapshot for snapshot in source_chain if snapshot.name != snapname], destination_chain)
+        if source_common is not None:
+            base = source_common.name
+
+        parent = disk.destination.rsplit('/', 1)[0]
+        if self.prepend_storage_id and not dataset_exists(self.hostname, parent):
+            rc, stdout, stderr, pid = execute_command(on_host(self.hostname, ['zfs', 'create', '-p', parent]))
+            if rc != 0:
+                return rc, stderr, pid
+
+        send = ['zfs', 'send']
+        if self.raw:
+            send.append('-w')
+        if self.replicate:
+            send.append('-R')
+        if self.properties:
+            send.append('-p')
+        if self.compressed:
+            send.append('-c')
+        send.append('-v')
+        if base is not None:
+            send = send + ['-I' if self.replicate else '-i', disk.source + '@' + base]
+        send = send + ['--', disk.source + '@' + snapname]
+        receive = ['zfs', 'recv', '-s', '-F', '--', disk.destination]
+
+        log_debug ("Sending " + disk.source + "@" + snapname + (" incremental from " + base if base is not None else " (full)"))
+        rc, stdout, stderr, pid = execute_pipeline(tuned_pipeline(source_host, send, self.hostname, receive))
+        return rc, output + stderr, pid
+
+    #Checks if an interrupted receive of any disk of the ID can be resumed. The remote side must not be sanitized (rolled back) then
+    def can_resume(self, id):
+        guest, error = self.prepare_guest(id)
+        if guest is None:
+            return False
+        for disk in guest.disks:
+            if get_resume_token(self.hostname, disk.destination) is not None:
+                return True
+        return False
+
+    #Copy the guest config to the destination, named like pve-zsync does (<vmid>.conf.<type>.<snapshot>), or into the config store,
+    #and remove configs of pruned snapshots
+    def send_config(self, type, vmid, config, snapname, pruned_snapnames):
+        if self.config_store:
+            rc, stderr = store_config(self.hostname, self.dest_config_path, vmid, type, snapname, config)
+            if rc != 0:
+                return rc, stderr
+            if len(pruned_snapnames) > 0:
+                remove_entries(self.hostname, self.dest_config_path, [config_name(vmid, type, pruned) for pruned in pruned_snapnames], collect=False)
+            return 0, ""
+        rc, stdout, stderr, pid = execute_command(on_host(self.hostname, ['mkdir', '-p', self.dest_config_path]))
+        if rc != 0:
+            return rc, stderr
+        rc, stdout, stderr, pid = execute_command(on_host(self.hostname, ['dd', 'status=none', 'of=' + os.path.join(self.dest_config_path, vmid + '.conf.' + type + '.' + snapname)]), input=config)
+        if rc != 0:
+            return rc, stderr
+        if len(pruned_snapnames) > 0:
+            execute_command(on_host(self.hostname, ['rm', '-f'] + [os.path.join(self.dest_config_path, vmid + '.conf.' + type + '.' + pruned) for pruned in pruned_snapnames]))
+        return 0, ""
+
+    #Destroy all but the newest maxsnap snapshots of this backupname, with one zfs destroy per dataset. Returns the destroyed snapshot names
+    def prune(self, host, dataset):
+        snapshots = [snapshot for snapshot in list_snapshots(host, dataset) if is_backup_snapshot(snapshot, self.backupname)]
+        if len(snapshots) <= self.maxsnap:
+            return []
+        to_destroy = snapshots[:len(snapshots) - self.maxsnap]
+        rc, stdout, stderr, pid = execute_command(on_host(host, ['zfs', 'destroy', dataset + '@' + ','.join(to_destroy)]))
+        if rc != 0:
+            log ("Could not prune snapshots of " + dataset + ": " + stderr)
+            return []
+        return to_destroy
+
+    #Resolve a VM/CT ID to a Guest with its config and ZFS disks. Returns the Guest, or None and an error message in pve-zsync style
+    def prepare_guest(self, id):
+        source_host, vmid = self.parse_id(id)
+        type = self.get_type(source_host, vmid)
+        if type is None:
+            return None, "VM " + vmid + " doesn't exist\n"
+        config = self.get_config(source_host, type, vmid)
+        if config is None:
+            return None, "Could not read config of " + vmid + "\n"
+        disks = self.get_disks(source_host, type, vmid, config)
+        if len(disks) == 0:
+            return None, "Vm include no disk on zfs.\n" #Same message as pve-zsync, which is skipped in backup()
+        return Guest(id, source_host, vmid, type, config, disks), ""
+
+    #Snapshot phase: take the snapshots of all given IDs before any transfer starts. Every consistency group (list of IDs) is
+    #snapshotted with one "zfs snapshot" per source host and pool, so its disks are captured at the same point in time with one txg commit.
+    #IDs not in any group form one additional group. The prepared guests are used by sync() afterwards.
+    def snapshot_all(self, ids, consistency_groups=[]):
+        snapname = snapshot_name(self.backupname, datetime.datetime.now())
+        grouped_ids = [id for group in consistency_groups for id in group]
+        groups = [[id for id in group if id in ids] for group in consistency_groups]
+        groups.append([id for id in ids if id not in grouped_ids])
+        for group in groups:
+            snapshots = {} #(source host, pool) -> snapshots to take in one command
+            guests = []
+            for id in group:
+                guest, error = self.prepare_guest(id)
+                if guest is None:
+                    log_debug ("ID " + id + " not prepared: " + error.strip())
+                    continue
+                guests.append(guest)
+                for disk in guest.disks:
+                    key = (guest.source_host, disk.source.split('/')[0]) #All snapshots of one "zfs snapshot" have to be in the same pool
+                    if not key in snapshots:
+                        snapshots[key] = []
+                    snapshots[key].append(disk.source + '@' + snapname)
+            failed_hosts = []
+            for (source_host, pool), pool_snapshots in snapshots.items():
+                log_debug ("Taking " + str(len(pool_snapshots)) + " snapshots on " + (source_host if source_host is not None else "localhost") + ":" + pool)
+                rc, stdout, stderr, pid = execute_command(on_host(source_host, ['zfs', 'snapshot'] + pool_snapshots))
+                if rc != 0:
+                    log ("Snapshot phase failed on " + (source_host if source_host is not None else "localhost") + ":" + pool + ", affected IDs will be snapshotted on their own: " + stderr)
+                    failed_hosts.append((source_host, pool))
+            for guest in guests:
+                if len([disk for disk in guest.disks if (guest.source_host, disk.source.split('/')[0]) in failed_hosts]) == 0:
+                    guest.snapname = snapname
+                    self.prepared[guest.id] = guest
+                    continue
+                #sync() snapshots the guest again under a new name, the snapshots taken on its other pools would be orphaned
+                for disk in guest.disks:
+                    if not (guest.source_host, disk.source.split('/')[0]) in failed_hosts:
+                        rc, stdout, stderr, pid = execute_command(on_host(guest.source_host, ['zfs', 'destroy', disk.source + '@' + snapname]))
+                        if rc != 0:
+                            log ("Could not destroy " + disk.source + "@" + snapname + " of the failed snapshot phase: " + stderr)
+        log ("Snapshot phase done, " + str(len(self.prepared)) + " of " + str(len(ids)) + " IDs snapshotted as " + snapname)
+
+    #Sync one VM/CT ID. Returns returncode, stdout, stderr and pid like execute_command, so it can be used instead of "pve-zsync sync"
+    #Uses the snapshot of the snapshot phase, if there was one for this ID, otherwise the guest is snapshotted now
+    def sync(self, id):
+        pid = os.getpid()
+        guest = self.prepared.pop(id, None) #A retry will take a new snapshot, as the prepared one is destroyed on failure
+        if guest is None:
+            guest, error = self.prepare_guest(id)
+            if guest is None:
+                return 1, "", error, pid
+        source_host = guest.source_host
+        vmid = guest.vmid
+        type = guest.type
+        disks = guest.disks
+
+        if not self.set_guest_lock(source_host, type, vmid, True):
+            errors = ""
+            if guest.snapname is not None: #Taken in the snapshot phase, a retry takes a new one
+                errors = self.destroy_snapshots(source_host, disks, guest.snapname)
+            return 1, "", "Could not lock " + vmid + ", it is locked by another task (e.g. backup, migrate or snapshot)\n" + errors, pid
+        output = ""
+
+        if guest.snapname is None:
+            guest.snapname = snapshot_name(self.backupname, datetime.datetime.now())
+            #All disks of the guest are snapshotted with one command, so they are consistent with each other
+            rc, stdout, stderr, snapshot_pid = execute_command(on_host(source_host, ['zfs', 'snapshot'] + [disk.source + '@' + guest.snapname for disk in disks]))
+            if rc != 0:
+                self.set_guest_lock(source_host, type, vmid, False)
+                return rc, "", stderr, pid
+        snapname = guest.snapname
+
+        for disk in disks:
+            rc, stderr, pid = self.send_disk(source_host, disk, snapname)
+            output = output + stderr
+            if rc != 0:
+                if get_resume_token(self.hostname, disk.destination) is not None:
+                    #The snapshot is kept, as the partially received state can only be continued from it
+                    output = output + "Receive of " + disk.destination + " was interrupted and will be resumed by the next try\n"
+                else:
+                    #Same as pve-zsync: the new snapshot is removed again, the next try will create a new one
+                    output = output + self.destroy_snapshots(source_host, disks, snapname)
+                self.set_guest_lock(source_host, type, vmid, False)
+                return rc, "", output + "Sending " + disk.source + "@" + snapname + " to " + self.hostname + ":" + disk.destination + " failed\n", pid
+
+        pruned_snapnames = []
+        for disk in disks:
+            for pruned in self.prune(source_host, disk.source):
+                if pruned not in pruned_snapnames:
+                    pruned_snapnames.append(pruned)
+            if self.retention is None:
+                self.prune(self.hostname, disk.destination)
+        if self.retention is not None:
+            pruned_snapnames = [] #The destination keeps these snapshots and their configs, the retention engine removes them later
+
+        rc, stderr = self.send_config(type, vmid, guest.config, snapname, pruned_snapnames)
+        self.set_guest_lock(source_host, type, vmid, False)
+        if rc != 0:
+            return rc, "", output + "Sending config of " + vmid + " failed: " + stderr, pid
+        return 0, "", output, pid
@@ -2,23 +2,46 @@
 
 import time
 import datetime
+import concurrent.futures
+import fcntl
 import os
 import re
+import shlex
+import sys
 
 import pzm_common
-from pzm_common import execute_readonly_command, execute_command, check_zfs_pool, log, log_debug
+from pzm_common import execute_readonly_command, execute_command, execute_pipeline, check_zfs_pool, log, log_debug, on_host, is_local, read_file, list_directory, fetch_file, Zfs_Listing, build_snapshot_index
 from pzm_locking import lock, unlock
+from pzm_replicate import get_resume_token, list_snapshots, is_backup_snapshot
+from pzm_retention import snapshot_time
+from pzm_remote import get_agent
+from pzm_tuning import tuned_pipeline
+from pzm_config_store import read_index, resolve, config_lookup
+
+#The independent copy of a cloned disk is received next to it, with this suffix
+cloneCopySuffix = "-independent"
+#Lock files of the PVE guest configs, qm/pct and the HA stack flock them while they change a config. Waited for like PVE does (seconds)
+guestConfigLocks = {"qemu": "/var/lock/qemu-server/lock-{}.conf", "lxc": "/run/lock/lxc/pve-config-{}.lock"}
+guestConfigLockTimeout = 10
+#Suffix of the clone while it is created, it replaces the destination only once the clone exists
+cloneTempSuffix = "-restoring"
+#Time formats of --at, a date alone means the end of that day
+atTimeformats = ["%Y-%m-%d_%H:%M:%S", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d_%H:%M", "%Y-%m-%d %H:%M", "%Y-%m-%d"]
 
 
 #Disc class for the restore function.
 #Each disk has a Name/ID, latest snaoshot, destination (aka pool) and a vm/ct config file
+#remote_data holds what was already fetched for all disks at once (snapshot names, config file names, configs), so a Disk doesn't query it again
 class Disk:
     def parse_id(self):
         id = self.name.split('-')[1]
         return id
 
-    def get_last_snapshot(self, hostname, backupname):
-        rc, stdout, stderr = execute_readonly_command(['ssh', '-o', 'BatchMode yes', 'root@' + hostname, 'zfs', 'list', '-t', 'snapshot', '-H', '-o', 'name', self.full_name])
+    def get_last_snapshot(self, hostname, backupname, remote_data=None):
+        if remote_data is not None:
+            rc, stdout, stderr = 0, '\n'.join([self.full_name + '@' + snapname for snapname in remote_data["snapshots"].get(self.full_name, [])]), ""
+        else:
+            rc, stdout, stderr = execute_readonly_command(on_host(hostname, ['zfs', 'list', '-t', 'snapshot', '-H', '-o', 'name', self.full_name]))
         if (rc != 0):
             log ("(SSH) ZFS command error: " + stderr)
             sys.exit(1)
@@ -34,17 +57,20 @@ class Disk:
             self.skip = True #Backupname not found, skip in favor for others
             return None
 
-    def get_last_config(self, hostname, configs_path):
-        rc, stdout, stderr = execute_readonly_command(['ssh', '-o', 'BatchMode yes', 'root@' + hostname, 'ls', '-l', configs_path])
+    def get_last_config(self, hostname, configs_path, remote_data=None):
+        if remote_data is not None:
+            rc, files, stderr = 0, remote_data["config_files"], ""
+        else:
+            rc, files, stderr = list_directory(hostname, configs_path)
         if (rc != 0):
-            log ("(SSH) ls -l command error: " + stderr)
+            log ("(SSH) ls command error: " + stderr)
             sys.exit(1)
-        stdout = stdout.split('\n')
-        for x in set(stdout).intersection(pzm_common.considered_empty):
-            stdout.remove(x)
-        relevant_files = [element for element in stdout if(self.last_snapshot.split('@')[1] in element and self.id in element)]
+        if remote_data is not None:
+            relevant_files = [remote_data["config_lookup"][(self.id, self.last_snapshot.split('@')[1])]] if (self.id, self.last_snapshot.split('@')[1]) in remote_data["config_lookup"] else []
+        else:
+            relevant_files = [element for element in files if(self.last_snapshot.split('@')[1] in element and self.id in element)]
         if len(relevant_files) > 0:
-            last_config = relevant_files[-1].split(' ')[-1]
+            last_config = relevant_files[-1]
             if "qemu" in last_config:
                 self.type = "qemu"
             if "lxc" in last_config:
@@ -55,8 +81,11 @@ class Disk:
             self.skip = True #No Config File for this disk found, skip
             return None
 
-    def get_destination(self, hostname, configs_path):
-        rc, stdout, stderr = execute_readonly_command(['ssh', '-o', 'BatchMode yes', 'root@' + hostname, 'cat', configs_path + '/' + self.last_config])
+    def get_destination(self, hostname, configs_path, remote_data=None):
+        if remote_data is not None and self.last_config in remote_data["configs"]:
+            rc, stdout, stderr = 0, remote_data["configs"][self.last_config], ""
+        else:
+            rc, stdout, stderr = read_file(hostname, resolve(hostname, configs_path, self.last_config))
         if (rc != 0):
             log ("(SSH) Get config path command error: " + stderr)
             sys.exit(1)
@@ -89,7 +118,8 @@ class Disk:
             destination = ""
         return destination
 
-    def __init__(self, hostname, full_name, backupname, configs_path):
+    #snapname selects the snapshot to restore (e.g. a restore point of the catalogue), otherwise the newest snapshot of backupname
+    def __init__(self, hostname, full_name, backupname, configs_path, remote_data=None, snapname=None):
         self.restore = False
         self.rollback = False
         self.keep = False
@@ -97,12 +127,18 @@ class Disk:
         self.full_name = full_name
         self.name = full_name.split('/')[-1]
         self.id = self.parse_id()
-        self.last_snapshot = self.get_last_snapshot(hostname, backupname)
+        self.destination = None
+        if snapname is not None:
+            self.last_snapshot = full_name + '@' + snapname
+        else:
+            self.last_snapshot = self.get_last_snapshot(hostname, backupname, remote_data)
         if self.skip: # Can be set in get_last_snapshot
             return
-        self.last_config = self.get_last_config(hostname, configs_path)
+        self.last_config = self.get_last_config(hostname, configs_path, remote_data)
         if self.skip: # Can be set in get_last_config
             return
+        if remote_data is not None: #The configs of all disks are read at once, gather_restore_data sets the destination afterwards
+            return
         self.destination = self.get_destination(hostname, configs_path)
 
 
@@ -122,34 +158,144 @@ class Disk_Group:
         return self.id == other.id
 
 
-#Parses all zfs disks on the remote side (with an optional filter), and asks the user what should be done to each individual disk.
-def gather_restore_data(args):
-    zfs_disks = check_zfs_pool(args.hostname, args.zfs_source_pool).split('\n')
-    zfs_disks = [element for element in zfs_disks if re.search('(basevol|subvol|vm)-\d+-disk-\d+', element)]
-
-    if args.filter is not None:
-        zfs_disks = [element for element in zfs_disks if args.filter in element]
-    for x in set(zfs_disks).intersection(pzm_common.considered_empty):
-        zfs_disks.remove(x)
-    zfs_disk_objects = []
+#Lists all zfs disks on the remote side (with an optional filter), their snapshots with one recursive listing and the config names with
+#one directory listing (plus the index of the config store). Returns the disks, the data fetched for all of them at once (remote_data) and the agent
+def fetch_restore_data(args):
+    check_zfs_pool(args.hostname, args.zfs_source_pool)
+    #Only the subtree of the source pool is listed, and filtered while it's streamed
+    listing = Zfs_Listing(args.hostname, [args.zfs_source_pool])
+    zfs_disks = [name for name, in listing if name.startswith(args.zfs_source_pool + '/') and re.search('(basevol|subvol|vm)-\d+-disk-\d+', name) and (args.filter is None or args.filter in name)]
+    if listing.returncode != 0:
+        log ("(SSH) Error while getting zfs list names " + listing.stderr)
+        sys.exit(1)
 
     if pzm_common.debug:
         print ("Disks found after filter: " + str(zfs_disks))
 
+    #Snapshots of all disks and the config file names are fetched at once: with the remote agent in one round-trip (and all needed configs
+    #in a second one), otherwise with one streamed snapshot listing of the source pool, indexed by disk
+    remote_data = None
+    agent = get_agent(args.hostname)
+    if agent is not None:
+        results = agent.request([{"op": "list_snapshots", "datasets": zfs_disks, "properties": []},
+                                 {"op": "list_dir", "path": args.config_path}])
+        if results is not None and results[0]["ok"] and results[1]["ok"]:
+            snapshots = {}
+            for dataset, dataset_snapshots in results[0]["result"].items():
+                snapshots[dataset] = [snapshot["name"] for snapshot in dataset_snapshots]
+            remote_data = {"snapshots": snapshots, "config_files": results[1]["result"], "configs": {}}
+    if remote_data is None:
+        rc, snapshots, stderr = build_snapshot_index(args.hostname, args.zfs_source_pool, set(zfs_disks))
+        if (rc != 0):
+            log ("(SSH) ZFS command error: " + stderr)
+            sys.exit(1)
+        rc, config_files, stderr = list_directory(args.hostname, args.config_path)
+        if (rc != 0):
+            log ("(SSH) ls command error: " + stderr)
+            sys.exit(1)
+        remote_data = {"snapshots": snapshots, "config_files": config_files, "configs": {}}
+    #Configs in the config store (pzm_config_store) are listed with their pve-zsync names, all configs are looked up by VM/CT and snapshot
+    remote_data["config_files"] = sorted(set(remote_data["config_files"]).union(read_index(args.hostname, args.config_path).keys()))
+    remote_data["config_lookup"] = config_lookup(remote_data["config_files"])
+    return zfs_disks, remote_data, agent
+
+#Every restorable point in time of every VM/CT, from the fetched data in memory. A point is a snapshot of backupname with a config, which
+#every disk of the VM/CT has that existed at that time (its oldest snapshot is older, its newest newer), so disks added or removed later
+#don't hide it. Returns vmid -> {"type", "disks", "points": [(snapname, disks, config name), oldest first]}
+def build_catalogue(zfs_disks, remote_data, backupname):
+    disks_by_vmid = {}
+    for zfs_disk in zfs_disks:
+        disks_by_vmid.setdefault(zfs_disk.split('/')[-1].split('-')[1], []).append(zfs_disk)
+    catalogue = {}
+    for vmid, disks in disks_by_vmid.items():
+        snapshots = dict([(disk, set([snapname for snapname in remote_data["snapshots"].get(disk, []) if is_backup_snapshot(snapname, backupname)])) for disk in disks])
+        disks = [disk for disk in disks if len(snapshots[disk]) > 0]
+        lifetimes = dict([(disk, (min(snapshots[disk]), max(snapshots[disk]))) for disk in disks]) #The timestamp in the names sorts by time
+        points = []
+        for snapname in sorted(set().union(*snapshots.values())):
+            config = remote_data["config_lookup"].get((vmid, snapname))
+            if config is None:
+                continue
+            existing = [disk for disk in disks if lifetimes[disk][0] <= snapname <= lifetimes[disk][1]]
+            if len([disk for disk in existing if not snapname in snapshots[disk]]) == 0:
+                points.append((snapname, existing, config))
+        if len(points) > 0:
+            catalogue[vmid] = {"type": config_type(points[-1][2]), "disks": disks, "points": points}
+    return catalogue
+
+#Type (qemu/lxc) of a config name
+def config_type(config_name):
+    return "qemu" if ".conf.qemu." in config_name else "lxc"
+
+#Time of --at, e.g. "2024-05-01_13:00:00", "2024-05-01 13:00" or "2024-05-01" (end of that day)
+def parse_at(at):
+    for timeformat in atTimeformats:
+        try:
+            at_time = datetime.datetime.strptime(at, timeformat)
+        except ValueError:
+            continue
+        if timeformat == "%Y-%m-%d":
+            at_time = at_time + datetime.timedelta(days=1, seconds=-1)
+        return at_time
+    print ("Invalid time for --at: " + at + ", use e.g. 2024-05-01_13:00:00, \"2024-05-01 13:00\" or 2024-05-01")
+    sys.exit(1)
+
+#Entry point of "restore --list": show the restore points of every VM/CT, nothing is changed
+def list_restore_points(args):
+    zfs_disks, remote_data, agent = fetch_restore_data(args)
+    catalogue = build_catalogue(zfs_disks, remote_data, args.backupname)
+    if len(catalogue) == 0:
+        print ("No restore points of " + args.backupname + " found")
+        return
+    for vmid in sorted(catalogue.keys(), key=int):
+        entry = catalogue[vmid]
+        print ("ID: " + vmid + " (" + entry["type"] + ", " + str(len(entry["points"])) + " restore points)")
+        for snapname, disks, config in reversed(entry["points"]):
+            print ("    " + snapshot_time(snapname).strftime("%Y-%m-%d %H:%M:%S") + "  " + snapname + "  " + ", ".join([disk.split('/')[-1] for disk in disks]))
+
+#Parses all zfs disks on the remote side (with an optional filter). Returns the Disk_Groups and the data fetched for all disks at once (remote_data).
+#With --at every VM/CT is restored from its newest restore point at or before that time, otherwise every disk from its newest snapshot
+def scan_restore_data(args):
+    zfs_disks, remote_data, agent = fetch_restore_data(args)
+    chosen = None #disk -> snapshot name of the restore point
+    if args.at is not None:
+        at = parse_at(args.at)
+        chosen = {}
+        for vmid, entry in build_catalogue(zfs_disks, remote_data, args.backupname).items():
+            points = [point for point in entry["points"] if snapshot_time(point[0]) <= at]
+            if len(points) == 0:
+                print ("ID: " + vmid + " has no restore point at or before " + at.strftime("%Y-%m-%d %H:%M:%S") + " - skipping...")
+                continue
+            snapname, disks, config = points[-1]
+            for disk in disks:
+                chosen[disk] = snapname
+        zfs_disks = [zfs_disk for zfs_disk in zfs_disks if zfs_disk in chosen]
+
+    zfs_disk_objects = []
     for zfs_disk in zfs_disks:
-        if args.zfs_source_pool + '/' in zfs_disk:
-            zfs_disk_objects.append(Disk(args.hostname, zfs_disk, args.backupname, args.config_path))
-            if zfs_disk_objects[-1].skip:
-                zfs_disk_objects.pop()
-    disk_groups = []
+        zfs_disk_objects.append(Disk(args.hostname, zfs_disk, args.backupname, args.config_path, remote_data, chosen[zfs_disk] if chosen is not None else None))
+        if zfs_disk_objects[-1].skip:
+            zfs_disk_objects.pop()
+
+    if agent is not None:
+        config_names = list(dict.fromkeys([disk.last_config for disk in zfs_disk_objects]))
+        results = agent.request([{"op": "read_file", "path": resolve(args.hostname, args.config_path, config_name)} for config_name in config_names])
+        if results is not None:
+            for config_name, result in zip(config_names, results):
+                if result["ok"] and result["result"] is not None:
+                    remote_data["configs"][config_name] = result["result"]
     for disk in zfs_disk_objects:
-        if not Disk_Group(disk.id, None, None) in disk_groups:
-            group = Disk_Group(disk.id, disk.type, disk.last_config)
-            group.disks.append(disk)
-            disk_groups.append(group)
-        else:
-            disk_groups[disk_groups.index(Disk_Group(disk.id, None, None))].disks.append(disk)
+        disk.destination = disk.get_destination(args.hostname, args.config_path, remote_data)
+    groups = {} #VM/CT id -> Disk_Group, in the order of the disks
+    for disk in zfs_disk_objects:
+        if not disk.id in groups:
+            groups[disk.id] = Disk_Group(disk.id, disk.type, disk.last_config)
+        groups[disk.id].disks.append(disk)
+    return list(groups.values()), remote_data
 
+#Parses all zfs disks on the remote side (with an optional filter), and asks the user what should be done to each individual disk.
+def gather_restore_data(args):
+    disk_groups, remote_data = scan_restore_data(args)
 
     for group in disk_groups:
         print ("ID: " + group.id)
@@ -185,7 +331,7 @@ def gather_restore_data(args):
             if disk.restore:
                 print ("RESTORE: " +  disk.name + " from " + disk.last_snapshot + " to " + disk.destination + ": ")
             elif disk.rollback:
-                print ("ROLLBACK: " + disk.name + " to " + disk.destination + disk.last_snapshot.split('@')[1])
+                print ("ROLLBACK: " + disk.name + " to " + disk.destination + '@' + disk.last_snapshot.split('@')[1])
             elif disk.keep:
                 print ("KEEP DATA: " + disk.destination)
     input_data = input ("\nIs the information correct? (y):")
@@ -195,17 +341,97 @@ def gather_restore_data(args):
        return None
 
 #Destroys newer snapshots than the given one. Needed if the data has to be kept, but the snapshots have to be synchronized
+#All newer snapshots are destroyed with one range destroy (dataset@first%last)
 def destroy_newer_snapshots(args, destination, snapshot):
-    rc, stdout, stderr = execute_readonly_command(['zfs', 'list', '-t', 'snapshot', '-H', '-o', 'name', destination])
-    stdout = stdout.split('\n')
-    index_of_snap = stdout.index(destination + '@' + snapshot.split('@')[1])
-    snaps_to_delete = stdout[index_of_snap+1:]
-    for x in set(snaps_to_delete).intersection(pzm_common.considered_empty):
-        snaps_to_delete.remove(x)
-    for snap in snaps_to_delete:
-        if snap == "":
+    snapshots = list_snapshots(None, destination)
+    snapname = snapshot.split('@')[1]
+    if not snapname in snapshots:
+        return
+    snaps_to_delete = snapshots[snapshots.index(snapname)+1:]
+    if len(snaps_to_delete) == 0:
+        return
+    rc, stdout, stderr, pid = execute_command(['zfs', 'destroy', destination + '@' + snaps_to_delete[0] + '%' + snaps_to_delete[-1]])
+    if rc != 0:
+        print (stderr)
+
+#Splits a PVE guest config into its sections. Returns a list of [name, lines], the current config has the name None.
+#Snapshot sections are named like the snapshot, [PENDING] and [special:...] sections are no snapshots
+def split_guest_config(config):
+    sections = [[None, []]]
+    for line in config.split('\n'):
+        match = re.match(r'^\[([^\]]+)\]\s*$', line)
+        if match is not None:
+            sections.append([match.group(1), []])
+        sections[-1][1].append(line)
+    return sections
+
+#Names of the snapshots in a PVE guest config
+def config_snapshot_names(config):
+    return [name for name, lines in split_guest_config(config) if name is not None and name != "PENDING" and not name.startswith("special:")]
+
+#Removes the given snapshots from a PVE guest config in one edit, like "qm/pct delsnapshot --force" would one by one.
+#"parent:" references to a removed snapshot are moved to the next parent which is kept, so the snapshot tree stays intact
+def remove_config_snapshots(config, snapnames):
+    snapnames = set(snapnames)
+    sections = split_guest_config(config)
+    parents = {}
+    for name, lines in sections:
+        for line in lines:
+            if line.startswith('parent:'):
+                parents[name] = line.split(':', 1)[1].strip()
+    def kept_parent(parent):
+        while parent is not None and parent in snapnames:
+            parent = parents.get(parent)
+        return parent
+    new_lines = []
+    for name, lines in sections:
+        if name in snapnames:
             continue
-        execute_command(['zfs', 'destroy', snap])
+        for line in lines:
+            if line.startswith('parent:'):
+                parent = kept_parent(line.split(':', 1)[1].strip())
+                if parent is None:
+                    continue
+                line = 'parent: ' + parent
+            new_lines.append(line)
+    return '\n'.join(new_lines)
+
+#Names of the snapshots in a PVE guest config which have a RAM state (a vmstate: volume)
+def vmstate_snapshot_names(config):
+    return [name for name, lines in split_guest_config(config) if name in config_snapshot_names(config) and len([line for line in lines if line.startswith('vmstate:')]) > 0]
+
+#Edit the config of a guest under its PVE config lock, so a concurrent qm/pct set or HA update is neither overwritten nor lost:
+#the config is read, changed with edit(config) and written back while the lock is held. Returns returncode and stderr
+def edit_guest_config(type, id, edit):
+    config_path = ('/etc/pve/lxc/' if type == "lxc" else '/etc/pve/qemu-server/') + id + '.conf'
+    lock_path = guestConfigLocks[type].format(id)
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    with open(lock_path, 'a') as lock_file: #Closing the file releases the lock
+        deadline = time.time() + guestConfigLockTimeout
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.time() > deadline:
+                    return 1, "Can't lock the config of " + id + ", it is locked by another process"
+                time.sleep(0.1)
+        rc, config, stderr = read_file(None, config_path)
+        if rc != 0:
+            return rc, stderr
+        rc, stdout, stderr, pid = execute_command(['dd', 'status=none', 'of=' + config_path], input=edit(config))
+        return rc, stderr
+
+#Continues an interrupted receive into destination from its resume token.
+#Snapshots of the replication stream which weren't received at all are sent incremental afterwards
+def resume_receive(args, destination, snapshot, token):
+    rc, stdout, stderr, pid = execute_pipeline(tuned_pipeline(args.hostname, ['zfs', 'send', '-t', token], None, ['zfs', 'recv', '-s', destination]))
+    if stderr != "":
+        return rc, stdout, stderr
+    received_snapshots = list_snapshots(None, destination)
+    if len(received_snapshots) > 0 and received_snapshots[-1] != snapshot.split('@')[1]:
+        rc, stdout, stderr, pid = execute_pipeline(tuned_pipeline(args.hostname, ['zfs', 'send', '-Rw', '-I', '@' + received_snapshots[-1], snapshot], None, ['zfs', 'recv', '-s', '-F', destination]))
+    return rc, stdout, stderr
 
 #Checks if a dataset is encrypted
 def zfs_is_encrypted(dataset):
@@ -217,52 +443,176 @@ def zfs_is_encrypted(dataset):
     else:
         return True
 
-#Main method for the restore function. Will restore a backup made with pve-zsync-manager or pve-zsync according to the given input in gather_restore_data
-def restore(args, disk_groups):
-    lock(args.hostname)
-    for group in disk_groups:
-        if group.skip:
-            print ("VM/CT ID " + group.id + " skipped...")
-            continue
-        print ("VM/CT ID " + group.id + " preparing...")
-        if (group.type == "lxc"):
-            execute_command(['pct', 'shutdown', group.id])
-            execute_command(['pct', 'set', group.id, '--lock=backup'])
-
-            rc, stdout, stderr, pid = execute_command(['mv', '/etc/pve/lxc/' + group.id + '.conf', '/etc/pve/lxc/' + group.id + '.conf.backup'])
-            #if rc != 0:
-            #    print (stdout)
-            #    print (stderr)
-            #    continue
-
-            rc, stdout, stderr, pid = execute_command(['scp', '-B', 'root@' + args.hostname + ':' + args.config_path + '/' + group.last_config, '/etc/pve/lxc/' + group.id + '.conf'])
+#Checks if a disk can be restored by cloning its snapshot: the backup is on this node, in the same pool as the destination,
+#and the destination is neither the replica itself nor a parent or child of it (destroying the destination would destroy the replica)
+def can_clone(args, disk):
+    if not is_local(args.hostname):
+        return False
+    if disk.full_name.split('/')[0] != disk.destination.split('/')[0]:
+        return False
+    return not ((disk.full_name + '/').startswith(disk.destination + '/') or (disk.destination + '/').startswith(disk.full_name + '/'))
+
+#Value of a property of a local dataset, None if it can't be read
+def zfs_property(dataset, property):
+    rc, stdout, stderr = execute_readonly_command(['zfs', 'get', '-H', '-o', 'value', property, dataset])
+    if rc != 0:
+        return None
+    return stdout.strip()
+
+#Load the key of a restored, encrypted disk from --keyfile (or let it inherit the key of its parent if that is encrypted too) and mount it.
+#Returns False if that failed
+def load_key_and_mount(args, disk):
+    if args.keyfile is not None:
+        dataset_encrypted = zfs_is_encrypted(disk.destination)
+        parent_encrypted = zfs_is_encrypted(disk.destination.rsplit('/',1)[0])
+        if dataset_encrypted:
+            rc, stdout, stderr, pid = execute_command(['zfs', 'set', 'keylocation=file://' + args.keyfile, disk.destination])
             if rc != 0:
                 print (stdout)
                 print (stderr)
-                execute_command(['mv', '/etc/pve/lxc/' + group.id + '.conf.backup', '/etc/pve/lxc/' + group.id + '.conf'])
-                continue
-
-        elif (group.type == "qemu"):
-            execute_command(['qm', 'shutdown', group.id])
-            execute_command(['qm', 'set', group.id, '--lock=backup'])
-
-            rc, stdout, stderr, pid = execute_command(['mv', '/etc/pve/qemu-server/' + group.id + '.conf', '/etc/pve/qemu-server/' + group.id + '.conf.backup'])
+                return False
+            rc, stdout, stderr, pid = execute_command(['zfs', 'load-key', disk.destination])
             if rc != 0:
                 print (stdout)
                 print (stderr)
-                continue
-
-            rc, stdout, stderr, pid = execute_command(['scp', '-B', 'root@' + args.hostname + ':' + args.config_path + '/' + group.last_config, '/etc/pve/qemu-server/' + group.id + '.conf'])
+                return False
+        if parent_encrypted:
+            rc, stdout, stderr, pid = execute_command(['zfs', 'change-key', '-i', disk.destination])
             if rc != 0:
                 print (stdout)
                 print (stderr)
-                execute_command(['mv', '/etc/pve/qemu-server/' + group.id + '.conf.backup', '/etc/pve/qemu-server/' + group.id + '.conf'])
-                continue
-        no_restore_count = 0
+                return False
 
-        for disk in group.disks:
-            if disk.restore:
-                print ("VM/CT ID " + group.id + " - restoring " + disk.destination)
+    rc, stdout, stderr, pid = execute_command(['zfs', 'mount', disk.destination])
+    if rc != 0:
+        print (stdout)
+        print (stderr)
+        return False
+    return True
+
+#Load the key of an encrypted replica from --keyfile before it is cloned. A clone shares the encryption root (and the key) of its origin,
+#so the key is loaded on that encryption root. Returns False if the replica is encrypted and its key can't be loaded
+def load_clone_key(args, group, disk):
+    dataset = disk.last_snapshot.split('@')[0]
+    if not zfs_is_encrypted(dataset) or zfs_property(dataset, 'keystatus') == "available":
+        return True
+    if args.keyfile is None:
+        print ("VM/CT ID " + group.id + " - " + dataset + " is encrypted and its key isn't loaded, use --keyfile")
+        return False
+    root = zfs_property(dataset, 'encryptionroot')
+    if root in [None, "", "-"]:
+        return False
+    rc, stdout, stderr, pid = execute_command(['zfs', 'load-key', '-L', 'file://' + args.keyfile, root])
+    if rc != 0:
+        print (stderr)
+        return False
+    return True
+
+#Restores a disk in seconds by cloning the snapshot of the local replica into place. The config of the VM/CT already points at the destination.
+#The clone is created next to the destination and only renamed over it once it exists, so a failing clone leaves the destination as it was.
+#With --promote the clone takes over the snapshots of the replica up to the cloned one, so the replica can be destroyed.
+#With --independent a full copy is received in the background (as a systemd unit) next to the clone. Returns True if the clone is in place,
+#False if the disk has to be restored with send/recv
+def clone_disk(args, group, disk):
+    print ("VM/CT ID " + group.id + " - cloning " + disk.last_snapshot + " to " + disk.destination)
+    if not load_clone_key(args, group, disk):
+        return False
+    temporary = disk.destination + cloneTempSuffix
+    rc, stdout, stderr = execute_readonly_command(['zfs', 'list', temporary])
+    if rc == 0: #Left over by an interrupted restore
+        execute_command(['zfs', 'destroy', '-r', temporary])
+    rc, stdout, stderr, pid = execute_command(['zfs', 'clone', disk.last_snapshot, temporary])
+    if rc != 0:
+        print (stderr)
+        return False
+    rc, stdout, stderr = execute_readonly_command(['zfs', 'list', disk.destination])
+    if rc == 0:
+        rc, stdout, stderr, pid = execute_command(['zfs', 'destroy', '-r', disk.destination])
+        if rc != 0:
+            print (stderr)
+            execute_command(['zfs', 'destroy', temporary])
+            return False
+    rc, stdout, stderr, pid = execute_command(['zfs', 'rename', temporary, disk.destination])
+    if rc != 0:
+        print (stderr)
+        execute_command(['zfs', 'destroy', temporary])
+        return False
+    if zfs_property(disk.destination, 'type') == "filesystem" and zfs_property(disk.destination, 'mounted') != "yes":
+        rc, stdout, stderr, pid = execute_command(['zfs', 'mount', disk.destination])
+        if rc != 0:
+            print (stderr)
+    if args.promote:
+        rc, stdout, stderr, pid = execute_command(['zfs', 'promote', disk.destination])
+        if rc != 0:
+            print (stderr)
+    if args.independent:
+        copy = disk.destination + cloneCopySuffix
+        unit = 'pve-zsync-manager-copy-' + disk.destination.split('/')[-1]
+        script = 'zfs send -w ' + shlex.quote(disk.last_snapshot) + ' | zfs recv -s -u ' + shlex.quote(copy)
+        rc, stdout, stderr, pid = execute_command(['systemd-run', '--unit', unit, '--collect', 'sh', '-c', script])
+        if rc != 0:
+            print (stderr)
+        else:
+            print ("VM/CT ID " + group.id + " - copying " + disk.last_snapshot + " to " + copy + " in the background (journalctl -u " + unit + ")")
+            print ("VM/CT ID " + group.id + " - once it is done and the VM/CT is stopped: zfs destroy -r " + disk.destination + " && zfs rename " + copy + " " + disk.destination)
+    return True
+
+#Restore one VM/CT as planned in its Disk_Group
+def restore_group(args, group):
+    if group.skip:
+        print ("VM/CT ID " + group.id + " skipped...")
+        return
+    print ("VM/CT ID " + group.id + " preparing...")
+    if (group.type == "lxc"):
+        execute_command(['pct', 'shutdown', group.id])
+        execute_command(['pct', 'set', group.id, '--lock=backup'])
+
+        rc, stdout, stderr, pid = execute_command(['mv', '/etc/pve/lxc/' + group.id + '.conf', '/etc/pve/lxc/' + group.id + '.conf.backup'])
+        #if rc != 0:
+        #    print (stdout)
+        #    print (stderr)
+        #    continue
+
+        rc, stdout, stderr, pid = fetch_file(args.hostname, resolve(args.hostname, args.config_path, group.last_config), '/etc/pve/lxc/' + group.id + '.conf')
+        if rc != 0:
+            print (stdout)
+            print (stderr)
+            execute_command(['mv', '/etc/pve/lxc/' + group.id + '.conf.backup', '/etc/pve/lxc/' + group.id + '.conf'])
+            return
+
+    elif (group.type == "qemu"):
+        execute_command(['qm', 'shutdown', group.id])
+        execute_command(['qm', 'set', group.id, '--lock=backup'])
+
+        rc, stdout, stderr, pid = execute_command(['mv', '/etc/pve/qemu-server/' + group.id + '.conf', '/etc/pve/qemu-server/' + group.id + '.conf.backup'])
+        if rc != 0:
+            print (stdout)
+            print (stderr)
+            return
+
+        rc, stdout, stderr, pid = fetch_file(args.hostname, resolve(args.hostname, args.config_path, group.last_config), '/etc/pve/qemu-server/' + group.id + '.conf')
+        if rc != 0:
+            print (stdout)
+            print (stderr)
+            execute_command(['mv', '/etc/pve/qemu-server/' + group.id + '.conf.backup', '/etc/pve/qemu-server/' + group.id + '.conf'])
+            return
+    no_restore_count = 0
+
+    for disk in group.disks:
+        if disk.restore:
+            if getattr(args, 'clone', False):
+                if not can_clone(args, disk):
+                    print ("VM/CT ID " + group.id + " - " + disk.full_name + " is not a local replica in the pool of " + disk.destination + ", can't clone")
+                elif clone_disk(args, group, disk):
+                    continue
+                else:
+                    print ("VM/CT ID " + group.id + " - cloning " + disk.destination + " failed, restoring with send/recv")
+            print ("VM/CT ID " + group.id + " - restoring " + disk.destination)
+            token = get_resume_token(None, disk.destination)
+            if token is not None: #A previous restore was interrupted, continue it instead of starting over
+                print ("VM/CT ID " + group.id + " - resuming interrupted receive of " + disk.destination)
+                rc, stdout, stderr = resume_receive(args, disk.destination, disk.last_snapshot, token)
+            else:
                 rc, stdout, stderr = execute_readonly_command(['zfs', 'list', disk.destination])
                 if rc == 0:
                     rc, stdout, stderr, pid = execute_command(['zfs', 'destroy', '-r', disk.destination])
@@ -270,96 +620,98 @@ def restore(args, disk_groups):
                         print (stdout)
                         print (stderr)
                         continue
-                rc, stdout, stderr, pid = execute_command(['ssh -o \"BatchMode yes\" root@' + args.hostname + ' zfs send -Rw ' +  disk.last_snapshot + ' | zfs recv -F ' + disk.destination], shell=True)
-                if stderr != "":
-                    print (stdout)
-                    print (stderr)
-                    continue
+                rc, stdout, stderr, pid = execute_pipeline(tuned_pipeline(args.hostname, ['zfs', 'send', '-Rw', disk.last_snapshot], None, ['zfs', 'recv', '-s', '-F', disk.destination]))
+            tries = 0
+            while stderr != "" and args.retries is not None and tries < args.retries:
+                token = get_resume_token(None, disk.destination)
+                if token is None:
+                    break
+                tries += 1
+                print ("VM/CT ID " + group.id + " - receive interrupted, resuming after 30 seconds...")
+                time.sleep(30)
+                rc, stdout, stderr = resume_receive(args, disk.destination, disk.last_snapshot, token)
+            if stderr != "":
+                print (stdout)
+                print (stderr)
+                continue
 
-                if args.keyfile is not None:
-                    dataset_encrypted = zfs_is_encrypted(disk.destination)
-                    parent_encrypted = zfs_is_encrypted(disk.destination.rsplit('/',1)[0])
-                    if dataset_encrypted:
-                        rc, stdout, stderr, pid = execute_command(['zfs', 'set', 'keylocation=file://' + args.keyfile, disk.destination])
-                        if rc != 0:
-                            print (stdout)
-                            print (stderr)
-                            continue
-                        rc, stdout, stderr, pid = execute_command(['zfs', 'load-key', disk.destination])
-                        if rc != 0:
-                            print (stdout)
-                            print (stderr)
-                            continue
-                    if parent_encrypted:
-                        rc, stdout, stderr, pid = execute_command(['zfs', 'change-key', '-i', disk.destination])
-                        if rc != 0:
-                            print (stdout)
-                            print (stderr)
-                            continue
-
-                rc, stdout, stderr, pid = execute_command(['zfs', 'mount', disk.destination])
-                if rc != 0:
-                    print (stdout)
-                    print (stderr)
-                    continue
-            elif disk.rollback:
-                no_restore_count = no_restore_count + 1
-                print ("VM/CT ID " + group.id + " - rolling back " + disk.destination + " to " + disk.last_snapshot.split('@')[1])
-                rc, stdout, stderr, pid = execute_command(['zfs', 'rollback', '-r', disk.destination + disk.last_snapshot.split('@')[1]])
-                if rc != 0:
-                    print (stdout)
-                    print (stderr)
-                    continue
+            if not load_key_and_mount(args, disk):
+                continue
+        elif disk.rollback:
+            no_restore_count = no_restore_count + 1
+            print ("VM/CT ID " + group.id + " - rolling back " + disk.destination + " to " + disk.last_snapshot.split('@')[1])
+            rc, stdout, stderr, pid = execute_command(['zfs', 'rollback', '-r', disk.destination + '@' + disk.last_snapshot.split('@')[1]])
+            if rc != 0:
+                print (stdout)
+                print (stderr)
+                continue
 
-            elif disk.keep:
-                no_restore_count = no_restore_count + 1
-                print ("VM/CT ID " + group.id + " - destroying newer snapshots than " + disk.last_snapshot.split('@')[1] + " on " + disk.destination)
-                destroy_newer_snapshots(args, disk.destination, disk.last_snapshot)
-
-
-        if group.type == "lxc":
-            execute_command(['pct', 'unlock', group.id])
-        elif group.type == "qemu":
-            execute_command(['qm', 'unlock', group.id])
-
-        ## Force Delete PVE Snapshots which are not on all disks
-        if no_restore_count > 0:
-            cleanup_disks = [ element for element in group.disks if not ( element.restore )]
-            if group.type == "lxc":
-                snaps_in_config = execute_readonly_command(['pct', 'listsnapshot', group.id])[1]
-            elif group.type == "qemu":
-                snaps_in_config = execute_readonly_command(['qm', 'listsnapshot', group.id])[1]
-            snaps_in_config = snaps_in_config.split('\n')
-
-            for x in set(snaps_in_config).intersection(pzm_common.considered_empty):
-                snaps_in_config.remove(x)
-
-            snapnames_in_config = []
-            for snap_in_config in snaps_in_config:
-                snapnames_in_config.append(snap_in_config.lstrip().split(' ')[1])
-                #print ("Snapname: " + snap_in_config.lstrip().split(' ')[1])
-            if "current" in snapnames_in_config:
-                snapnames_in_config.pop(snapnames_in_config.index("current"))
-
-            all_snaps_on_disks = []
-            for disk in cleanup_disks:
-                rc, stdout, stderr = execute_readonly_command(['zfs', 'list', '-t', 'snapshot', '-H', '-o', 'name', disk.destination])
-                snapshots_on_disk = stdout.split('\n')
-                for x in set(snapshots_on_disk).intersection(pzm_common.considered_empty):
-                    snapshots_on_disk.remove(x)
-                for snapshot_on_disk in snapshots_on_disk:
-                    if not snapshot_on_disk.split('@')[1] in all_snaps_on_disks:
-                        #print ("Snap on Disk: " + snapshot_on_disk.split('@')[1])
-                        all_snaps_on_disks.append(snapshot_on_disk.split('@')[1])
-
-            for snapname_in_config in snapnames_in_config:
-                if not snapname_in_config in all_snaps_on_disks:
-                    if group.type == "lxc":
-                        print ("Deleting Snapshot " + snapname_in_config + " because it's not present on all disks")
-                        execute_command(['pct', 'delsnapshot', group.id, snapname_in_config, '--force'])
-                    elif group.type == "qemu":
-                        print ("Deleting Snapshot " + snapname_in_config + " because it's not present on all disks")
-                        execute_command(['qm', 'delsnapshot', group.id, snapname_in_config, '--force'])
-
-        print ("VM/CT ID " + group.id + " finished!")
+        elif disk.keep:
+            no_restore_count = no_restore_count + 1
+            print ("VM/CT ID " + group.id + " - destroying newer snapshots than " + disk.last_snapshot.split('@')[1] + " on " + disk.destination)
+            destroy_newer_snapshots(args, disk.destination, disk.last_snapshot)
+
+
+    if group.type == "lxc":
+        execute_command(['pct', 'unlock', group.id])
+    elif group.type == "qemu":
+        execute_command(['qm', 'unlock', group.id])
+
+    ## Force Delete PVE Snapshots which are not on all disks
+    if no_restore_count > 0:
+        cleanup_disks = [element.destination for element in group.disks if not ( element.restore )]
+        config_path = ('/etc/pve/lxc/' if group.type == "lxc" else '/etc/pve/qemu-server/') + group.id + '.conf'
+        rc, config, stderr = read_file(None, config_path)
+        if rc != 0:
+            print (stderr)
+        else:
+            all_snaps_on_disks = set([name.split('@')[1] for name, in Zfs_Listing(None, cleanup_disks, types="snapshot", depth=1)])
+            snaps_to_delete = [snapname for snapname in config_snapshot_names(config) if not snapname in all_snaps_on_disks]
+            if len(snaps_to_delete) > 0:
+                print ("Deleting Snapshot(s) " + ", ".join(snaps_to_delete) + " because they're not present on all disks")
+                #delsnapshot also removes the vmstate volume of a RAM snapshot, it takes the config lock itself
+                with_vmstate = [snapname for snapname in snaps_to_delete if snapname in vmstate_snapshot_names(config)]
+                for snapname in with_vmstate:
+                    rc, stdout, stderr, pid = execute_command(['pct' if group.type == "lxc" else 'qm', 'delsnapshot', group.id, snapname, '--force'])
+                    if rc != 0:
+                        print (stderr)
+                without_vmstate = [snapname for snapname in snaps_to_delete if not snapname in with_vmstate]
+                if len(without_vmstate) > 0:
+                    rc, stderr = edit_guest_config(group.type, group.id, lambda config: remove_config_snapshots(config, without_vmstate))
+                    if rc != 0:
+                        print (stderr)
+
+    print ("VM/CT ID " + group.id + " finished!")
+
+#Groups which have to be restored one after the other, because they share a destination dataset. Groups of different chains are independent
+def independent_chains(disk_groups):
+    chains = [] #List of (destinations, groups)
+    for group in disk_groups:
+        destinations = set([disk.destination for disk in group.disks])
+        sharing = [chain for chain in chains if len(chain[0].intersection(destinations)) > 0]
+        merged = (destinations, [])
+        for chain in sharing:
+            merged[0].update(chain[0])
+            merged[1].extend(chain[1])
+            chains.remove(chain)
+        merged[1].append(group)
+        chains.append(merged)
+    return [groups for destinations, groups in chains]
+
+#Main method for the restore function. Will restore a backup made with pve-zsync-manager or pve-zsync according to the given input in gather_restore_data
+#or a restore plan. With --parallel, up to that many VM/CTs are restored at the same time, if their disks are independent
+def restore(args, disk_groups):
+    lock(args.hostname)
+    parallel = getattr(args, 'parallel', None) or 1
+    if parallel > 1:
+        def restore_chain(groups):
+            for group in groups:
+                restore_group(args, group)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as executor:
+            list(executor.map(restore_chain, independent_chains(disk_groups)))
+    else:
+        for group in disk_groups:
+            restore_group(args, group)
+    if pzm_common.throttle is not None:
+        print (pzm_common.throttle.summary())
     unlock(args.hostname)
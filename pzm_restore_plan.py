@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+import json
+import sys
+
+try:
+    import yaml #Optional, only needed for plans in YAML
+except ImportError:
+    yaml = None
+
+from pzm_common import log, Zfs_Listing
+from pzm_restore import scan_restore_data
+
+#What can be done to a disk. Disks which are not restored, but belong to a VM/CT with restored disks, have to be rolled back or kept
+actions = ["restore", "rollback", "keep", "skip"]
+
+
+#Plans ending with .yaml or .yml are YAML, all others JSON
+def is_yaml(path):
+    return path.endswith(".yaml") or path.endswith(".yml")
+
+#Write a plan to a file
+def write_plan(path, plan):
+    with open(path, 'w') as planFile:
+        if is_yaml(path):
+            if yaml is None:
+                print ("PyYAML is not installed, write the plan as .json instead")
+                sys.exit(1)
+            yaml.safe_dump(plan, planFile, default_flow_style=False, sort_keys=False)
+        else:
+            json.dump(plan, planFile, indent=4)
+
+#Read a plan from a file
+def read_plan(path):
+    with open(path, 'r') as planFile:
+        if is_yaml(path):
+            if yaml is None:
+                print ("PyYAML is not installed, can't read " + path)
+                sys.exit(1)
+            return yaml.safe_load(planFile)
+        return json.load(planFile)
+
+#Scan the remote side and write a plan, which restores every disk from its newest snapshot. Edit it and run it with --plan
+def emit_restore_plan(args):
+    disk_groups, remote_data = scan_restore_data(args)
+    plan = {
+        "hostname": args.hostname,
+        "zfs_source_pool": args.zfs_source_pool,
+        "backupname": args.backupname,
+        "config_path": args.config_path,
+        "guests": []
+    }
+    for group in disk_groups:
+        plan["guests"].append({
+            "id": group.id,
+            "type": group.type,
+            "config": group.last_config,
+            "disks": [{"source": disk.full_name,
+                       "snapshot": disk.last_snapshot.split('@')[1],
+                       "destination": disk.destination,
+                       "action": "restore"} for disk in group.disks]
+        })
+    write_plan(args.emit_plan, plan)
+    print ("Restore plan for " + str(len(disk_groups)) + " VM/CTs written to " + args.emit_plan)
+    print ("Actions per disk: " + "/".join(actions) + ". Run it with --plan " + args.emit_plan)
+
+#Local datasets and snapshots (dataset@snapname) of the given destinations, from one listing. Destinations which don't exist are missing
+def list_destinations(destinations):
+    if len(destinations) == 0:
+        return set()
+    return set([name for name, in Zfs_Listing(None, sorted(destinations), types="filesystem,volume,snapshot", depth=1)])
+
+#Check a plan against the scanned remote side and the local destinations which are rolled back or kept. All errors are collected,
+#so a plan can be fixed in one go. Returns the list of errors
+def validate_plan(args, plan, disk_groups, remote_data):
+    errors = []
+    local = list_destinations(set([disk.get("destination") for guest in plan.get("guests", []) for disk in guest.get("disks", [])
+                                   if disk.get("action") in ["rollback", "keep"] and isinstance(disk.get("destination"), str) and disk.get("destination") != ""]))
+    for key in ["hostname", "zfs_source_pool", "backupname", "config_path"]:
+        if plan.get(key) != getattr(args, key):
+            errors.append("Plan was made for --" + key.replace('_', '-') + " " + str(plan.get(key)) + ", not " + str(getattr(args, key)))
+    groups = dict([(group.id, group) for group in disk_groups])
+    for guest in plan.get("guests", []):
+        id = str(guest.get("id"))
+        if not id in groups:
+            errors.append("VM/CT " + id + ": no disks with snapshots of " + args.backupname + " found")
+            continue
+        if not guest.get("config") in remote_data["config_files"]:
+            errors.append("VM/CT " + id + ": config " + str(guest.get("config")) + " does not exist in " + args.config_path)
+        disks = dict([(disk.full_name, disk) for disk in groups[id].disks])
+        planned = guest.get("disks", [])
+        restored = [disk for disk in planned if disk.get("action") == "restore"]
+        for disk in planned:
+            source = disk.get("source")
+            if not source in disks:
+                errors.append("VM/CT " + id + ": disk " + str(source) + " not found")
+                continue
+            if not disk.get("action") in actions:
+                errors.append("VM/CT " + id + ": unknown action " + str(disk.get("action")) + " for " + source + ", use " + "/".join(actions))
+            if not disk.get("snapshot") in remote_data["snapshots"].get(source, []):
+                errors.append("VM/CT " + id + ": snapshot " + source + "@" + str(disk.get("snapshot")) + " does not exist")
+            if not disk.get("destination"):
+                errors.append("VM/CT " + id + ": no destination for " + source)
+            elif disk.get("action") in ["rollback", "keep"] and not disk.get("destination") in local:
+                errors.append("VM/CT " + id + ": destination " + str(disk.get("destination")) + " of " + source + " does not exist, it can't be " + ("rolled back" if disk.get("action") == "rollback" else "kept"))
+            elif disk.get("action") == "rollback" and not str(disk.get("destination")) + "@" + str(disk.get("snapshot")) in local:
+                errors.append("VM/CT " + id + ": snapshot " + str(disk.get("destination")) + "@" + str(disk.get("snapshot")) + " does not exist, can't roll back to it")
+            if len(restored) > 0 and disk.get("action") == "skip":
+                errors.append("VM/CT " + id + ": " + source + " has to be rolled back or kept, other disks of the VM/CT are restored")
+    return errors
+
+#Load a plan, validate it and turn it into Disk_Groups for restore(), without asking anything. Exits if the plan is invalid
+def load_restore_plan(args):
+    plan = read_plan(args.plan)
+    disk_groups, remote_data = scan_restore_data(args)
+    errors = validate_plan(args, plan, disk_groups, remote_data)
+    if len(errors) > 0:
+        for error in errors:
+            log ("Plan error: " + error)
+        log ("Plan " + args.plan + " has " + str(len(errors)) + " errors, nothing was done")
+        sys.exit(1)
+
+    groups = dict([(group.id, group) for group in disk_groups])
+    planned_groups = []
+    for guest in plan.get("guests", []):
+        group = groups[str(guest["id"])]
+        group.last_config = guest["config"]
+        disks = dict([(disk.full_name, disk) for disk in group.disks])
+        group.disks = []
+        for planned in guest["disks"]:
+            disk = disks[planned["source"]]
+            disk.last_snapshot = disk.full_name + '@' + planned["snapshot"]
+            disk.destination = planned["destination"]
+            disk.restore = planned["action"] == "restore"
+            disk.rollback = planned["action"] == "rollback"
+            disk.keep = planned["action"] == "keep"
+            if planned["action"] != "skip":
+                group.disks.append(disk)
+        group.skip = len([disk for disk in group.disks if disk.restore]) == 0
+        planned_groups.append(group)
+        log ("VM/CT " + group.id + ": " + (", ".join([planned["action"] + " " + planned["source"] + "@" + planned["snapshot"] for planned in guest["disks"]]) if not group.skip else "skipped"))
+    return planned_groups
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+import datetime
+import re
+import shlex
+
+from pzm_common import execute_command, log, log_debug, ssh_command, is_local, list_directory, Zfs_Listing
+from pzm_replicate import snapshotTimeformat, defaultConfigPath, is_backup_snapshot
+from pzm_remote import get_agent
+from pzm_locking import lock, unlock
+from pzm_config_store import read_index, remove_entries, parse_config_name
+
+#Periods of a retention policy and the key of the period a snapshot time falls in. A policy keeps the newest snapshot of the newest n periods
+periods = {
+    "hourly": lambda time: time.strftime("%Y-%m-%d %H"),
+    "daily": lambda time: time.strftime("%Y-%m-%d"),
+    "weekly": lambda time: "%d-%02d" % time.isocalendar()[0:2],
+    "monthly": lambda time: time.strftime("%Y-%m"),
+    "yearly": lambda time: time.strftime("%Y"),
+}
+#At most this many characters of destroy commands are sent in one remote command
+maxCommandLength = 65536
+
+
+#Parse a policy like "last=4,hourly=24,daily=7,weekly=4,monthly=12,yearly=2" into period -> count. "last" keeps the newest n snapshots
+def parse_policy(keep):
+    policy = {}
+    for rule in keep.split(','):
+        if not '=' in rule:
+            raise ValueError("Invalid retention rule \"" + rule + "\", use period=count")
+        period, count = rule.split('=', 1)
+        if period != "last" and not period in periods:
+            raise ValueError("Unknown retention period \"" + period + "\", use last, " + ", ".join(periods.keys()))
+        policy[period] = int(count)
+    return policy
+
+#Time of a backup snapshot from its name (rep_<backupname>_<timestamp>)
+def snapshot_time(snapname):
+    return datetime.datetime.strptime(snapname.rsplit('_', 2)[-2] + '_' + snapname.rsplit('_', 1)[-1], snapshotTimeformat)
+
+#Snapshot names (oldest first) of one dataset which the policy keeps. The newest snapshot is always kept, it is the base of the next incremental
+def select_snapshots(snapnames, policy):
+    keep = set()
+    newest_first = list(reversed(snapnames))
+    if len(newest_first) > 0:
+        keep.add(newest_first[0])
+    keep.update(newest_first[:policy.get("last", 0)])
+    for period, key in periods.items():
+        count = policy.get(period, 0)
+        seen = set()
+        for snapname in newest_first:
+            if len(seen) >= count:
+                break
+            bucket = key(snapshot_time(snapname))
+            if not bucket in seen:
+                seen.add(bucket)
+                keep.add(snapname)
+    return [snapname for snapname in snapnames if snapname in keep]
+
+#The VM/CT id a disk dataset belongs to (vm-100-disk-0, subvol-100-disk-0, basevol-100-disk-0), None for other datasets
+def dataset_vmid(dataset):
+    match = re.search(r'(basevol|subvol|vm)-(\d+)-disk-\d+$', dataset)
+    return match.group(2) if match is not None else None
+
+#Compute what the policy destroys on a target, from one listing of all snapshots below zfspool. Only the disks of vmids are pruned,
+#other nodes may push their VM/CTs below the same zfspool with the same backupname. vmids None prunes every dataset of the target.
+#Returns dataset -> snapshot names to destroy (oldest first) and vmid -> snapshot names which are gone from all disks of that vmid
+def plan_retention(hostname, zfspool, backupname, policy, vmids=None):
+    inventory = {}
+    listing = Zfs_Listing(hostname, [zfspool], types="snapshot", sort="createtxg")
+    for name, in listing:
+        dataset, unused, snapname = name.partition('@')
+        if vmids is not None and not dataset_vmid(dataset) in vmids:
+            continue
+        if is_backup_snapshot(snapname, backupname):
+            inventory.setdefault(dataset, []).append(snapname)
+    if listing.returncode != 0:
+        log ("Could not list snapshots of " + hostname + ":" + zfspool + ": " + listing.stderr)
+        return None, None
+    to_destroy = {}
+    kept_by_vmid = {}
+    destroyed_by_vmid = {}
+    for dataset, snapnames in inventory.items():
+        keep = select_snapshots(snapnames, policy)
+        destroy = [snapname for snapname in snapnames if not snapname in keep]
+        if len(destroy) > 0:
+            to_destroy[dataset] = destroy
+        vmid = dataset_vmid(dataset)
+        if vmid is not None:
+            kept_by_vmid.setdefault(vmid, set()).update(keep)
+            destroyed_by_vmid.setdefault(vmid, set()).update(destroy)
+    gone = {}
+    for vmid, destroyed in destroyed_by_vmid.items():
+        gone[vmid] = destroyed - kept_by_vmid[vmid]
+    return to_destroy, gone
+
+#Run the destroys on the target, as few remote commands as possible: one agent batch, or shell scripts of up to maxCommandLength
+#characters with one "zfs destroy dataset@a,b,c" per dataset. Returns the number of commands which failed
+def run_destroys(hostname, to_destroy, remove_files):
+    commands = []
+    agent = get_agent(hostname)
+    results = None
+    if agent is not None:
+        results = agent.request([{"op": "destroy", "dataset": dataset, "snapshots": snapnames} for dataset, snapnames in to_destroy.items()])
+    failed = 0
+    if results is not None:
+        failed = len([result for result in results if not result["ok"]])
+    else:
+        commands = ['zfs destroy ' + shlex.quote(dataset + '@' + ','.join(snapnames)) for dataset, snapnames in to_destroy.items()]
+    if len(remove_files) > 0:
+        commands.append('rm -f ' + ' '.join([shlex.quote(path) for path in remove_files]))
+    scripts = []
+    for command in commands:
+        if len(scripts) > 0 and sum([len(element) for element in scripts[-1]]) + len(command) < maxCommandLength:
+            scripts[-1].append(command)
+        else:
+            scripts.append([command])
+    for script in scripts:
+        #Every command of the script runs, even if one fails. The returncode is the number of failed commands
+        script = 'failed=0; ' + ''.join([command + ' || failed=$((failed+1)); ' for command in script]) + 'exit $failed'
+        if is_local(hostname):
+            command = ['sh', '-c', script]
+        else:
+            command = ssh_command(hostname, ['sh', '-c', shlex.quote(script)]) #ssh passes the command through the remote shell
+        rc, stdout, stderr, pid = execute_command(command)
+        if rc != 0:
+            log ("Pruning on " + hostname + " failed: " + stderr)
+            failed = failed + (rc if rc > 0 else 1)
+    return failed
+
+#Apply the retention policy of a backupname to the disks of vmids below zfspool on hostname (all datasets if vmids is None), and remove
+#the config files of snapshots which are gone from all disks of their VM/CT. Returns a summary for the log
+def prune_target(hostname, zfspool, backupname, policy, dest_config_path=None, vmids=None):
+    config_path = dest_config_path if dest_config_path is not None else defaultConfigPath
+    to_destroy, gone = plan_retention(hostname, zfspool, backupname, policy, vmids)
+    if to_destroy is None:
+        return "Retention failed, could not list snapshots"
+    snapshot_count = sum([len(snapnames) for snapnames in to_destroy.values()])
+    if snapshot_count == 0:
+        return "Retention: nothing to destroy"
+    remove_files = []
+    rc, config_files, stderr = list_directory(hostname, config_path)
+    if rc == 0:
+        for config_file in config_files:
+            parts = config_file.split('.', 3) #<vmid>.conf.<type>.<snapname>
+            if len(parts) == 4 and parts[1] == "conf" and parts[3] in gone.get(parts[0], set()):
+                remove_files.append(config_path.rstrip('/') + '/' + config_file)
+    store_entries = [] #The same configs in the config store, if there is one
+    for name in read_index(hostname, config_path).keys():
+        parsed = parse_config_name(name)
+        if parsed is not None and parsed[2] in gone.get(parsed[0], set()):
+            store_entries.append(name)
+    for dataset, snapnames in to_destroy.items():
+        log_debug ("Retention: destroying " + str(len(snapnames)) + " snapshots of " + dataset)
+    failed = run_destroys(hostname, to_destroy, remove_files)
+    removed = remove_entries(hostname, config_path, store_entries)
+    return "Retention: destroyed " + str(snapshot_count) + " snapshots of " + str(len(to_destroy)) + " datasets and " + str(len(remove_files) + removed) + " configs" + (", " + str(failed) + " commands failed" if failed > 0 else "")
+
+#Remove the configs of a backupname from the config store whose snapshot is gone from all disks of their VM/CT, e.g. pruned by pve-zsync
+#with --maxsnap. One listing of all snapshots below zfspool. The unused blobs are left to collect_garbage. Returns the number of removed configs
+def prune_config_store(hostname, zfspool, backupname, config_path):
+    index = read_index(hostname, config_path)
+    if len(index) == 0:
+        return 0
+    existing = {} #vmid -> snapshot names of this backupname on any of its disks
+    listing = Zfs_Listing(hostname, [zfspool], types="snapshot")
+    for name, in listing:
+        dataset, unused, snapname = name.partition('@')
+        vmid = dataset_vmid(dataset)
+        if vmid is not None and is_backup_snapshot(snapname, backupname):
+            existing.setdefault(vmid, set()).add(snapname)
+    if listing.returncode != 0:
+        log ("Could not list snapshots of " + hostname + ":" + zfspool + ", config store not pruned: " + listing.stderr)
+        return 0
+    stale = []
+    for name in index.keys():
+        parsed = parse_config_name(name)
+        if parsed is not None and is_backup_snapshot(parsed[2], backupname) and not parsed[2] in existing.get(parsed[0], set()):
+            stale.append(name)
+    return remove_entries(hostname, config_path, stale, collect=False)
+
+#Entry point of the "prune" command
+def prune(args):
+    try:
+        policy = parse_policy(args.keep)
+    except ValueError as e:
+        print (str(e))
+        return
+    vmids = None if args.ids == "all" else set(args.ids.split(','))
+    lock(args.hostname)
+    log (prune_target(args.hostname, args.zfspool, args.backupname, policy, args.dest_config_path, vmids))
+    unlock(args.hostname)
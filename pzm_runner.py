@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+import asyncio
+import os
+import signal
+
+#How often running commands are checked for their timeout and progress, in seconds
+checkInterval = 5
+
+
+#Sum of read and written bytes (rchar + wchar from /proc/<pid>/io) of all processes in the given process groups.
+#Children (e.g. zfs send and ssh started by pve-zsync) are in the process group of the command which started them
+def group_io(pgids):
+    total = 0
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/' + entry + '/stat', 'r') as statfile:
+                pgrp = int(statfile.read().rsplit(')', 1)[1].split()[2])
+            if pgrp not in pgids:
+                continue
+            with open('/proc/' + entry + '/io', 'r') as iofile:
+                for line in iofile:
+                    if line.startswith('rchar:') or line.startswith('wchar:'):
+                        total = total + int(line.split(':')[1])
+        except (OSError, ValueError, IndexError):
+            continue #Process exited in between
+    return total
+
+#Kill all given process groups, including everything the commands started
+def kill_groups(pgids):
+    for pgid in pgids:
+        try:
+            os.killpg(pgid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+#Read a stream until EOF. Every read counts as progress for the stall watchdog.
+#chunks is a list, or a capped output (pzm_logs.Capped_Output) which is also written to the output_log
+async def read_stream(stream, chunks, progress, output_log=None):
+    while True:
+        data = await stream.read(65536)
+        if not data:
+            break
+        if output_log is not None:
+            output_log.write(data)
+            chunks.write(data)
+        else:
+            chunks.append(data)
+        progress[0] = progress[0] + len(data)
+
+#Run commands as a pipeline (stdout of one is stdin of the next), each in its own process group.
+#timeout: kill everything after this many seconds. stall_timeout: kill everything if there was no progress for this many seconds.
+#Progress is any output, or any read/write of a process in the pipeline (or one of its children), so silent transfers aren't killed.
+#A killed pipeline returns a non zero returncode and the reason in stderr. If the caller is cancelled (e.g. Ctrl+C), everything is killed too.
+#With an output_log (pzm_logs.Capped_Output) the output is streamed to it, and only its capped head and tail are kept in memory.
+#Returns returncode (first non zero one, like "set -o pipefail"), stdout, stderr and pid of the first command
+async def run_pipeline(commands, input=None, shell=False, timeout=None, stall_timeout=None, output_log=None):
+    processes = []
+    readers = []
+    stdout_chunks = output_log.buffer() if output_log is not None else []
+    stderr_chunks = []
+    progress = [0]
+    previous_read = None
+    reason = None
+    try:
+        for index, command in enumerate(commands):
+            last = index == len(commands) - 1
+            write_fd = None
+            if not last:
+                read_fd, write_fd = os.pipe()
+            if previous_read is not None:
+                stdin = previous_read
+            else:
+                stdin = asyncio.subprocess.PIPE if input is not None else None
+            stdout = asyncio.subprocess.PIPE if last else write_fd
+            if shell:
+                process = await asyncio.create_subprocess_shell(" ".join(command), stdin=stdin, stdout=stdout, stderr=asyncio.subprocess.PIPE, start_new_session=True)
+            else:
+                process = await asyncio.create_subprocess_exec(*command, stdin=stdin, stdout=stdout, stderr=asyncio.subprocess.PIPE, start_new_session=True)
+            if previous_read is not None:
+                os.close(previous_read) #Only the new process reads from it now
+                previous_read = None
+            if write_fd is not None:
+                os.close(write_fd)
+                previous_read = read_fd
+            processes.append(process)
+            stderr_chunks.append(output_log.buffer() if output_log is not None else [])
+            readers.append(asyncio.ensure_future(read_stream(process.stderr, stderr_chunks[-1], progress, output_log)))
+        readers.append(asyncio.ensure_future(read_stream(processes[-1].stdout, stdout_chunks, progress, output_log)))
+        if input is not None:
+            processes[0].stdin.write(input)
+            await processes[0].stdin.drain()
+            processes[0].stdin.close()
+
+        pgids = [process.pid for process in processes]
+        waiter = asyncio.ensure_future(asyncio.gather(*([process.wait() for process in processes] + readers)))
+        loop = asyncio.get_event_loop()
+        starttime = last_progress_time = loop.time()
+        last_counter = None
+        while not waiter.done():
+            await asyncio.wait([waiter], timeout=checkInterval)
+            if waiter.done():
+                break
+            now = loop.time()
+            if timeout is not None and now - starttime > timeout:
+                reason = "Killed after a timeout of " + str(timeout) + "s"
+            elif stall_timeout is not None:
+                counter = progress[0] + group_io(pgids)
+                if counter != last_counter:
+                    last_counter = counter
+                    last_progress_time = now
+                elif now - last_progress_time > stall_timeout:
+                    reason = "Killed, no progress for " + str(int(now - last_progress_time)) + "s"
+            if reason is not None:
+                kill_groups(pgids)
+                await waiter
+                break
+    except asyncio.CancelledError:
+        kill_groups([process.pid for process in processes])
+        raise
+    finally:
+        if previous_read is not None:
+            os.close(previous_read)
+
+    returncode = 0
+    for process in processes:
+        if returncode == 0 and process.returncode != 0:
+            returncode = process.returncode
+    if output_log is not None:
+        stderr = "".join([chunks.text() for chunks in stderr_chunks])
+        stdout = stdout_chunks.text()
+    else:
+        stderr = b"".join([b"".join(chunks) for chunks in stderr_chunks]).decode("utf-8", "replace")
+        stdout = b"".join(stdout_chunks).decode("utf-8", "replace")
+    if reason is not None:
+        stderr = stderr + reason + "\n"
+        if output_log is not None:
+            output_log.write((reason + "\n").encode("utf-8"))
+        if returncode == 0:
+            returncode = -signal.SIGKILL
+    return returncode, stdout, stderr, processes[0].pid
+
+#Blocking wrapper for run_pipeline
+def run_commands(commands, input=None, shell=False, timeout=None, stall_timeout=None, output_log=None):
+    return asyncio.run(run_pipeline(commands, input, shell, timeout, stall_timeout, output_log))
+
+#Run many independent commands concurrently from one thread, at most limit at the same time. Returns the results in the order of the commands
+def run_concurrently(commands, limit=8, timeout=None):
+    async def run_all():
+        semaphore = asyncio.Semaphore(limit)
+        async def run_one(command):
+            async with semaphore:
+                return await run_pipeline([command], timeout=timeout)
+        return await asyncio.gather(*[run_one(command) for command in commands])
+    return asyncio.run(run_all())
@@ -1,21 +1,12 @@
 import time
 import datetime
 import os
+import sys
 
 import pzm_common
-from pzm_common import execute_readonly_command, execute_command, log, log_debug, get_ids
-
-#get the lastest snapshot of dataset, or zvol
-def get_latest_snapshot(dataset_name, backupname):
-    rc, stdout, stderr = execute_readonly_command(['zfs', 'list', '-t', 'snapshot', '-H', '-o', 'name', dataset_name, '-S', 'creation'])
-    stdout = stdout.split('\n')
-    for x in set(stdout).intersection(pzm_common.considered_empty):
-        stdout.remove(x)
-    snaps = [element for element in stdout if(backupname in element)]
-    if len(snaps) > 0:
-        last = snaps[0]
-        return last
-    return None
+from pzm_common import execute_readonly_command, execute_command, log, log_debug, get_ids, on_host
+from pzm_replicate import get_snapshot_chains, find_common_snapshot
+from pzm_remote import get_agent
 
 #get CT/VM configdata from dataset
 def parse_dataset(type, id):
@@ -47,6 +38,28 @@ def parse_dataset(type, id):
     return datasets
 
 
+#Compares the snapshot chain of a local disk with the chain of its remote copy by guid, so renamed snapshots or snapshots of another backupname are found too.
+#Logs the newest common snapshot and the incremental which is possible from it.
+#Returns the common snapshot of both sides (None, None if there is none) and the remote snapshots which are newer than the common one
+def analyse_divergence(dataset, local_chain, remote_dataset, remote_chain):
+    local_common, remote_common = find_common_snapshot(local_chain, remote_chain)
+    if local_common is None:
+        log ("Disk " + dataset + ": no common snapshot with " + remote_dataset + ", only a full send is possible")
+        return None, None, []
+    remote_newer = [snapshot for snapshot in remote_chain if snapshot.createtxg > remote_common.createtxg]
+    local_newer = [snapshot for snapshot in local_chain if snapshot.createtxg > local_common.createtxg]
+    common_text = local_common.name
+    if local_common.name != remote_common.name:
+        common_text = common_text + " (remote name: " + remote_common.name + ")"
+    log ("Disk " + dataset + ": newest common snapshot with " + remote_dataset + " is " + common_text)
+    if len(remote_newer) > 0:
+        log ("Disk " + dataset + ": remote has " + str(len(remote_newer)) + " newer snapshot(s) which are not on the local side, rollback to " + remote_common.name + " needed")
+    if len(local_newer) > 0:
+        log ("Disk " + dataset + ": incremental possible from " + local_common.name + " to " + local_newer[-1].name)
+    else:
+        log ("Disk " + dataset + ": remote is up to date")
+    return local_common, remote_common, remote_newer
+
 #Main method for sanitzing (aka synchronizing) the local snapshot with the remote snapshot.
 #This is usually needed if a backup fails, and will be executed autmatically, if the retries parameter is non 0
 def sanitize(args):
@@ -84,35 +97,52 @@ def sanitize(args):
     log_debug (disks)
     log_debug ("Count: " + str(len(disks)))
 
+    #The remote copy is either <zfspool>/<disk> or, with pve-zsync's "prepend-storage-id", <zfspool>/<pve-storage-id>/<disk>
+    local_datasets = [disk.split(':')[1] for disk in disks]
+    remote_candidates = {}
+    for disk in disks:
+        remote_candidates[disk] = [args.zfspool + '/' + disk.split(':')[1].split('/')[-1], args.zfspool + '/' + disk.split(':')[0] + '/' + disk.split(':')[1].split('/')[-1]]
+    local_chains = get_snapshot_chains(None, local_datasets)
+    remote_chains = get_snapshot_chains(args.hostname, [candidate for candidates in remote_candidates.values() for candidate in candidates])
+
+    #Rollbacks and renames are collected first, so they can be done in one batch by the remote agent
+    changes = []
     for disk in disks:
-        latest_snap = get_latest_snapshot(disk.split(':')[1], args.backupname)
-        if latest_snap is not None:
-            rollback_to = args.zfspool + '/' + latest_snap.split('/')[-1]
-            rc, stdout, stderr = execute_readonly_command(['ssh', '-o', 'BatchMode yes', 'root@' + args.hostname, 'zfs', 'list', '-t', 'snapshot', '-H', '-o', 'name', rollback_to.split('@')[0]])
-            #No need to check for return code, as it will be skipped in case of error
-            if stdout != "":
-                stdout = stdout.split('\n')
-                for x in set(stdout).intersection(pzm_common.considered_empty):
-                    stdout.remove(x)
-                if rollback_to in stdout:
-                    if stdout.index(rollback_to) < len(stdout)-1:
-                        rc, stdout, stderr, pid = execute_command(['ssh', '-o', 'BatchMode yes', 'root@' + args.hostname, 'zfs', 'rollback', '-r', rollback_to])
-                        if stdout != "" or stderr != "":
-                            log (stdout)
-                            log (stderr)
-            else: #Add pve-zsync 2.1-1 function "prepend-storage-id" - if it can't find a backup with <zfs-destination-pool>/disk it tries with <zfs-destination-pool>/<pve-storage-id>/disk
-                rollback_to = args.zfspool + '/' + disk.split(':')[0]  + '/' + latest_snap.split('/')[-1] #prepend-storage-id adds the pve storage id between the destination pool and the dataset"
+        dataset = disk.split(':')[1]
+        remote_dataset = None
+        for candidate in remote_candidates[disk]:
+            if candidate in remote_chains:
+                remote_dataset = candidate
+                break
+        if remote_dataset is None:
+            log_debug ("No snapshots of " + dataset + " found on " + args.hostname)
+            continue
+        local_common, remote_common, remote_newer = analyse_divergence(dataset, local_chains.get(dataset, []), remote_dataset, remote_chains[remote_dataset])
+        if local_common is None or getattr(args, 'report', False):
+            continue
+        if len(remote_newer) > 0:
+            changes.append({"op": "rollback", "snapshot": remote_dataset + '@' + remote_common.name})
+        #pve-zsync finds its incremental base by name, so the remote snapshot gets the local name, if it isn't taken already
+        if local_common.name != remote_common.name and not local_common.name in [snapshot.name for snapshot in remote_chains[remote_dataset]]:
+            log ("Renaming " + remote_dataset + "@" + remote_common.name + " to " + local_common.name)
+            changes.append({"op": "rename", "source": remote_dataset + '@' + remote_common.name, "destination": remote_dataset + '@' + local_common.name})
 
-                #The rest is the same as without prepend-storage-id
-                rc, stdout, stderr = execute_readonly_command(['ssh', '-o', 'BatchMode yes', 'root@' + args.hostname, 'zfs', 'list', '-t', 'snapshot', '-H', '-o', 'name', rollback_to.split('@')[0]])
-                #No need to check for return code, as it will be skipped in case of error
-                if stdout != "":
-                    stdout = stdout.split('\n')
-                    for x in set(stdout).intersection(pzm_common.considered_empty):
-                        stdout.remove(x)
-                    if rollback_to in stdout:
-                        if stdout.index(rollback_to) < len(stdout)-1:
-                            rc, stdout, stderr, pid = execute_command(['ssh', '-o', 'BatchMode yes', 'root@' + args.hostname, 'zfs', 'rollback', '-r', rollback_to])
-                            if stdout != "" or stderr != "":
-                                log (stdout)
-                                log (stderr)
+    if len(changes) == 0:
+        return
+    results = None
+    agent = get_agent(args.hostname)
+    if agent is not None:
+        results = agent.request(changes)
+    if results is not None:
+        for result in results:
+            if not result["ok"]:
+                log (result["error"])
+        return
+    for change in changes:
+        if change["op"] == "rollback":
+            rc, stdout, stderr, pid = execute_command(on_host(args.hostname, ['zfs', 'rollback', '-r', change["snapshot"]]))
+        else:
+            rc, stdout, stderr, pid = execute_command(on_host(args.hostname, ['zfs', 'rename', change["source"], change["destination"]]))
+        if stdout != "" or stderr != "":
+            log (stdout)
+            log (stderr)
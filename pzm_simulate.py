@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import re
+import sys
+from json.decoder import JSONDecodeError
+
+import pzm_common
+from pzm_common import format_duration
+from pzm_sync import source_of
+
+#Units of the sizes in the status file (estimated send sizes of zfs send -v)
+sizeUnits = {"B": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+#Seconds a sync waits before a retry
+retryWait = 30
+#Remaining work below this is done, against rounding errors
+epsilon = 1e-6
+
+
+#Seconds of a duration in the status file (str of a timedelta, e.g. "1 day, 2:03:04.5")
+def parse_duration(duration):
+    match = re.match(r'^(?:(\d+) days?, )?(\d+):(\d+):(\d+(?:\.\d+)?)$', duration.strip())
+    if match is None:
+        return None
+    return int(match.group(1) or 0) * 86400 + int(match.group(2)) * 3600 + int(match.group(3)) * 60 + float(match.group(4))
+
+#Bytes of a size in the status file, the estimated sizes of all disks separated with commas (e.g. "12.5G,300M"). None if unknown
+def parse_size(size):
+    total = 0
+    for part in size.split(','):
+        match = re.match(r'^(\d+(?:\.\d+)?)(B|K|M|G|T)$', part.strip())
+        if match is None:
+            return None
+        total = total + float(match.group(1)) * sizeUnits[match.group(2)]
+    return total
+
+#Recorded guests of the status file, by backupname (one backupname is one target). Every guest is a dict with id, duration (seconds),
+#bytes (None if unknown), attempts and failed. Also returns the recorded duration of the last run of every backupname
+def load_recorded(statusfile, backupnames):
+    with open(statusfile, 'r') as jsonFile:
+        try:
+            data = json.load(jsonFile)
+        except JSONDecodeError:
+            data = {}
+    targets = {}
+    recorded = {}
+    for entry in data.values():
+        if backupnames is not None and not entry['backupname'] in backupnames:
+            continue
+        duration = parse_duration(entry['duration']) if entry.get('duration') not in [None, "-"] else None
+        if entry['id'] == "all" or entry['id'].endswith(":all"):
+            if entry['id'] == "all" and duration is not None:
+                recorded[entry['backupname']] = duration
+            continue
+        if duration is None:
+            continue #Never finished, e.g. still syncing
+        retries = re.search(r'Needed (\d+) additional retries', entry.get('info', ""))
+        targets.setdefault(entry['backupname'], []).append({
+            "id": entry['id'],
+            "duration": duration,
+            "bytes": parse_size(entry['size']) if entry.get('size') not in [None, "-"] else None,
+            "attempts": 1 + (int(retries.group(1)) if retries is not None else 0),
+            "failed": entry['status'] == "error"
+        })
+    return targets, recorded
+
+#One guest in the model. Its attempts are a list of phases: ("wait", seconds) before a retry and ("transfer", work).
+#The work of a transfer is bytes at the recorded rate, or seconds if the size is unknown (not limited by the bandwidth).
+#The recorded duration spans all attempts and the waits between them, one attempt took (duration - waits) / attempts
+class Sim_Guest:
+    def __init__(self, guest, retries, retry_cost):
+        self.id = guest["id"]
+        self.bytes = guest["bytes"]
+        attempts = guest["attempts"]
+        attempt_duration = max(guest["duration"] - (attempts - 1) * retryWait, 0) / attempts
+        self.rate = guest["bytes"] / attempt_duration if guest["bytes"] and attempt_duration > 0 else None
+        work = guest["bytes"] if self.rate is not None else attempt_duration
+        if guest["failed"]:
+            attempts = 1 + (retries if retries is not None else 0) #A failed guest fails in every attempt
+        elif retries is not None:
+            attempts = min(attempts, 1 + retries)
+        self.phases = [("transfer", work)]
+        for attempt in range(attempts - 1):
+            self.phases += [("wait", retryWait), ("transfer", work * retry_cost)]
+        self.start = None
+        self.end = None
+
+    #Phase which is running now and its remaining work
+    def current(self):
+        return self.phases[0]
+
+    #Maximum speed of the running phase: the recorded rate for transfers in bytes, 1 (second per second) for everything else
+    def max_rate(self):
+        kind, work = self.phases[0]
+        if kind == "transfer" and self.rate is not None:
+            return self.rate
+        return 1.0
+
+    def limited(self):
+        kind, work = self.phases[0]
+        return kind == "transfer" and self.rate is not None
+
+
+#One target (backupname) in the model of backup(): lanes per source host, at most pull_lanes lanes at the same time, at most lane_limit
+#guests per lane and at most cap guests on the target. Limited transfers share bandwidth (bytes/s) fairly, none is faster than recorded
+class Sim_Target:
+    def __init__(self, name, guests, args):
+        self.name = name
+        self.cap = args.target_cap
+        self.bandwidth = args.bandwidth * 1024 * 1024 if args.bandwidth is not None else None
+        self.pull_lanes = args.pull_lanes
+        self.lane_limit = args.lane_limit
+        if args.order == "longest":
+            guests = sorted(guests, key=lambda guest: -guest.phases[0][1] / guest.max_rate())
+        else:
+            guests = sorted(guests, key=lambda guest: guest.id)
+        self.guests = guests
+        self.lanes = {}
+        for guest in guests:
+            self.lanes.setdefault(source_of(guest.id), []).append(guest)
+        self.waiting_lanes = list(self.lanes.keys())
+        self.active_lanes = []
+        self.lane_running = {}
+        self.running = []
+        self.busy = 0.0 #Guest-seconds of running guests
+        self.transferred = 0.0
+        self.end = 0.0
+
+    #Start what the limits allow
+    def schedule(self, now):
+        while len(self.waiting_lanes) > 0 and (self.pull_lanes is None or len(self.active_lanes) < self.pull_lanes):
+            lane = self.waiting_lanes.pop(0)
+            self.active_lanes.append(lane)
+            self.lane_running[lane] = 0
+        for lane in self.active_lanes:
+            while len(self.lanes[lane]) > 0 and self.lane_running[lane] < self.lane_limit and (self.cap is None or len(self.running) < self.cap):
+                guest = self.lanes[lane].pop(0)
+                guest.start = now
+                self.running.append(guest)
+                self.lane_running[lane] = self.lane_running[lane] + 1
+
+    #Current speed of every running guest
+    def rates(self):
+        rates = {}
+        limited = [guest for guest in self.running if guest.limited()]
+        for guest in self.running:
+            if not guest.limited() or self.bandwidth is None:
+                rates[guest] = guest.max_rate()
+        if self.bandwidth is not None:
+            left = self.bandwidth
+            limited.sort(key=lambda guest: guest.max_rate())
+            for index, guest in enumerate(limited):
+                rates[guest] = min(guest.max_rate(), left / (len(limited) - index))
+                left = left - rates[guest]
+        return rates
+
+    #Advance the running guests by dt seconds
+    def advance(self, dt, rates, now):
+        self.busy = self.busy + len(self.running) * dt
+        for guest in list(self.running):
+            kind, work = guest.current()
+            done = rates[guest] * dt
+            if guest.limited():
+                self.transferred = self.transferred + done
+            if work - done > epsilon * max(rates[guest], 1.0):
+                guest.phases[0] = (kind, work - done)
+                continue
+            guest.phases.pop(0)
+            if len(guest.phases) == 0:
+                guest.end = now
+                self.end = now
+                self.running.remove(guest)
+                lane = source_of(guest.id)
+                self.lane_running[lane] = self.lane_running[lane] - 1
+                if len(self.lanes[lane]) == 0 and self.lane_running[lane] == 0:
+                    self.active_lanes.remove(lane)
+
+    def finished(self):
+        return len(self.running) == 0 and len(self.waiting_lanes) == 0 and len(self.active_lanes) == 0
+
+#Run all targets at the same time (like their cron jobs starting together) until every guest is done, from event to event:
+#the next event is the earliest end of a running phase at the current speeds
+def run_simulation(targets):
+    now = 0.0
+    for target in targets:
+        target.schedule(now)
+    while len([target for target in targets if not target.finished()]) > 0:
+        rates = dict([(target, target.rates()) for target in targets])
+        dt = None
+        for target in targets:
+            for guest in target.running:
+                if rates[target][guest] > 0:
+                    remaining = guest.current()[1] / rates[target][guest]
+                    dt = remaining if dt is None else min(dt, remaining)
+        if dt is None:
+            stuck = [target.name for target in targets if not target.finished()]
+            print ("Simulation stuck at " + format_duration(now) + " for " + ", ".join(stuck) + ", check --target-cap, --lane-limit and --pull-lanes")
+            sys.exit(1)
+        now = now + dt
+        for target in targets:
+            target.advance(dt, rates[target], now)
+            target.schedule(now)
+    return now
+
+#Entry point of the "simulate" command. Replays the durations and sizes of the status file through a model of backup() with the given limits.
+#Nothing is executed, everything is offline
+def simulate(args):
+    statusfile = args.status_file if args.status_file is not None else pzm_common.statusJsonFile
+    if not os.path.exists(statusfile):
+        print ("No status file " + statusfile + ", nothing recorded to simulate")
+        sys.exit(1)
+    backupnames = args.backupname.split(',') if args.backupname is not None else None
+    recorded_guests, recorded = load_recorded(statusfile, backupnames)
+    if len(recorded_guests) == 0:
+        print ("No recorded syncs in " + statusfile)
+        sys.exit(1)
+    targets = [Sim_Target(name, [Sim_Guest(guest, args.retries, args.retry_cost) for guest in guests], args) for name, guests in sorted(recorded_guests.items())]
+    makespan = run_simulation(targets)
+
+    print ("Model: " + (str(args.pull_lanes) if args.pull_lanes is not None else "all") + " lanes at the same time, " + str(args.lane_limit) + " guests per lane, "
+           + (str(args.target_cap) if args.target_cap is not None else "no") + " cap per target, " + (str(args.bandwidth) + "MB/s" if args.bandwidth is not None else "unlimited bandwidth") + " per target, "
+           + (str(args.retries) if args.retries is not None else "recorded") + " retries, order " + args.order)
+    print ("Predicted makespan: " + format_duration(makespan))
+    print ("")
+    format_row = "{:<30} {:<8} {:<12} {:<12} {:<12} {:<12}"
+    print (format_row.format("Target", "Guests", "Recorded", "Predicted", "Slots used", "Bandwidth"))
+    for target in targets:
+        slots = target.cap if target.cap is not None else len(target.guests)
+        slot_usage = "%.0f%%" % (100.0 * target.busy / (slots * target.end)) if target.end > 0 else "-"
+        bandwidth_usage = "%.0f%%" % (100.0 * target.transferred / (target.bandwidth * target.end)) if target.bandwidth is not None and target.end > 0 else "-"
+        print (format_row.format(target.name, len(target.guests), format_duration(recorded[target.name]) if target.name in recorded else "-", format_duration(target.end), slot_usage, bandwidth_usage))
+
+    if args.window is not None:
+        window = args.window * 60
+        late = [(target.name, guest) for target in targets for guest in target.guests if guest.end > window]
+        print ("")
+        if len(late) == 0:
+            print ("All guests finish within the window of " + format_duration(window))
+        else:
+            print (str(len(late)) + " guests miss the window of " + format_duration(window) + ":")
+            format_row = "{:<30} {:<20} {:<12} {:<12}"
+            print (format_row.format("Target", "VM/CT-ID", "Start", "End"))
+            for name, guest in sorted(late, key=lambda late_guest: late_guest[1].end):
+                print (format_row.format(name, guest.id, format_duration(guest.start), format_duration(guest.end)))
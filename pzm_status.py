@@ -3,7 +3,6 @@
 import pzm_common
 import os
 import json
-from prettytable import PrettyTable
 from json.decoder import JSONDecodeError
 
 
@@ -19,17 +18,26 @@ class bcolors:
     BOLD = '\033[1m'
     UNDERLINE = '\033[4m'
 
+#Result of the last verify run of a status entry
+def verified(data):
+    if data.get('verify_status') is None:
+        return "-"
+    return data['verify_status'] + " " + data['verify_time'] + ("" if data['verify_status'] == "ok" else ": " + data['verify_info'])
+
 #Read status from json status file. Either in fancy, human friendly manner (plain=False), or for automated reports, in plain text
-def read_from_json(plain):
-    if not os.path.exists(pzm_common.statusJsonFile):
-        os.mknod(pzm_common.statusJsonFile)
-    with open(pzm_common.statusJsonFile, "r") as jsonFile:
+#statusfile defaults to the status file of this node
+def read_from_json(plain, statusfile=None):
+    if statusfile is None:
+        statusfile = pzm_common.statusJsonFile
+    if not os.path.exists(statusfile):
+        os.mknod(statusfile)
+    with open(statusfile, "r") as jsonFile:
         try:
             readdata = json.load(jsonFile)
             readdataString = json.dumps(readdata, sort_keys=True)
             readdata = json.loads(readdataString)
             lines = []
-            headers=["VM/CT-ID", "Backupname", "Starttime", "Endtime", "Duration", "Size", "Status", "Additional Info"]
+            headers=["VM/CT-ID", "Backupname", "Starttime", "Endtime", "Duration", "Size", "Status", "Additional Info", "Verified"]
             empty_line = []
             for header in headers:
                 empty_line.append("")
@@ -56,9 +64,10 @@ def read_from_json(plain):
                             line.append("")
                         line.append(data['status'])
                         line.append(data['info'])
+                        line.append(verified(data))
                         lines.append(line)
                     lines.append(empty_line)
-                format_row = "{:<10} {:<22} {:<21} {:<21} {:<16} {:<8} {:<8} {:<30}"
+                format_row = "{:<10} {:<22} {:<21} {:<21} {:<16} {:<8} {:<8} {:<30} {:<30}"
                 print (format_row.format(*headers))
                 lines.pop() # remove last item - empty line
 
@@ -66,6 +75,7 @@ def read_from_json(plain):
                     print(format_row.format(*line))
 
             else:
+                from prettytable import PrettyTable #Only needed for the table, --plain (monitoring) starts faster without it
                 for i in range(len(headers)):
                     headers[i] = bcolors.HEADER + headers[i] + bcolors.ENDC
 
@@ -73,14 +83,16 @@ def read_from_json(plain):
 
                 for name, data in sorted.items():
                     for name, data in data.items():
-                        table.add_row([(bcolors.BOLD if data['id'] == "all" else "") + data['id'] + (bcolors.ENDC if data['id'] == "all" else ""),
-                                       (bcolors.BOLD if data['id'] == "all" else "") + data['backupname'] + (bcolors.ENDC if data['id'] == "all" else ""),
-                                       (bcolors.BOLD if data['id'] == "all" else "") + data['starttime'] + (bcolors.ENDC if data['id'] == "all" else ""),
-                                       (bcolors.BOLD if data['id'] == "all" else "") + data['endtime'] + (bcolors.ENDC if data['id'] == "all" else ""),
-                                       (bcolors.BOLD if data['id'] == "all" else "") + data['duration'] + (bcolors.ENDC if data['id'] == "all" else ""),
-                                       (bcolors.BOLD if data['id'] == "all" else "") + data['size'] if data.get('size') is not None else "-" + (bcolors.ENDC if data['id'] == "all" else ""),
-                                       (bcolors.BOLD if data['id'] == "all" else "") + (bcolors.FAIL if data['status'] == "error" else bcolors.OKGREEN) + data['status'] + bcolors.ENDC + (bcolors.ENDC if data['id'] == "all" else ""),
-                                       (bcolors.BOLD if data['id'] == "all" else "") + data['info'] + (bcolors.ENDC if data['id'] == "all" else "")
+                        summary = data['id'].split('/')[-1] == "all" or data['id'].endswith(":all") #Summary of the run (of a node) or of one pull source
+                        table.add_row([(bcolors.BOLD if summary else "") + data['id'] + (bcolors.ENDC if summary else ""),
+                                       (bcolors.BOLD if summary else "") + data['backupname'] + (bcolors.ENDC if summary else ""),
+                                       (bcolors.BOLD if summary else "") + data['starttime'] + (bcolors.ENDC if summary else ""),
+                                       (bcolors.BOLD if summary else "") + data['endtime'] + (bcolors.ENDC if summary else ""),
+                                       (bcolors.BOLD if summary else "") + data['duration'] + (bcolors.ENDC if summary else ""),
+                                       (bcolors.BOLD if summary else "") + data['size'] if data.get('size') is not None else "-" + (bcolors.ENDC if summary else ""),
+                                       (bcolors.BOLD if summary else "") + (bcolors.FAIL if data['status'] == "error" else bcolors.OKGREEN) + data['status'] + bcolors.ENDC + (bcolors.ENDC if summary else ""),
+                                       (bcolors.BOLD if summary else "") + data['info'] + (bcolors.ENDC if summary else ""),
+                                       (bcolors.FAIL if data.get('verify_status') == "error" else "") + verified(data) + (bcolors.ENDC if data.get('verify_status') == "error" else "")
                                      ])
                     table.add_row(empty_line)
                 row_count = 0
@@ -6,89 +6,203 @@ import os
 import json
 import re
 import sys
+import threading
+import concurrent.futures
 from json.decoder import JSONDecodeError
 
 import pzm_common
-from pzm_common import execute_readonly_command, execute_command, check_zfs_pool, log, log_debug, get_ids
-from pzm_locking import lock, unlock
+from pzm_common import execute_readonly_command, execute_command, check_zfs_pool, log, log_debug, get_ids, parse_ids, is_local, set_output_log
+from pzm_locking import lock, unlock, held_by_coordinator
 from pzm_sanitize import sanitize
-
-#Where errorlogs are stored
-logpath = "/var/log/pve-zsync"
+from pzm_replicate import Replication_Job, defaultConfigPath
+from pzm_preflight import preflight
+from pzm_retention import parse_policy, prune_target, prune_config_store
+from pzm_config_store import import_flat_configs, collect_garbage
+from pzm_logs import logpath, open_log, remove_log, cleanup_logfolder
+from pzm_adaptive import select_due, record
+
+#Format of the times in the status file
+timeformat = "%d-%m-%Y_%H:%M:%S"
+#The status file is read, changed and written again. IDs of different lanes finish at the same time, so this is serialized
+statusLock = threading.Lock()
 
 #Removed CT/VM IDs which no longer exist from the status file.
 def cleanup_json(delete = ""):
-    if not os.path.exists(pzm_common.statusJsonFile):
-        os.mknod(pzm_common.statusJsonFile)
-    with open(pzm_common.statusJsonFile, "r") as jsonFile:
-        try:
-            data = json.load(jsonFile)
-        except JSONDecodeError:
-            data = {}
-            pass
-        vmids = get_ids("qm",[],[])
-        ctids = get_ids("pct",[],[])
-        ids = vmids + ctids
-        if delete != "":
-            ids.remove(delete)
-        newData = {}
-        for name, data in data.items():
-            if (data['id'] in ids) or (data['id'] == "all") or ':' in data['id']:
-                 newData[data['id'] + "_" + data['backupname']] = {
-                     'id': data['id'],
-                     'backupname': data['backupname'],
-                     'starttime': data['starttime'],
-                     'endtime': data['endtime'],
-                     'duration': data['duration'],
-                     'size': data['size'] if data.get('size') is not None else "-",
-                     'status': data['status'],
-                     'info': data['info']
-                 }
+    with statusLock:
+        if not os.path.exists(pzm_common.statusJsonFile):
+            os.mknod(pzm_common.statusJsonFile)
+        with open(pzm_common.statusJsonFile, "r") as jsonFile:
+            try:
+                data = json.load(jsonFile)
+            except JSONDecodeError:
+                data = {}
+                pass
+            vmids = get_ids("qm",[],[])
+            ctids = get_ids("pct",[],[])
+            ids = vmids + ctids
+            if delete != "":
+                ids.remove(delete)
+            newData = {}
+            for name, data in data.items():
+                if (data['id'] in ids) or (data['id'] == "all") or ':' in data['id']:
+                     newData[data['id'] + "_" + data['backupname']] = dict(data) #Keeps additional fields, e.g. of verify
+                     newData[data['id'] + "_" + data['backupname']]['size'] = data['size'] if data.get('size') is not None else "-"
+            with open(pzm_common.statusJsonFile, "w") as jsonFile:
+                json.dump(newData, jsonFile, indent=4)
+
+#Write status to json status file. extra holds additional fields, e.g. the run id and log of a sync
+def write_to_json(id, backupname, starttime, endtime, duration, size, status, info, extra=None):
+    with statusLock:
+        if not os.path.exists(pzm_common.statusJsonFile):
+            os.mknod(pzm_common.statusJsonFile)
+        with open(pzm_common.statusJsonFile, "r") as jsonFile:
+            try:
+                data = json.load(jsonFile)
+            except JSONDecodeError:
+                data = {}
+        previous = data.get(id + "_" + backupname, {})
+        data[id + "_" + backupname] = {
+            'id': id,
+            'backupname': backupname,
+            'starttime': starttime,
+            'endtime': endtime,
+            'duration': duration,
+            'size': size,
+            'status': status,
+            'info': info
+        }
+        data[id + "_" + backupname].update(dict([(key, value) for key, value in previous.items() if key.startswith('verify_')])) #The last verification stays
+        if extra is not None:
+            data[id + "_" + backupname].update(extra)
         with open(pzm_common.statusJsonFile, "w") as jsonFile:
-            json.dump(newData, jsonFile, indent=4)
-
-#Delete logfiles from errored syncs if they are older than 7 days.
-def cleanup_logfolder():
-    if not os.path.exists(logpath):
-        return
-    for f in os.listdir(logpath):
-        if os.stat(os.path.join(logpath,f)).st_mtime < time.time() - 7 * 86400:
-            os.remove(os.path.join(logpath,f))
-
-#Write error logfile
-def write_logfile(data, logfilename):
-    if not os.path.exists(logpath):
-        os.makedirs(logpath)
-    with open(os.path.join(logpath,logfilename), 'w') as logfile:
-        logfile.write(data)
-
-
-#Write status to json status file
-def write_to_json(id, backupname, starttime, endtime, duration, size, status, info):
-    if not os.path.exists(pzm_common.statusJsonFile):
-        os.mknod(pzm_common.statusJsonFile)
-    with open(pzm_common.statusJsonFile, "r") as jsonFile:
+            json.dump(data, jsonFile, indent=4)
+
+
+
+#Build the "pve-zsync sync" command for one ID
+def pve_zsync_command(id, destination, backupname, maxsnap, replicate, raw, properties, prepend_storage_id, dest_config_path):
+    command = ['pve-zsync', 'sync',
+                  '--source', id,
+                  '--dest', destination,
+                  '--name', backupname,
+                  '--maxsnap', str(maxsnap),
+                  '--method', 'ssh',
+                  '--source-user', 'root',
+                  '--dest-user', 'root',
+                  '--verbose']
+    if dest_config_path is not None:
+        command.append('--dest-config-path')
+        command.append(dest_config_path)
+    if replicate:
+        command.append('--replicate')
+    if raw:
+        command.append('--raw')
+    if properties:
+        command.append('--properties')
+    if prepend_storage_id:
+        command.append('--prepend-storage-id')
+    return command
+
+#Sync one ID (with retries) and write its status. Returns the status ("ok", "error" or None if the ID has no disk on ZFS and is skipped)
+#and its line of the response. The output of all attempts is streamed to the log <run_id>_<id>.log.gz, which is kept if an attempt failed
+def sync_id(id, hostname, zfspool, backupname, command, job, retries, run_id):
+    log ("ID " + id + " syncing...")
+    starttime = datetime.datetime.now()
+    logfilename = run_id + "_" + id.replace(':', '_') + ".log.gz"
+    if not pzm_common.test:
+        write_to_json(id, backupname, starttime.strftime(timeformat), "-", "-", "-", "syncing", "", {'run_id': run_id})
+
+    #One attempt, its output goes to the log of the ID. Only the capped head and tail of it are kept in memory
+    def attempt(number):
+        output_log = open_log(logfilename, "### Attempt " + str(number) + " at " + datetime.datetime.now().strftime(timeformat) + ": " + ' '.join(command), b"total estimated size is")
+        set_output_log(output_log)
         try:
-            data = json.load(jsonFile)
-        except JSONDecodeError:
-            data = {}
-    data[id + "_" + backupname] = {
-        'id': id,
-        'backupname': backupname,
-        'starttime': starttime,
-        'endtime': endtime,
-        'duration': duration,
-        'size': size,
-        'status': status,
-        'info': info
-    }
-    with open(pzm_common.statusJsonFile, "w") as jsonFile:
-        json.dump(data, jsonFile, indent=4)
+            if job is not None:
+                return job.sync(id)
+            return execute_command(command, transfer=True)
+        finally:
+            set_output_log(None)
+            if output_log is not None:
+                output_log.close()
+
+    rc, stdout, stderr, pid = attempt(1)
+    tries = 0
+
+    if retries is not None:
+        while retries > tries and rc != 0:
+            if "include no disk on zfs" in stderr:
+                break #break the retry loop cause "include no disk on zfs" is not an error... just skip this vm/ct id instead
+            tries+=1
+            log ("Failed, will retry after 30 seconds...")
+            time.sleep(30)
+            if job is not None and job.can_resume(id):
+                log ("Interrupted receive will be resumed, not sanitizing remote side")
+            else:
+                log ("Sanitizing remote side...")
+                innerArgs = type('innerArgs', (object,),
+                 {'hostname':hostname, 'backupname': backupname, 'ids': id, 'zfspool':zfspool})()
+                sanitize(innerArgs)
+
+            log ("Retrying backup...")
+            rc, stdout, stderr, pid = attempt(tries + 1)
+
+    endtime = datetime.datetime.now()
+    duration = endtime - starttime
+    logfile = os.path.join(logpath, logfilename)
+
+    if rc != 0:
+        if "include no disk on zfs" in stderr:
+            remove_log(logfilename)
+            if not pzm_common.test:
+                cleanup_json(id)
+                return None, "" #"include no disk on zfs" is not an error... just skip this vm/ct id and continue with the next. We don't need log data either
+        log (stderr)
+        log ("Command: \"" + ' '.join(command) + "\" failed " + str(tries+1) + " times, no retries left")
+        log ("ID " + id + " failed. Took " + str(duration))
+        if not pzm_common.test:
+            write_to_json(id, backupname, starttime.strftime(timeformat), endtime.strftime(timeformat), str(duration), "-", "error" ,"Errorlog at " + logfile, {'run_id': run_id, 'log': logfile})
+        return "error", "ID " + id + " - ERROR - Took " + str(duration) +"\n"
+
+    log ("ID " + id + " done successfully with " + str (tries+1) + " attempts. Took " + str(duration))
+    additionalMessage = ""
+    extra = {'run_id': run_id}
+    if tries > 0:
+        additionalMessage = "Needed " + str(tries) + " additional retries, check " + logfile
+        extra['log'] = logfile
+    else:
+        remove_log(logfilename)
+    if not pzm_common.test:
+        estimated_total_size_matches = re.findall(r"total estimated size is.*", stderr)
+        estimated_size = ""
+        if len(estimated_total_size_matches) > 0:
+            for estimated_total_size_match in estimated_total_size_matches:
+               estimated_size_carved_match = re.search(r'(\d+(\.\d+)?(B|K|M|G|T))', estimated_total_size_match)
+               if estimated_size_carved_match is not None:
+                   estimated_size = estimated_size + estimated_size_carved_match.group() + ","
+            log_debug ("Sent size: " + str(estimated_size[:-1]))
+            estimated_size = estimated_size[:-1] #Remove trailing ","
+        else:
+            estimated_size = "-"
+        write_to_json(id, backupname, starttime.strftime(timeformat), endtime.strftime(timeformat), str(duration), estimated_size, "ok", additionalMessage, extra)
+    return "ok", "ID " + id + " - OK! - Took " + str(duration) + "\n"
 
+#Source host of an ID, None for local (push) IDs
+def source_of(id):
+    if ':' in id:
+        return id.rsplit(':', 1)[0]
+    return None
 
 
 #Main method for the backup function
-def backup(hostname,zfspool,backupname,ids,replicate,raw,properties,maxsnap,retries,prepend_storage_id,dest_config_path=None):
+#engine selects who does the actual sync: "pve-zsync" (external pve-zsync process per ID) or "native" (Replication_Job)
+#consistency_groups (lists of IDs) are snapshotted together in the snapshot phase of the native engine
+#retention (policy of pzm_retention) prunes the destination after all transfers, instead of maxsnap
+#IDs are synced in one lane per source host (all push IDs are one lane). At most pull_lanes lanes run at the same time (all if None),
+#and within a lane at most lane_limit IDs. Every pull lane gets its own summary "<source host>:all" in the status file
+#synced (list), if given, gets the IDs which were synced successfully
+#config_store: the configs are kept in the content-addressed store of the config path. The native engine writes them there, the files
+#pve-zsync writes are imported after all transfers, and configs of snapshots which are gone are removed from it
+def backup(hostname,zfspool,backupname,ids,replicate,raw,properties,maxsnap,retries,prepend_storage_id,dest_config_path=None,engine="pve-zsync",compressed=False,consistency_groups=[],retention=None,pull_lanes=None,lane_limit=1,synced=None,config_store=False):
     if replicate:
         replicationtext = " with replication"
     else:
@@ -99,113 +213,89 @@ def backup(hostname,zfspool,backupname,ids,replicate,raw,properties,maxsnap,retr
     else:
         dest_config_path_text = " Config-Path: Default"
 
-    log ("Backing up to " + hostname + ":" + zfspool + "@" + backupname + replicationtext + "," + dest_config_path_text)
+    log ("Backing up to " + hostname + ":" + zfspool + "@" + backupname + replicationtext + "," + dest_config_path_text + ", Engine: " + engine)
 
     if maxsnap is None:
         maxsnap = 1
 
-    timeformat = "%d-%m-%Y_%H:%M:%S"
+    job = None
+    if engine == "native":
+        job = Replication_Job(hostname, zfspool, backupname, maxsnap, replicate, raw, properties, compressed, prepend_storage_id, dest_config_path, retention, config_store)
+
     response = ""
     failedOnce = False
     firststarttime = datetime.datetime.now()
-    is_pull = False
+    run_id = firststarttime.strftime("%Y%m%d-%H%M%S") + "-" + str(os.getpid()) #Logs and status entries of this run carry it
     destination = zfspool
-    if not ("localhost" in hostname or "127.0.0.1" in hostname):
+    if not is_local(hostname):
         destination = hostname + ":" + destination
 
     ids.sort() #Sort ID list, so qms and cts are not synced in series, but in order based on their VM/CT id
+    is_pull = len([id for id in ids if source_of(id) is not None]) > 0
 
+    if job is not None:
+        job.snapshot_all(ids, consistency_groups) #Snapshots of all IDs are taken before the first transfer starts
 
+    lanes = {}
     for id in ids:
-        log ("ID " + id + " syncing...")
-        if ':' in id:
-            is_pull = True
-        starttime = datetime.datetime.now()
-        if not pzm_common.test:
-            write_to_json(id, backupname, starttime.strftime(timeformat), "-", "-", "-", "syncing", "")
-        command = ['pve-zsync', 'sync',
-                      '--source', id,
-                      '--dest', destination,
-                      '--name', backupname,
-                      '--maxsnap', str(maxsnap),
-                      '--method', 'ssh',
-                      '--source-user', 'root',
-                      '--dest-user', 'root',
-                      '--verbose']
-        if dest_config_path is not None:
-            command.append('--dest-config-path')
-            command.append(dest_config_path)
-        if replicate:
-            command.append('--replicate')
-        if raw:
-            command.append('--raw')
-        if properties:
-            command.append('--properties')
-        if prepend_storage_id:
-            command.append('--prepend-storage-id')
-
-        rc, stdout, stderr, pid = execute_command(command)
-        tries = 0
-
-        logfilestrings = ""
-        if retries is not None:
-            while retries > tries and rc != 0:
-                if "include no disk on zfs" in stderr:
-                    break #break the retry loop cause "include no disk on zfs" is not an error... just skip this vm/ct id instead
-                write_logfile(stderr, str(pid) + '.err')
-                logfilestrings = str(pid) + '.err' + " "
-                tries+=1
-                log ("Failed, will retry after 30 seconds...")
-                time.sleep(30)
-                log ("Sanitizing remote side...")
-                innerArgs = type('innerArgs', (object,),
-                 {'hostname':hostname, 'backupname': backupname, 'ids': id, 'zfspool':zfspool})()
-                sanitize(innerArgs)
-
-                log ("Retrying backup...")
-                rc, stdout, stderr, pid = execute_command(command)
+        lanes.setdefault(source_of(id), []).append(id)
+
+    def sync_one(id):
+        command = pve_zsync_command(id, destination, backupname, maxsnap, replicate, raw, properties, prepend_storage_id, dest_config_path)
+        return sync_id(id, hostname, zfspool, backupname, command, job, retries, run_id)
+
+    #Sync all IDs of one source host, at most lane_limit at the same time. All ssh sessions to the source share one connection
+    def run_lane(source):
+        lane_ids = lanes[source]
+        lane_starttime = datetime.datetime.now()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(lane_limit, 1)) as executor:
+            lane_results = dict(zip(lane_ids, executor.map(sync_one, lane_ids)))
+        lane_endtime = datetime.datetime.now()
+        if source is not None:
+            synced = [status for status, line in lane_results.values() if status is not None]
+            errors = len([status for status in synced if status == "error"])
+            log ("Source " + source + " finished, " + str(len(synced) - errors) + " of " + str(len(synced)) + " IDs OK. Took " + str(lane_endtime - lane_starttime))
+            if not pzm_common.test:
+                write_to_json(source + ":all", backupname, lane_starttime.strftime(timeformat), lane_endtime.strftime(timeformat), str(lane_endtime - lane_starttime), "-", "error" if errors > 0 else "ok", str(len(synced) - errors) + " of " + str(len(synced)) + " IDs OK", {'run_id': run_id})
+        return lane_results
 
-        endtime = datetime.datetime.now()
-        duration = endtime - starttime
+    if len(lanes) > 1:
+        log ("Syncing from " + str(len(lanes)) + " sources, " + (str(pull_lanes) if pull_lanes is not None else "all") + " at the same time, " + str(lane_limit) + " IDs per source")
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(pull_lanes if pull_lanes is not None else len(lanes), 1)) as executor:
+        for lane_results in executor.map(run_lane, list(lanes.keys())):
+            results.update(lane_results)
 
-        if rc != 0:
-            if "include no disk on zfs" in stderr:
-                if not pzm_common.test:
-                    cleanup_json(id)
-                    continue #"include no disk on zfs" is not an error... just skip this vm/ct id and continue with the next. We don't need log data either
-            log (stderr)
-            log ("Command: \"" + ' '.join(command) + "\" failed " + str(tries+1) + " times, no retries left")
-            log ("ID " + id + " failed. Took " + str(duration))
+    for id in ids:
+        status, line = results[id]
+        if status is None:
+            continue
+        if status == "error":
             failedOnce = True
-            response = response + "ID " + id + " - ERROR - Took " + str(duration) +"\n"
-            write_logfile(stderr, str(pid) + '.err')
-            if not pzm_common.test:
-                write_to_json(id, backupname, starttime.strftime(timeformat), endtime.strftime(timeformat), str(duration), "-", "error" ,"Errorlog at " + os.path.join(logpath,str(pid) + ".err"))
-        else:
-            log ("ID " + id + " done successfully with " + str (tries+1) + " attempts. Took " + str(duration))
-            response = response + "ID " + id + " - OK! - Took " + str(duration) + "\n"
-            additionalMessage = ""
-            if tries > 0:
-                additionalMessage = "Needed " + str(tries) + " additional retries, check " + os.path.join(logpath) + "[" + logfilestrings + "]"
-            if not pzm_common.test:
-                estimated_total_size_matches = re.findall(r"total estimated size is.*", stderr)
-                estimated_size = ""
-                if len(estimated_total_size_matches) > 0:
-                    for estimated_total_size_match in estimated_total_size_matches:
-                       estimated_size_carved_match = re.search(r'(\d+(\.\d+)?(B|K|M|G|T))', estimated_total_size_match)
-                       if estimated_size_carved_match is not None:
-                           estimated_size = estimated_size + estimated_size_carved_match.group() + ","
-                    log_debug ("Sent size: " + str(estimated_size[:-1]))
-                    estimated_size = estimated_size[:-1] #Remove trailing ","
-                else:
-                    estimated_size = "-"
-                write_to_json(id, backupname, starttime.strftime(timeformat), endtime.strftime(timeformat), str(duration), estimated_size, "ok", additionalMessage)
+        elif synced is not None:
+            synced.append(id)
+        response = response + line
+
+    #Retention runs once for the whole target after all transfers, so the transfers don't wait for the pruning
+    if retention is not None:
+        log (prune_target(hostname, zfspool, backupname, retention, dest_config_path, set([id.split(':')[-1] for id in ids])))
+
+    if config_store:
+        config_path = dest_config_path if dest_config_path is not None else defaultConfigPath
+        imported = import_flat_configs(hostname, config_path)
+        removed = prune_config_store(hostname, zfspool, backupname, config_path)
+        collect_garbage(hostname, config_path) #Once for all entries the lanes and the pruning removed
+        log ("Config store: " + str(imported) + " configs imported, " + str(removed) + " of pruned snapshots removed")
 
     finaltime = datetime.datetime.now()
     finalduration = duration = finaltime - firststarttime
+    throttleinfo = ""
+    if pzm_common.throttle is not None:
+        throttleinfo = pzm_common.throttle.summary()
+        log (throttleinfo)
     if not is_pull:
         if not pzm_common.test:
-            write_to_json("all", backupname, firststarttime.strftime(timeformat), finaltime.strftime(timeformat), str(finalduration), "-", "error" if failedOnce else "ok", "")
+            write_to_json("all", backupname, firststarttime.strftime(timeformat), finaltime.strftime(timeformat), str(finalduration), "-", "error" if failedOnce else "ok", throttleinfo, {'run_id': run_id})
 
     response = response + "\n" + "Finished in " + str(finalduration)
 
@@ -216,42 +306,60 @@ def backup(hostname,zfspool,backupname,ids,replicate,raw,properties,maxsnap,retr
 def sync(args):
     check_zfs_pool(args.hostname,args.zfspool)
 
-    all_ids = False
-    exclude_ids = []
-    include_ids = []
-    id_list = args.ids.split(',')
-    if "all" in id_list:
-        id_list.pop(id_list.index("all"))
-        all_ids = True
-        for id in id_list:
-            if id.startswith('-'):
-                exclude_ids.append(id.replace("-", ""))
-            else:
-                print ("Do not use \"all\" in combination with other, non excluding ids!")
-                sys.exit(2)
-    else:
-        for id in id_list:
-            if id.startswith('-'):
-                print ("Do not use excluding IDs without \"all\"!")
-                sys.exit(2)
-            else:
-                include_ids.append(id)
-
+    include_ids, exclude_ids = parse_ids(args.ids)
     vmids = get_ids("qm",include_ids,exclude_ids)
     ctids = get_ids("pct",include_ids,exclude_ids)
 
     backup_ids = list(dict.fromkeys(vmids + ctids))
 
+    consistency_groups = []
+    if args.consistency_groups is not None:
+        if args.engine != "native":
+            print ("Consistency groups are only supported with \"--engine native\"!")
+            sys.exit(2)
+        for group in args.consistency_groups.split(';'):
+            consistency_groups.append([id for id in group.split(',') if id != ""])
+
+    retention = None
+    if args.keep is not None:
+        if args.engine != "native":
+            print ("Retention with \"--keep\" is only supported with \"--engine native\", pve-zsync prunes with --maxsnap itself!")
+            sys.exit(2)
+        try:
+            retention = parse_policy(args.keep)
+        except ValueError as e:
+            print (str(e))
+            sys.exit(2)
+
+    #Adaptive: only the IDs whose delta is big enough (or which weren't synced for too long) are synced in this run
+    adaptive_state = None
+    if args.adaptive is not None and len(backup_ids) > 0:
+        backup_ids, adaptive_state = select_due(args, backup_ids, args.adaptive, args.min_interval, args.max_interval)
+
+    #Pre-flight: check the destination before locking it, instead of finding out after hours of transfer
+    if args.preflight is not None and len(backup_ids) > 0:
+        backup_ids, skipped = preflight(args, backup_ids, args.preflight, args.facts_ttl * 60)
+        if not pzm_common.test:
+            now = datetime.datetime.now().strftime("%d-%m-%Y_%H:%M:%S")
+            for id, reason in skipped.items():
+                write_to_json(id, args.backupname, now, now, "0:00:00", "-", "error", reason)
+
     log_debug ("IDs to Backup: " + str(backup_ids))
     log_debug ("Count: " + str(len(backup_ids)))
 
+    synced = []
     if len(backup_ids) > 0:
-        lock(args.hostname)
+        coordinated = held_by_coordinator(args.hostname) #The cluster coordinator holds the lock for all nodes
+        if not coordinated:
+            lock(args.hostname)
         cleanup_logfolder()
-        response = backup(args.hostname, args.zfspool, args.backupname, backup_ids, args.replicate, args.raw, args.properties, args.maxsnap, args.retries, args.prepend_storage_id, args.dest_config_path)
+        response = backup(args.hostname, args.zfspool, args.backupname, backup_ids, args.replicate, args.raw, args.properties, args.maxsnap, args.retries, args.prepend_storage_id, args.dest_config_path, args.engine, args.compressed, consistency_groups, retention, args.pull_lanes, args.lane_limit, synced, args.config_store)
         cleanup_json()
-        unlock(args.hostname)
+        if not coordinated:
+            unlock(args.hostname)
         log ("Backup/Sync finished")
+    if adaptive_state is not None:
+        record(args, adaptive_state, synced)
 
 
         #execute_command(['/scripts/Notifications/pushnotification', '[PVE-ZSYNC][' + args.backupname + ']', response])
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+import atexit
+import datetime
+import argparse
+import os
+import shlex
+import threading
+
+import pzm_common
+from pzm_common import execute_readonly_command, log, log_debug
+
+#cgroup v2 hierarchy, the transfers of one run are placed in <cgroupRoot>/pve-zsync-manager-<pid>
+cgroupRoot = "/sys/fs/cgroup"
+#How often the limits are adjusted to the time of day while transfers are running, in seconds
+updateInterval = 60
+#Used instead of a cgroup if cgroup v2 with the io and cpu controllers is not available
+fallbackPrefix = ['nice', '-n', '19', 'ionice', '-c', '2', '-n', '7']
+#Helper shell of a throttled transfer: moves itself into the cgroup (its cgroup.procs is $0) and executes the transfer, which then runs
+#there with everything it starts. Nothing has to be done in the forked child of this multi-threaded process (no preexec_fn)
+cgroupWrapper = 'echo $$ > "$0" && exec "$@"'
+
+
+#Parse "HH:MM-HH:MM[,HH:MM-HH:MM...]" into a list of (start, end) minutes of the day. A window may cross midnight (22:00-06:00)
+def parse_hours(hours):
+    windows = []
+    if hours is None:
+        return windows
+    for window in hours.split(','):
+        times = window.split('-')
+        if len(times) != 2:
+            raise ValueError("Invalid time window " + window + ", use HH:MM-HH:MM")
+        minutes = []
+        for time in times:
+            hour, unused, minute = time.strip().partition(':')
+            if not hour.isdigit() or not minute.isdigit() or int(hour) > 24 or int(minute) > 59 or int(hour) * 60 + int(minute) > 1440:
+                raise ValueError("Invalid time " + time + " in " + window + ", use HH:MM-HH:MM")
+            minutes.append(int(hour) * 60 + int(minute))
+        windows.append((minutes[0], minutes[1]))
+    return windows
+
+#argparse type of --throttle-hours, so a malformed value is reported like any other invalid argument
+def hours_argument(hours):
+    try:
+        parse_hours(hours)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return hours
+
+#Block devices ("major:minor" of the whole disks) of all imported pools, io.max needs them
+def get_pool_devices():
+    rc, stdout, stderr = execute_readonly_command(['zpool', 'list', '-v', '-H', '-P'])
+    devices = []
+    for line in stdout.split('\n'):
+        path = line.strip().split('\t')[0]
+        if not path.startswith('/dev/'):
+            continue
+        name = os.path.basename(os.path.realpath(path))
+        sysfs = os.path.realpath('/sys/class/block/' + name)
+        if os.path.exists(os.path.join(sysfs, 'partition')): #Limits apply to the whole disk, not to a partition
+            sysfs = os.path.dirname(sysfs)
+        try:
+            with open(os.path.join(sysfs, 'dev'), 'r') as devfile:
+                device = devfile.read().strip()
+        except OSError:
+            continue
+        if not device in devices:
+            devices.append(device)
+    return devices
+
+
+#Limits for the transfer processes (pve-zsync, zfs send/recv and everything they start) of a run, so they don't starve the guests.
+#With cgroup v2 the transfers are placed in an own cgroup with io.max (io_limit in MB/s), io.weight and cpu.max (cpu_limit in percent of one CPU),
+#otherwise they are started with nice/ionice. With hours, the limits only apply within these times of the day.
+#The io limits are best effort: ZFS issues most pool I/O from its kernel threads (txg sync, zio taskqs), which are in no cgroup and
+#ignore ionice. They pace the transfers only as far as these wait for their own reads and writes
+#The time the transfers were throttled (cpu.stat throttled_usec, stall time from io.pressure) is taken from the counters of the cgroup
+#at setup and at the end of the run. Transfers run at the same time share the cgroup, so they can't be accounted one by one.
+class Throttle:
+    def __init__(self, io_limit=None, io_weight=None, cpu_limit=None, hours=None):
+        self.io_limit = io_limit
+        self.io_weight = io_weight
+        self.cpu_limit = cpu_limit
+        self.windows = parse_hours(hours)
+        self.cgroup = None
+        self.devices = []
+        self.active = None
+        self.baseline = (0, 0) #Counters of the cgroup at setup, in microseconds
+        self.stop = threading.Event()
+        self.updater = None
+
+    #Create the cgroup of this run. Returns False if cgroup v2 with io and cpu controllers is not usable, nice/ionice is used then
+    def setup(self):
+        if pzm_common.test:
+            return False
+        try:
+            with open(os.path.join(cgroupRoot, 'cgroup.controllers'), 'r') as controllers:
+                available = controllers.read().split()
+            if not 'io' in available or not 'cpu' in available:
+                raise OSError("io and cpu controllers are not available")
+            with open(os.path.join(cgroupRoot, 'cgroup.subtree_control'), 'w') as subtree_control:
+                subtree_control.write('+io +cpu')
+            cgroup = os.path.join(cgroupRoot, 'pve-zsync-manager-' + str(os.getpid()))
+            if not os.path.isdir(cgroup):
+                os.mkdir(cgroup)
+        except OSError as e:
+            log ("No cgroup v2 for transfers (" + str(e) + "), using nice/ionice instead")
+            return False
+        self.cgroup = cgroup
+        self.baseline = self.counters()
+        if self.io_limit is not None:
+            self.devices = get_pool_devices()
+        self.apply()
+        self.updater = threading.Thread(target=self.update, daemon=True)
+        self.updater.start()
+        atexit.register(self.close)
+        return True
+
+    #Checks if the limits apply now
+    def in_window(self):
+        if len(self.windows) == 0:
+            return True
+        now = datetime.datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end in self.windows:
+            if start <= end and start <= minute < end:
+                return True
+            if start > end and (minute >= start or minute < end):
+                return True
+        return False
+
+    #Write the limits to the cgroup, or remove them outside of the time windows
+    def apply(self):
+        if self.cgroup is None:
+            return
+        active = self.in_window()
+        if active == self.active:
+            return
+        settings = []
+        if self.io_limit is not None:
+            limit = str(self.io_limit * 1024 * 1024) if active else "max"
+            for device in self.devices:
+                settings.append(('io.max', device + ' rbps=' + limit + ' wbps=' + limit))
+        if self.io_weight is not None:
+            settings.append(('io.weight', 'default ' + (str(self.io_weight) if active else '100')))
+        if self.cpu_limit is not None:
+            settings.append(('cpu.max', (str(self.cpu_limit * 1000) if active else 'max') + ' 100000'))
+        for filename, value in settings:
+            try:
+                with open(os.path.join(self.cgroup, filename), 'w') as setting:
+                    setting.write(value)
+            except OSError as e:
+                log ("Could not set " + filename + " to " + value + ": " + str(e))
+        log_debug ("Transfer limits " + ("applied" if active else "lifted"))
+        self.active = active
+
+    #Adjust the limits to the time of day until the run ends
+    def update(self):
+        while not self.stop.wait(updateInterval):
+            self.apply()
+
+    #Command which runs within the cgroup, started by the helper shell of cgroupWrapper. Shell commands are text, there the shell which
+    #runs them moves itself into the cgroup first
+    def in_cgroup(self, command, shell):
+        procs = os.path.join(self.cgroup, 'cgroup.procs')
+        if shell:
+            return ['echo $$ >', shlex.quote(procs), '&&'] + command
+        return ['sh', '-c', cgroupWrapper, procs] + command
+
+    #Returns the commands of a transfer, run within the limits
+    def wrap(self, commands, shell=False):
+        if self.cgroup is not None:
+            self.apply()
+            return [self.in_cgroup(command, shell) for command in commands]
+        if self.in_window():
+            return [fallbackPrefix + command for command in commands]
+        return commands
+
+    #Throttled cpu time and io stall time of the cgroup so far, in microseconds
+    def counters(self):
+        throttled_cpu = 0
+        stalled_io = 0
+        if self.cgroup is None:
+            return throttled_cpu, stalled_io
+        try:
+            with open(os.path.join(self.cgroup, 'cpu.stat'), 'r') as cpustat:
+                for line in cpustat:
+                    if line.startswith('throttled_usec'):
+                        throttled_cpu = int(line.split()[1])
+            with open(os.path.join(self.cgroup, 'io.pressure'), 'r') as pressure:
+                for line in pressure:
+                    if line.startswith('some'):
+                        stalled_io = int(line.split('total=')[1])
+        except (OSError, ValueError, IndexError):
+            pass
+        return throttled_cpu, stalled_io
+
+    #Throttled time of the run as text, for the log and the status file
+    def summary(self):
+        if self.cgroup is None:
+            return "Transfers ran with nice/ionice" if len(self.windows) == 0 else "Transfers ran with nice/ionice within " + ",".join(["%02d:%02d-%02d:%02d" % (start // 60, start % 60, end // 60, end % 60) for start, end in self.windows])
+        throttled_cpu, stalled_io = self.counters()
+        return "Throttled: cpu " + str(datetime.timedelta(seconds=int((throttled_cpu - self.baseline[0]) / 1000000))) + ", io stalled " + str(datetime.timedelta(seconds=int((stalled_io - self.baseline[1]) / 1000000)))
+
+    #Stop adjusting the limits and remove the cgroup. It can only be removed once all transfers ended
+    def close(self):
+        self.stop.set()
+        if self.cgroup is not None:
+            try:
+                os.rmdir(self.cgroup)
+            except OSError:
+                pass
+            self.cgroup = None
+
+
+#Create the Throttle for the given options and make it used by all transfers. Returns None if no limit was given
+def setup_throttle(io_limit, io_weight, cpu_limit, hours):
+    if io_limit is None and io_weight is None and cpu_limit is None:
+        return None
+    throttle = Throttle(io_limit, io_weight, cpu_limit, hours)
+    throttle.setup()
+    pzm_common.throttle = throttle
+    return throttle
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import shlex
+import threading
+import time
+
+import pzm_common
+from pzm_common import execute_readonly_command, log, log_debug, ssh_command, is_local, on_host
+
+#Measured ssh cipher and stream compressor of every host and direction, re-tuned after --tune-transfers days
+tuningCacheFile = "/var/lib/pve-zsync/manager_transfer_tuning"
+#Candidates of the benchmark. Ciphers are measured without compression first, then the compressors with the fastest cipher
+candidateCiphers = ["aes128-gcm@openssh.com", "aes256-gcm@openssh.com", "chacha20-poly1305@openssh.com", "aes128-ctr"]
+candidateCompressors = {
+    "none": None,
+    "lz4": ("lz4 -q -c", "lz4 -q -dc"),
+    "zstd-1": ("zstd -q -1 -T0 -c", "zstd -q -dc"),
+    "zstd-3": ("zstd -q -3 -T0 -c", "zstd -q -dc"),
+    "zstd-6": ("zstd -q -6 -T0 -c", "zstd -q -dc"),
+}
+#The benchmark sends up to this many bytes of the real send stream, stored in samplePath on the sending side first.
+#Streams smaller than minSampleSize (e.g. small incrementals) aren't used, the time would be mostly the ssh connection setup
+sampleSize = 256 * 1024 * 1024
+minSampleSize = 32 * 1024 * 1024
+samplePath = "/tmp/pve-zsync-manager-tune-sample"
+#Lanes transferring from or to the same host wait for one benchmark
+tuningLock = threading.Lock()
+
+
+#A command (list) as text for a shell
+def shell_text(command):
+    return ' '.join([shlex.quote(element) for element in command])
+
+def load_cache():
+    if not os.path.exists(tuningCacheFile):
+        return {}
+    with open(tuningCacheFile, 'r') as cacheFile:
+        try:
+            return json.load(cacheFile)
+        except ValueError:
+            return {}
+
+def save_cache(cache):
+    with open(tuningCacheFile, 'w') as cacheFile:
+        json.dump(cache, cacheFile, indent=4)
+
+#Shell script of one benchmark run, executed locally: the sample goes over ssh from (sender_remote) or to hostname, compressed if a compressor is given.
+#ssh passes its command to the remote shell, so the remote part is one argument
+def benchmark_script(hostname, sender_remote, cipher, compressor):
+    compress, decompress = compressor if compressor is not None else ("cat", "cat")
+    if sender_remote:
+        return shell_text(ssh_command(hostname, ['cat ' + samplePath + ' | ' + compress], cipher)) + ' | ' + decompress + ' > /dev/null'
+    return 'cat ' + samplePath + ' | ' + compress + ' | ' + shell_text(ssh_command(hostname, [decompress + ' > /dev/null'], cipher))
+
+#Throughput of one candidate in MB/s (of the uncompressed stream of size bytes), None if it failed (cipher or compressor not available)
+def measure(hostname, sender_remote, cipher, compressor, size):
+    starttime = time.time()
+    rc, stdout, stderr = execute_readonly_command(['bash', '-c', 'set -o pipefail; ' + benchmark_script(hostname, sender_remote, cipher, compressor)])
+    duration = time.time() - starttime
+    if rc != 0:
+        log_debug ("Benchmark of " + cipher + " failed: " + stderr.strip())
+        return None
+    return size / 1024.0 / 1024.0 / max(duration, 0.001)
+
+#Benchmark the ciphers and compressors of the link to (or from, if sender_remote) hostname with the first sampleSize bytes of send,
+#the stream which is about to be transferred, so the compressibility is real. Returns the tuning, or None if no sample could be taken
+def benchmark(hostname, sender_remote, send):
+    sample_script = shell_text(send) + ' 2>/dev/null | head -c ' + str(sampleSize) + ' > ' + samplePath
+    if sender_remote:
+        sample_command = ssh_command(hostname, ['sh', '-c', shlex.quote(sample_script)])
+    else:
+        sample_command = ['sh', '-c', sample_script]
+    log ("Tuning transfers " + ("from " if sender_remote else "to ") + hostname + "...")
+    rc, stdout, stderr = execute_readonly_command(sample_command)
+    sample_host = hostname if sender_remote else None
+    if rc != 0:
+        log ("Could not take a sample for tuning: " + stderr)
+        execute_readonly_command(on_host(sample_host, ['rm', '-f', samplePath]))
+        return None
+    rc, stdout, stderr = execute_readonly_command(on_host(sample_host, ['stat', '-c', '%s', samplePath]))
+    size = int(stdout.strip()) if rc == 0 and stdout.strip().isdigit() else 0
+    if size < minSampleSize:
+        log_debug ("Not tuning transfers " + ("from " if sender_remote else "to ") + hostname + ", the stream has only " + str(size) + " bytes")
+        execute_readonly_command(on_host(sample_host, ['rm', '-f', samplePath]))
+        return None
+    results = {}
+    for cipher in candidateCiphers:
+        results[cipher + "/none"] = measure(hostname, sender_remote, cipher, None, size)
+    working = [(speed, name) for name, speed in results.items() if speed is not None]
+    if len(working) == 0:
+        log ("No cipher worked for " + hostname + ", using the ssh defaults")
+        execute_readonly_command(on_host(sample_host, ['rm', '-f', samplePath]))
+        return None
+    cipher = max(working)[1].split('/')[0]
+    for name, compressor in candidateCompressors.items():
+        if compressor is not None:
+            results[cipher + "/" + name] = measure(hostname, sender_remote, cipher, compressor, size)
+    speed, best = max([(speed, name) for name, speed in results.items() if speed is not None])
+    execute_readonly_command(on_host(sample_host, ['rm', '-f', samplePath]))
+    log ("Tuned transfers " + ("from " if sender_remote else "to ") + hostname + ": " + best + " (" + ("%.0f" % speed) + " MB/s), "
+         + ", ".join([name + " " + ("%.0f" % result if result is not None else "failed") for name, result in sorted(results.items())]))
+    return {"cipher": best.split('/')[0], "compressor": best.split('/')[1], "time": time.time(), "results": results}
+
+#Tuning of the link to (or from) hostname: cached, or measured if there is none younger than --tune-transfers days. None uses the ssh defaults
+def get_tuning(hostname, sender_remote, send):
+    key = hostname + (":send" if sender_remote else ":receive")
+    with tuningLock:
+        cache = load_cache()
+        tuning = cache.get(key)
+        if tuning is not None and time.time() - tuning["time"] < pzm_common.tune_interval * 86400:
+            return tuning
+        if pzm_common.test:
+            return tuning
+        tuning = benchmark(hostname, sender_remote, send)
+        if tuning is not None:
+            cache[key] = tuning
+            save_cache(cache)
+        return tuning
+
+#Commands of a send/receive pipeline between two hosts (None is this host). With --tune-transfers, the ssh sessions use the measured
+#cipher of their host and the stream is compressed before and decompressed after ssh, if a compressor was faster.
+#Remote pipelines run with pipefail, so a failing zfs send or recv isn't hidden by the compressor
+def tuned_pipeline(send_host, send, receive_host, receive):
+    if pzm_common.tune_interval is None:
+        return [on_host(send_host, send), on_host(receive_host, receive)]
+    commands = []
+    if is_local(send_host):
+        commands.append(send)
+    else:
+        tuning = get_tuning(send_host, True, send)
+        if tuning is None:
+            commands.append(on_host(send_host, send))
+        else:
+            compressor = candidateCompressors.get(tuning["compressor"])
+            script = 'set -o pipefail; ' + shell_text(send) + (' | ' + compressor[0] if compressor is not None else '')
+            commands.append(ssh_command(send_host, ['bash', '-c', shlex.quote(script)], tuning["cipher"]))
+            if compressor is not None:
+                commands.append(['sh', '-c', compressor[1]])
+    if is_local(receive_host):
+        commands.append(receive)
+    else:
+        #Between two remote hosts the stream passes this host, the receiving link is only tuned when sending from here
+        tuning = get_tuning(receive_host, False, send) if is_local(send_host) else None
+        if tuning is None:
+            commands.append(on_host(receive_host, receive))
+        else:
+            compressor = candidateCompressors.get(tuning["compressor"])
+            if compressor is not None:
+                commands.append(['sh', '-c', compressor[0]])
+            script = 'set -o pipefail; ' + (compressor[1] + ' | ' if compressor is not None else '') + shell_text(receive)
+            commands.append(ssh_command(receive_host, ['bash', '-c', shlex.quote(script)], tuning["cipher"]))
+    return commands
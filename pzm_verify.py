@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+import datetime
+import json
+import os
+import re
+import shlex
+from json.decoder import JSONDecodeError
+
+import pzm_common
+from pzm_common import log, log_debug, check_zfs_pool, select_ids
+from pzm_locking import lock, unlock
+from pzm_remote import run_script
+from pzm_replicate import defaultConfigPath
+from pzm_retention import dataset_vmid, maxCommandLength
+from pzm_sync import statusLock, timeformat
+from pzm_config_store import index_script, parse_index, config_lookup, store_path
+
+#Keys of the disks in a PVE guest config which are replicated (unused disks are skipped by pve-zsync and the native engine)
+diskKeys = re.compile(r'^(ide|sata|scsi|virtio|efidisk|tpmstate|rootfs|mp)\d*$')
+#Volumes pve-zsync replicates
+volumeName = re.compile(r'^(basevol|subvol|vm)-\d+-disk-\d+$')
+#Deep checks clone the snapshot to <zfspool>/<cloneName><n> and mount it below <mountRoot>/<n>
+cloneName = "pzm-verify-"
+mountRoot = "/run/pve-zsync-manager-verify"
+
+
+#Shell script listing the backup snapshots and datasets below zfspool and the stored config files, with one command
+def inventory_script(zfspool, backupname, config_path):
+    return ("echo ::snapshots; zfs list -H -t snapshot -o name -s createtxg -r " + shlex.quote(zfspool) + " | grep -F " + shlex.quote("@rep_" + backupname + "_") + "; "
+            "echo ::datasets; zfs list -H -t filesystem,volume -o name,type,keystatus -r " + shlex.quote(zfspool) + "; "
+            "echo ::configs; ls -1 " + shlex.quote(config_path) + "; "
+            "echo ::store; " + index_script(config_path))
+
+#Parse the output of inventory_script. Returns dataset -> snapshot names (oldest first), dataset -> (type, keystatus), the config names
+#(files and configs in the config store) and the index of the config store (config name -> sha256)
+def parse_inventory(stdout):
+    snapshots = {}
+    datasets = {}
+    config_files = []
+    store_lines = []
+    section = None
+    for line in stdout.split('\n'):
+        if line in pzm_common.considered_empty:
+            continue
+        if line.startswith('::'):
+            section = line[2:]
+            continue
+        if section == "snapshots":
+            dataset, unused, snapname = line.partition('@')
+            snapshots.setdefault(dataset, []).append(snapname)
+        elif section == "datasets":
+            fields = line.split('\t')
+            if len(fields) == 3:
+                datasets[fields[0]] = (fields[1], fields[2])
+        elif section == "configs":
+            config_files.append(line)
+        elif section == "store":
+            store_lines.append(line)
+    store_index = parse_index(store_lines)
+    return snapshots, datasets, sorted(set(config_files).union(store_index.keys())), store_index
+
+#Read many config files with as few commands as possible, from the config store if they are in store_index. Returns config name -> content
+def read_configs(hostname, config_path, config_names, store_index={}):
+    scripts = []
+    for config_name in config_names:
+        path = store_path(config_path) + '/blobs/' + store_index[config_name] if config_name in store_index else config_path.rstrip('/') + '/' + config_name
+        command = 'echo ' + shlex.quote('::' + config_name) + '; cat ' + shlex.quote(path) + '; '
+        if len(scripts) > 0 and len(scripts[-1]) + len(command) < maxCommandLength:
+            scripts[-1] = scripts[-1] + command
+        else:
+            scripts.append(command)
+    configs = {}
+    for script in scripts:
+        rc, stdout, stderr = run_script(hostname, script)
+        if rc != 0:
+            log ("Could not read all configs from " + hostname + ": " + stderr)
+        config_name = None
+        for line in stdout.split('\n'):
+            if line.startswith('::'):
+                config_name = line[2:]
+                configs[config_name] = []
+            elif config_name is not None:
+                configs[config_name].append(line)
+    return dict([(config_name, '\n'.join(lines)) for config_name, lines in configs.items()])
+
+#Volume names of the disks in the current section of a PVE guest config (not of its snapshots)
+def config_volumes(config):
+    volumes = []
+    for line in config.split('\n'):
+        if line.startswith('['):
+            break
+        key, unused, value = line.partition(':')
+        if not diskKeys.match(key.strip()) or 'media=cdrom' in value:
+            continue
+        volume = value.strip().split(',')[0]
+        volname = volume.split(':', 1)[-1]
+        if volumeName.match(volname):
+            volumes.append((volume.split(':', 1)[0], volname))
+    return volumes
+
+#Check every selected guest: the newest backup snapshot of its disks, the stored config of that snapshot (looked up like Disk.get_last_config)
+#and that every disk referenced by that config has the snapshot. Returns vmid -> result dict
+def check_guests(args, snapshots, datasets, config_files, store_index={}):
+    newest = {} #vmid -> newest snapshot name of all its disks
+    by_volname = {} #volume name -> datasets with that name
+    for dataset in datasets.keys():
+        by_volname.setdefault(dataset.split('/')[-1], []).append(dataset)
+    for dataset, snapnames in snapshots.items():
+        vmid = dataset_vmid(dataset)
+        if vmid is not None and (not vmid in newest or snapnames[-1] > newest[vmid]):
+            newest[vmid] = snapnames[-1]
+    results = {}
+    configs_needed = {}
+    lookup = config_lookup(config_files)
+    for vmid in select_ids(args.ids, newest.keys()):
+        snapname = newest[vmid]
+        results[vmid] = {"snapshot": snapname, "disks": [], "errors": []}
+        if not (vmid, snapname) in lookup:
+            results[vmid]["errors"].append("no config for " + snapname)
+            continue
+        configs_needed[vmid] = lookup[(vmid, snapname)]
+    configs = read_configs(args.hostname, args.dest_config_path, list(configs_needed.values()), store_index)
+    for vmid, config_name in configs_needed.items():
+        result = results[vmid]
+        if not config_name in configs:
+            result["errors"].append("config " + config_name + " not readable")
+            continue
+        volumes = config_volumes(configs[config_name])
+        if len(volumes) == 0:
+            result["errors"].append("config " + config_name + " references no disks")
+        for storage, volname in volumes:
+            candidates = by_volname.get(volname, [])
+            if len(candidates) > 1: #Sent with --prepend-storage-id
+                candidates = [dataset for dataset in candidates if dataset.split('/')[-2] == storage] or candidates
+            if len(candidates) == 0:
+                result["errors"].append(volname + " missing")
+            elif not result["snapshot"] in snapshots.get(candidates[0], []):
+                result["errors"].append(candidates[0] + "@" + result["snapshot"] + " missing")
+            else:
+                result["disks"].append(candidates[0])
+    return results
+
+#Shell script (bash) cloning every snapshot, mounting it (filesystems) or waiting for its device (volumes), optionally reading all data
+#into sha256sum, and destroying the clone again. Reading everything makes ZFS verify the checksum of every block.
+#Prints one "::<dataset> ok|error <detail>" line per disk
+def deep_script(args, disks, datasets, snapname):
+    lines = ['set -o pipefail', 'check() {',
+             '  ds=$1; clone=$2; mnt=$3; type=$4',
+             '  if [ "$5" = unavailable ]; then echo "::$ds error key not loaded"; return; fi',
+             '  if [ "$type" = volume ]; then opts="-o volmode=dev"; else opts="-o canmount=noauto -o mountpoint=$mnt"; fi',
+             '  zfs clone -o readonly=on $opts "$ds@$6" "$clone" 2>/dev/null || { echo "::$ds error clone failed"; return; }',
+             '  if [ "$type" = volume ]; then udevadm settle; dev=/dev/zvol/$clone; [ -b "$dev" ] || { echo "::$ds error no device"; zfs destroy "$clone"; return; }',
+             '  else mkdir -p "$mnt"; zfs mount "$clone" || { echo "::$ds error mount failed"; zfs destroy "$clone"; return; }; fi',
+             '  result="ok"']
+    if args.deep == "checksum":
+        lines += ['  if [ "$type" = volume ]; then sum=$(dd if="$dev" bs=1M status=none | sha256sum) || result="error read failed"',
+                  '  else sum=$(tar -cf - -C "$mnt" . 2>/dev/null | sha256sum) || result="error read failed"; fi',
+                  '  [ "$result" = ok ] && result="ok ${sum%% *}"']
+    lines += ['  [ "$type" = volume ] || { zfs unmount "$clone"; rmdir "$mnt"; }',
+              '  zfs destroy "$clone" || result="$result, clone not destroyed"',
+              '  echo "::$ds $result"',
+              '}']
+    for index, dataset in enumerate(disks):
+        dataset_type, keystatus = datasets.get(dataset, ("filesystem", "-"))
+        lines.append('check ' + ' '.join([shlex.quote(element) for element in [dataset, args.zfspool + '/' + cloneName + str(index), mountRoot + '/' + str(index), dataset_type, keystatus, snapname[dataset]]]))
+    return '\n'.join(lines)
+
+#Clone, mount or checksum and destroy the snapshot of every verified disk, all in one remote script. Returns dataset -> (ok, detail)
+def deep_check(args, results, datasets):
+    disks = []
+    snapname = {}
+    for vmid, result in results.items():
+        if len(result["errors"]) == 0:
+            for dataset in result["disks"]:
+                disks.append(dataset)
+                snapname[dataset] = result["snapshot"]
+    if len(disks) == 0:
+        return {}
+    log ("Deep check (" + args.deep + ") of " + str(len(disks)) + " disks on " + args.hostname)
+    rc, stdout, stderr = run_script(args.hostname, deep_script(args, disks, datasets, snapname), readonly=False, shell='bash', transfer=True)
+    checked = {}
+    for line in stdout.split('\n'):
+        if line.startswith('::'):
+            dataset, unused, detail = line[2:].partition(' ')
+            checked[dataset] = (detail.startswith("ok"), detail[3:] if detail.startswith("ok") else detail[6:])
+    if rc != 0 and len(checked) < len(disks):
+        log ("Deep check on " + args.hostname + " failed: " + stderr)
+    return checked
+
+#Write the results to the status file. Sync results of the same id and backupname are kept, the verification is added to them
+def write_verify_status(backupname, results, verifytime):
+    with statusLock:
+        if not os.path.exists(pzm_common.statusJsonFile):
+            os.mknod(pzm_common.statusJsonFile)
+        with open(pzm_common.statusJsonFile, "r") as jsonFile:
+            try:
+                data = json.load(jsonFile)
+            except JSONDecodeError:
+                data = {}
+        for vmid, result in results.items():
+            entry = data.setdefault(vmid + "_" + backupname, {'id': vmid, 'backupname': backupname, 'starttime': "-", 'endtime': "-",
+                                                              'duration': "-", 'size': "-", 'status': "-", 'info': "Not synced from this node"})
+            entry['verify_status'] = "ok" if len(result["errors"]) == 0 else "error"
+            entry['verify_time'] = verifytime
+            entry['verify_info'] = ", ".join(result["errors"]) if len(result["errors"]) > 0 else str(len(result["disks"])) + " disks at " + result["snapshot"]
+            if "checksums" in result:
+                entry['verify_checksums'] = result["checksums"]
+        with open(pzm_common.statusJsonFile, "w") as jsonFile:
+            json.dump(data, jsonFile, indent=4)
+
+#Entry point of the "verify" command. Checks on the backup host that the newest snapshot of every guest is complete and matches its stored
+#config. Everything is done remote-side, batched in a few commands: one listing, the needed configs, and with --deep one script for all clones
+def verify(args):
+    if args.dest_config_path is None:
+        args.dest_config_path = defaultConfigPath
+    check_zfs_pool(args.hostname, args.zfspool)
+    starttime = datetime.datetime.now()
+    rc, stdout, stderr = run_script(args.hostname, inventory_script(args.zfspool, args.backupname, args.dest_config_path))
+    if rc != 0 and not "::configs" in stdout:
+        log ("Could not list " + args.hostname + ":" + args.zfspool + ": " + stderr)
+        return
+    snapshots, datasets, config_files, store_index = parse_inventory(stdout)
+    results = check_guests(args, snapshots, datasets, config_files, store_index)
+
+    if args.deep is not None:
+        lock(args.hostname)
+        try:
+            checked = deep_check(args, results, datasets)
+        finally:
+            unlock(args.hostname)
+        for vmid, result in results.items():
+            for dataset in result["disks"]:
+                if not dataset in checked:
+                    continue
+                ok, detail = checked[dataset]
+                if not ok:
+                    result["errors"].append(dataset + ": " + detail)
+                elif args.deep == "checksum":
+                    result.setdefault("checksums", {})[dataset] = detail
+
+    failed = [vmid for vmid, result in results.items() if len(result["errors"]) > 0]
+    for vmid, result in results.items():
+        if len(result["errors"]) > 0:
+            log ("ID " + vmid + ": " + ", ".join(result["errors"]))
+        else:
+            log_debug ("ID " + vmid + ": " + str(len(result["disks"])) + " disks at " + result["snapshot"] + " ok")
+    if not pzm_common.test:
+        write_verify_status(args.backupname, results, starttime.strftime(timeformat))
+    log ("Verified " + str(len(results)) + " IDs on " + args.hostname + ", " + str(len(failed)) + " failed. Took " + str(datetime.datetime.now() - starttime))